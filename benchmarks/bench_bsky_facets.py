@@ -0,0 +1,49 @@
+"""
+Compares building Bluesky text and link facets with the shared URLExtract (what bsky does)
+against constructing a new URLExtract for every post, as it used to.
+
+    python -m benchmarks.bench_bsky_facets [--number N]
+"""
+import argparse
+import timeit
+from urlextract import URLExtract
+from nitter_xposter import bsky
+from nitter_xposter.bsky import build_bsky_text
+
+STATUS_TEXTS = [
+    # Plain text
+    'Just shipped a new release, thanks everyone who helped test it & reported bugs!',
+    # Hashtags, mentions and an external link
+    'Reading https://example.com/blog/2024/01/a-very-long-article-title about '
+    'https://twitter.com/search?q=%23python and https://twitter.com/search?q=%23performance by https://twitter.com/someone <3',
+    # Retweet
+    'This 👇 https://twitter.com/search?q=%23news\nRT: https://twitter.com/someone/status/1234567890',
+]
+
+
+def bench(name, number):
+    seconds = timeit.timeit(lambda: [build_bsky_text(t) for t in STATUS_TEXTS], number=number)
+    per_post_us = seconds / (number * len(STATUS_TEXTS)) * 1e6
+    print(f"{name:<12} {per_post_us:10.1f} us/post")
+    return per_post_us
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    shared = bench('shared', args.number)
+
+    # Swap the cached getter for one that builds a new extractor every time
+    cached_get_url_extractor = bsky.get_url_extractor
+    bsky.get_url_extractor = URLExtract
+    try:
+        per_post = bench('per post', args.number)
+    finally:
+        bsky.get_url_extractor = cached_get_url_extractor
+    print(f"speedup      {per_post / shared:10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Measures how long a fresh interpreter takes to import what a one-shot run of main.py needs for each kind of deployment,
+against importing every SDK up front as xposter used to.
+
+    python -m benchmarks.bench_import [--number N]
+"""
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+# main.py only imports the SDK of a target once it is configured, which is what importing it for that target amounts to
+SCENARIOS = {
+    'main': 'import main',
+    'mastodon': 'import main, mastodon, nitter_xposter.mastodon',
+    'bsky': 'import main, atproto, nitter_xposter.bsky',
+    'async': 'import main, nitter_xposter.aio',
+    'eager': 'import main, mastodon, atproto, httpx, urlextract, nitter_xposter.mastodon, nitter_xposter.bsky',
+}
+
+
+def bench(name: str, statement: str, number: int) -> float:
+    timings = []
+    for _ in range(number):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-W', 'ignore', '-c', statement], check=True)
+        timings.append(time.perf_counter() - started)
+    median_ms = statistics.median(timings) * 1000
+    print(f"{name:<10} {median_ms:8.1f} ms")
+    return median_ms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=10)
+    args = parser.parse_args()
+
+    # An empty interpreter is the floor that no import can go below
+    bench('python', 'pass', args.number)
+    results = {name: bench(name, statement, args.number) for name, statement in SCENARIOS.items()}
+    print(f"speedup    {results['eager'] / results['mastodon']:8.1f}x (mastodon only)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures the memory that the feed entries of many feeds hold on to while they are crawled together,
+with the compact entries of xposter (slots, feedparser entries released right after parsing)
+against keeping the whole parsed feed and dataclass entries with per-target media lists, as xposter used to.
+
+    python -m benchmarks.bench_memory [--feeds N] [--statuses N] [--image-ratio R] [--images-per-status N]
+"""
+import gc
+import argparse
+import tracemalloc
+import feedparser
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+from nitter_xposter.xposter import FeedEntry, normalize_entry_id, parse_feed_entry
+from .fake_servers import FakeState, HANDLE
+
+NITTER_HOST = 'nitter.example.com'
+
+
+@dataclass
+class LegacyParsedEntry:
+    id: str
+    text: Optional[str]
+    rt: Optional[str]
+    image_urls: List[str]
+    mastodon_media_ids: List[str]
+    bsky_blobs: list
+
+
+def legacy(rss: str):
+    feed = feedparser.parse(rss)
+    for entry in feed.entries:
+        entry['id'] = normalize_entry_id(entry.id)
+    parsed_entries = []
+    for entry in feed.entries:
+        parsed_entry = parse_feed_entry(entry, HANDLE, NITTER_HOST)
+        parsed_entries.append(LegacyParsedEntry(
+            parsed_entry.id, parsed_entry.text, parsed_entry.rt, list(parsed_entry.image_urls), [], []
+        ))
+    return feed, parsed_entries
+
+
+def compact(rss: str):
+    feed = feedparser.parse(rss)
+    feed_entries = [
+        FeedEntry(normalize_entry_id(entry.id), entry.get('description'), entry.get('author'), entry.get('link'))
+        for entry in feed.entries
+    ]
+    del feed
+    return feed_entries, [parse_feed_entry(entry, HANDLE, NITTER_HOST) for entry in feed_entries]
+
+
+def retained_bytes(name: str, build: Callable[[str], object], feeds: List[str]) -> int:
+    # Memory still allocated once every feed is parsed, as while their statuses are queued and sent
+    gc.collect()
+    tracemalloc.start()
+    kept = [build(rss) for rss in feeds]
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    entries = sum(len(parsed_entries) for _, parsed_entries in kept)
+    print(f"{name:<8} {retained / 1024 / 1024:8.1f} MiB retained {retained / entries:8.0f} B/entry {peak / 1024 / 1024:8.1f} MiB peak")
+    del kept
+    return retained
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feeds', type=int, default=200)
+    parser.add_argument('--statuses', type=int, default=20, help='statuses per feed, a page of Nitter has 20')
+    parser.add_argument('--image-ratio', type=float, default=0.5, help='share of statuses with images')
+    parser.add_argument('--images-per-status', type=int, default=2)
+    args = parser.parse_args()
+
+    state = FakeState(args.image_ratio, args.images_per_status, 0)
+    feeds = []
+    for index in range(args.feeds):
+        state.first_id, state.count = index * args.statuses + 1, args.statuses
+        feeds.append(state.rss(NITTER_HOST))
+
+    before = retained_bytes('legacy', legacy, feeds)
+    after = retained_bytes('compact', compact, feeds)
+    print(f"saving   {1 - after / before:8.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Compares parsing Nitter descriptions with one streaming pass (what xposter does)
+against the two BeautifulSoup passes it used to do.
+
+    python -m benchmarks.bench_parse_description [--number N]
+
+BeautifulSoup is not a dependency of nitter-xposter anymore, so install it to run the comparison.
+"""
+import argparse
+import html
+import timeit
+from urllib.parse import urlparse, urlunparse
+from nitter_xposter.xposter import parse_description
+
+NITTER_HOST = 'nitter.example.com'
+
+DESCRIPTIONS = [
+    # Plain text
+    '<p>Just shipped a new release, thanks everyone who helped test it &amp; reported bugs!</p>',
+    # Hashtags, mentions and an external link
+    '<p>Reading <a href="https://example.com/blog/2024/01/a-very-long-article-title">example.com/blog/2024/01/a-ve…</a> '
+    'about <a href="http://nitter.example.com/search?q=%23python">#python</a> and '
+    '<a href="http://nitter.example.com/search?q=%23performance">#performance</a> by '
+    '<a href="http://nitter.example.com/someone">@someone</a> &lt;3</p>',
+    # Images
+    '<p>Sunset today</p>'
+    '<img src="http://nitter.example.com/pic/media%2FGAAAAAAAAAAAAAA.jpg" style="max-width:250px;" />'
+    '<img src="http://nitter.example.com/pic/media%2FGBBBBBBBBBBBBBB.jpg" style="max-width:250px;" />'
+    '<img src="http://nitter.example.com/pic/media%2FGCCCCCCCCCCCCCC.jpg" style="max-width:250px;" />'
+    '<img src="http://nitter.example.com/pic/media%2FGDDDDDDDDDDDDDD.jpg" style="max-width:250px;" />',
+    # Quote tweet
+    '<p>This 👇 <a href="http://nitter.example.com/search?q=%23news">#news</a></p><hr/>'
+    '<blockquote><b>Someone (@someone)</b><p>Original tweet text with a link '
+    '<a href="https://example.org/">example.org</a></p>'
+    '<img src="http://nitter.example.com/pic/media%2FGEEEEEEEEEEEEEE.jpg" style="max-width:250px;" />'
+    '<footer><hr/><a href="http://nitter.example.com/someone/status/1234567890#m">nitter.example.com/someone/status/1234567890#m</a></footer>'
+    '</blockquote>',
+]
+
+
+def parse_description_with_bs4(description, nitter_host):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(description, "html.parser")
+    for a in soup.find_all('a'):
+        if a.has_attr('href'):
+            parsed_href = urlparse(a['href'])
+            if parsed_href.netloc == nitter_host:
+                parsed_href = parsed_href._replace(netloc='twitter.com')
+                parsed_href = parsed_href._replace(scheme='https')
+            a.replace_with(urlunparse(parsed_href))
+    text = html.unescape(soup.get_text())
+
+    soup = BeautifulSoup(description, "html.parser")
+    image_urls = [img['src'] for img in soup.find_all('img') if img.has_attr('src')]
+
+    return text, image_urls
+
+
+def bench(name, parse, number):
+    seconds = timeit.timeit(lambda: [parse(d, NITTER_HOST) for d in DESCRIPTIONS], number=number)
+    per_entry_us = seconds / (number * len(DESCRIPTIONS)) * 1e6
+    print(f"{name:<12} {per_entry_us:8.1f} us/entry")
+    return per_entry_us
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    streaming = bench('streaming', parse_description, args.number)
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        print("beautifulsoup4 is not installed, skipping comparison")
+        return
+
+    for description in DESCRIPTIONS:
+        assert parse_description(description, NITTER_HOST) == parse_description_with_bs4(description, NITTER_HOST), description
+    two_pass_bs4 = bench('bs4 x2', parse_description_with_bs4, args.number)
+    print(f"speedup      {two_pass_bs4 / streaming:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Measures xpost end to end, from crawling a feed to sending its statuses, against local stand-ins for Nitter,
+Mastodon and a Bluesky PDS (see fake_servers), and prints the results as JSON so that runs can be compared.
+
+    python -m benchmarks.bench_pipeline [--statuses N] [--rounds N] [--image-ratio R] [--images-per-status N]
+        [--image-kb N] [--latency-ms N] [--targets mastodon,bsky] [--engine sync|async] [--output FILE]
+
+Each round puts `--statuses` new statuses in the feed and runs xpost once. The first crawl only marks the feed as seen
+and is not measured. Per-stage times are taken from the metrics of nitter_xposter, and peak RSS is that of this process,
+as the servers run in a child process.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import platform
+import multiprocessing
+import requests
+from mastodon import Mastodon
+from atproto import Client
+from nitter_xposter import xposter
+from nitter_xposter.db import StateStore
+from nitter_xposter.bsky import login_to_bsky
+from nitter_xposter.xposter import xpost, XpostConfig, XpostClients
+from nitter_xposter.aio import xpost_many_async
+from nitter_xposter.ratelimit import RateLimit
+from nitter_xposter.metrics import (
+    REGISTRY, FEED_FETCH_SECONDS, FEED_PARSE_SECONDS, IMAGE_DOWNLOAD_SECONDS, MEDIA_TRANSCODE_SECONDS, MEDIA_UPLOAD_SECONDS, POST_SECONDS
+)
+from .fake_servers import serve_fake_servers, HANDLE
+
+STAGES = {
+    'feed_fetch': FEED_FETCH_SECONDS,
+    'feed_parse': FEED_PARSE_SECONDS,
+    'image_download': IMAGE_DOWNLOAD_SECONDS,
+    'media_transcode': MEDIA_TRANSCODE_SECONDS,
+    'media_upload': MEDIA_UPLOAD_SECONDS,
+    'post': POST_SECONDS,
+}
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def build_clients(config: XpostConfig, targets: list, mastodon_port: int, pds_port: int) -> XpostClients:
+    # create_clients only talks to Mastodon over HTTPS and to bsky.social, so the clients are pointed to the stand-ins here
+    store = StateStore(config.sqlite_file)
+    clients = XpostClients(store=store, session=requests.Session())
+    if 'mastodon' in targets:
+        clients.mastodon = Mastodon(
+            client_id='bench', client_secret='bench', access_token='bench',
+            api_base_url=f"http://127.0.0.1:{mastodon_port}", ratelimit_method='throw'
+        )
+    if 'bsky' in targets:
+        clients.bsky = Client(base_url=f"http://127.0.0.1:{pds_port}/xrpc")
+        login_to_bsky(clients.bsky, store, config.bsky_handle, config.bsky_password)
+    return clients
+
+
+def run_round(config: XpostConfig, clients: XpostClients, engine: str):
+    if engine == 'async':
+        failed = asyncio.run(xpost_many_async([config], 1, {0: clients}))
+        if failed:
+            raise Exception("xpost failed, see the log")
+    else:
+        xpost(config, clients)
+    clients.store.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--statuses', type=int, default=40, help='new statuses in the feed per round')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--image-ratio', type=float, default=0.5, help='share of statuses with images')
+    parser.add_argument('--images-per-status', type=int, default=2)
+    parser.add_argument('--image-kb', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=20, help='latency added to every request to the stand-ins')
+    parser.add_argument('--targets', default='mastodon,bsky')
+    parser.add_argument('--engine', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--output', help='file to write the results to, instead of stdout')
+    args = parser.parse_args()
+    targets = args.targets.split(',')
+
+    # Statuses are paced by the rate limit of each target, which the benchmark would otherwise run into
+    xposter.MASTODON_STATUS_RATE_LIMIT = xposter.BSKY_STATUS_RATE_LIMIT = RateLimit(burst=1e9, per_second=1e9)
+
+    context = multiprocessing.get_context('spawn')
+    connection, child_connection = context.Pipe()
+    servers = context.Process(
+        target=serve_fake_servers,
+        args=(child_connection, args.latency_ms / 1000, args.image_ratio, args.images_per_status, args.image_kb * 1024),
+        daemon=True
+    )
+    servers.start()
+    nitter_port, mastodon_port, pds_port = connection.recv()
+    control_url = f"http://127.0.0.1:{nitter_port}/_bench"
+
+    sqlite_file = os.path.join(tempfile.mkdtemp(prefix='bench-pipeline-'), 'bench.db')
+    config = XpostConfig(
+        sqlite_file=sqlite_file,
+        nitter_host=f"127.0.0.1:{nitter_port}",
+        nitter_https=False,
+        twitter_handle=HANDLE,
+        mastodon_host=f"127.0.0.1:{mastodon_port}" if 'mastodon' in targets else None,
+        mastodon_client_id='bench',
+        mastodon_client_secret='bench',
+        mastodon_access_token='bench',
+        mastodon_status_limit=0,
+        bsky_handle='bench.test' if 'bsky' in targets else None,
+        bsky_password='bench',
+        bsky_status_limit=0,
+    )
+    clients = build_clients(config, targets, mastodon_port, pds_port)
+    try:
+        # The first crawl only marks what is in the feed as seen
+        requests.post(f"{control_url}/feed", json={'first_id': 1, 'count': args.statuses}).raise_for_status()
+        run_round(config, clients, args.engine)
+        for metric in REGISTRY:
+            metric.clear()
+
+        round_seconds = []
+        for index in range(args.rounds):
+            first_id = (index + 1) * args.statuses + 1
+            requests.post(f"{control_url}/feed", json={'first_id': first_id, 'count': args.statuses}).raise_for_status()
+            started = time.perf_counter()
+            run_round(config, clients, args.engine)
+            round_seconds.append(time.perf_counter() - started)
+        stats = requests.get(f"{control_url}/stats").json()
+    finally:
+        clients.store.close()
+        connection.close()
+        servers.join(timeout=5)
+        if servers.is_alive():
+            servers.terminate()
+
+    expected_statuses = args.statuses * args.rounds * len(targets)
+    if stats['statuses'] != expected_statuses:
+        raise Exception(f"Expected {expected_statuses} statuses to be sent, but {stats['statuses']} were")
+
+    total_seconds = sum(round_seconds)
+    results = {
+        'params': vars(args),
+        'python': platform.python_version(),
+        'statuses_sent': stats['statuses'],
+        'media_uploaded': stats['uploads'],
+        'total_seconds': total_seconds,
+        'round_seconds': round_seconds,
+        'statuses_per_second': stats['statuses'] / total_seconds,
+        'stages': {
+            name: dict(zip(('seconds', 'count'), histogram.totals()))
+            for name, histogram in STAGES.items()
+        },
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Local stand-ins for a Nitter host, a Mastodon instance and a Bluesky PDS, used by bench_pipeline.
+They answer just enough of each API for xpost to crawl a feed, download its images and send its statuses,
+after an injected latency.
+
+The feed served by Nitter is set with POST /_bench/feed {"first_id": ..., "count": ...},
+and GET /_bench/stats returns how many images were uploaded and statuses sent.
+"""
+import json
+import time
+import base64
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+HANDLE = 'bench'
+# A valid CID, the PDS doesn't check what blobs refer to
+BLOB_CID = 'bafkreibme22gw2h7y2h7tg2fhqotaqjucnbc24deqo72b6mkl2egezxhvy'
+
+
+def fake_jwt(did: str) -> str:
+    def encode(value: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+    return f"{encode({'alg': 'none'})}.{encode({'sub': did, 'exp': int(time.time()) + 24 * 60 * 60})}.sig"
+
+
+def fake_image(url: str, size: int) -> bytes:
+    # Every URL gets different bytes, so that uploads are not skipped as duplicates of each other
+    seed = hashlib.sha256(url.encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class FakeState:
+    def __init__(self, image_ratio: float, images_per_status: int, image_bytes: int):
+        self.image_ratio = image_ratio
+        self.images_per_status = images_per_status
+        self.image_bytes = image_bytes
+        self.lock = threading.Lock()
+        self.first_id = 1
+        self.count = 0
+        self.uploads = 0
+        self.statuses = 0
+
+    def rss(self, host: str) -> str:
+        items = []
+        for status_id in range(self.first_id + self.count - 1, self.first_id - 1, -1):
+            # Spread images evenly over the feed, e.g. every other status for a ratio of 0.5
+            has_images = int(status_id * self.image_ratio) != int((status_id - 1) * self.image_ratio)
+            images = ''.join(
+                f'<img src="http://{host}/pic/media%2F{status_id}_{index}.jpg" style="max-width:250px;" />'
+                for index in range(self.images_per_status if has_images else 0)
+            )
+            items.append(f"""<item>
+    <title>title</title>
+    <dc:creator>@{HANDLE}</dc:creator>
+    <description><![CDATA[<p>Status {status_id} with a <a href="http://{host}/search?q=%23hashtag">#hashtag</a> and a link https://example.com/{status_id}</p>{images}]]></description>
+    <pubDate>{formatdate(usegmt=True)}</pubDate>
+    <guid>http://{host}/{HANDLE}/status/{status_id}#m</guid>
+    <link>http://{host}/{HANDLE}/status/{status_id}#m</link>
+</item>""")
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<rss xmlns:atom="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/elements/1.1/" version="2.0">
+  <channel>
+    <title>{HANDLE} / @{HANDLE}</title>
+    <link>http://{host}/{HANDLE}</link>
+    <description>Twitter feed for: @{HANDLE}. Generated by {host}</description>
+    {''.join(items)}
+  </channel>
+</rss>
+"""
+
+
+def make_handler(state: FakeState, latency_seconds: float):
+    class FakeHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, body, content_type: str = 'application/json; charset=utf-8', status: int = 200):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode() if content_type.startswith('application/json') else body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/_bench/stats':
+                with state.lock:
+                    self._send({'uploads': state.uploads, 'statuses': state.statuses})
+                return
+            time.sleep(latency_seconds)
+            host = self.headers['Host']
+            if path == f'/{HANDLE}/rss':
+                with state.lock:
+                    body = state.rss(host)
+                self._send(body, 'application/rss+xml; charset=utf-8')
+            elif path.startswith('/pic/'):
+                self._send(fake_image(self.path, state.image_bytes), 'image/jpeg')
+            elif path.rstrip('/') == '/api/v1/instance':
+                self._send({'version': '4.2.0', 'uri': host, 'title': 'bench'})
+            elif path == '/xrpc/app.bsky.actor.getProfile':
+                self._send({'did': 'did:plc:bench', 'handle': 'bench.test'})
+            else:
+                self._send({'error': 'Not found'}, status=404)
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            body = self._read_body()
+            if path == '/_bench/feed':
+                feed = json.loads(body)
+                with state.lock:
+                    state.first_id, state.count = feed['first_id'], feed['count']
+                self._send({})
+                return
+            time.sleep(latency_seconds)
+            if path in ('/api/v1/media', '/api/v2/media'):
+                with state.lock:
+                    state.uploads += 1
+                    media_id = str(state.uploads)
+                self._send({'id': media_id, 'type': 'image', 'url': f'http://{self.headers["Host"]}/media/{media_id}.jpg'})
+            elif path == '/api/v1/statuses':
+                with state.lock:
+                    state.statuses += 1
+                    status_id = str(state.statuses)
+                self._send({'id': status_id, 'content': '', 'media_attachments': []})
+            elif path == '/xrpc/com.atproto.server.createSession':
+                self._send({'did': 'did:plc:bench', 'handle': 'bench.test', 'accessJwt': fake_jwt('did:plc:bench'), 'refreshJwt': fake_jwt('did:plc:bench')})
+            elif path == '/xrpc/com.atproto.repo.uploadBlob':
+                with state.lock:
+                    state.uploads += 1
+                self._send({'blob': {'$type': 'blob', 'ref': {'$link': BLOB_CID}, 'mimeType': self.headers['Content-Type'], 'size': len(body)}})
+            elif path == '/xrpc/com.atproto.repo.createRecord':
+                with state.lock:
+                    state.statuses += 1
+                    rkey = state.statuses
+                self._send({'uri': f'at://did:plc:bench/app.bsky.feed.post/{rkey}', 'cid': BLOB_CID})
+            else:
+                self._send({'error': 'Not found'}, status=404)
+
+    return FakeHandler
+
+
+def serve_fake_servers(connection, latency_seconds: float, image_ratio: float, images_per_status: int, image_bytes: int):
+    # Runs in a child process so that the servers don't compete with xpost for the GIL or add to its RSS.
+    # Nitter, Mastodon and the PDS get a port each, as they would be different hosts, and their ports are sent back
+    state = FakeState(image_ratio, images_per_status, image_bytes)
+    servers = [ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state, latency_seconds)) for _ in range(3)]
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection.send([server.server_address[1] for server in servers])
+    # Serve until the parent closes its end or terminates the process
+    try:
+        connection.recv()
+    except EOFError:
+        pass
@@ -1,5 +1,10 @@
 import os
 from nitter_xposter.xposter import xpost, XpostConfig
+from nitter_xposter.daemon import run_daemon
+from nitter_xposter.accounts import load_accounts_config, xpost_many
+from nitter_xposter.media import DEFAULT_SPILL_BYTES
+from nitter_xposter.outbox import DEFAULT_RETRY_BASE_SECONDS
+from nitter_xposter.metrics import serve_metrics, write_metrics_textfile
 
 
 def env_or_bust(env: str):
@@ -7,11 +12,15 @@ def env_or_bust(env: str):
         raise Exception(f"Environment {env} is not set")
     return os.environ[env]
 
-DEFAULT_CROSSPOST_LIMIT = 10
+# 0 leaves it to the rate limiter of each target
+DEFAULT_CROSSPOST_LIMIT = 0
+DEFAULT_INTERVAL_MINUTES = 5
+DEFAULT_JITTER_SECONDS = 30
+DEFAULT_POST_HOOK = '/app/post.sh'
 
 
-if __name__ == "__main__":
-    xpost_config = XpostConfig(
+def config_from_env() -> XpostConfig:
+    return XpostConfig(
         sqlite_file=env_or_bust('SQLITE_FILE'),
         nitter_host=env_or_bust('NITTER_HOST'),
         nitter_https=bool(os.environ.get('NITTER_HTTPS', 'true') == 'true'),
@@ -24,5 +33,54 @@ if __name__ == "__main__":
         bsky_handle=os.getenv('BSKY_HANDLE', None),
         bsky_password=os.getenv('BSKY_PASSWORD', None),
         bsky_status_limit=int(os.getenv('BSKY_STATUS_LIMIT', str(DEFAULT_CROSSPOST_LIMIT))),
+        media_spill_bytes=int(os.getenv('MEDIA_SPILL_BYTES', str(DEFAULT_SPILL_BYTES))),
+        retry_base_seconds=float(os.getenv('RETRY_BASE_SECONDS', str(DEFAULT_RETRY_BASE_SECONDS))),
     )
-    xpost(xpost_config)
+
+
+if __name__ == "__main__":
+    if os.getenv('ACCOUNTS_FILE'):
+        xpost_configs, concurrency = load_accounts_config(os.environ['ACCOUNTS_FILE'])
+    else:
+        xpost_configs, concurrency = [config_from_env()], 1
+
+    if os.getenv('METRICS_PORT'):
+        serve_metrics(int(os.environ['METRICS_PORT']))
+    metrics_textfile = os.getenv('METRICS_TEXTFILE')
+
+    if os.getenv('DAEMON', 'false') == 'true':
+        run_daemon(
+            xpost_configs,
+            interval_minutes=int(os.getenv('INTERVAL_MINUTES', str(DEFAULT_INTERVAL_MINUTES))),
+            jitter_seconds=int(os.getenv('JITTER_SECONDS', str(DEFAULT_JITTER_SECONDS))),
+            post_hook=os.getenv('POST_HOOK', DEFAULT_POST_HOOK),
+            concurrency=concurrency,
+            metrics_textfile=metrics_textfile,
+        )
+    else:
+        try:
+            if os.getenv('BACKFILL_SINCE'):
+                from nitter_xposter.backfill import backfill, parse_backfill_since
+                since_status_id, since_time = parse_backfill_since(os.environ['BACKFILL_SINCE'])
+                for xpost_config in xpost_configs:
+                    backfill(xpost_config, since_status_id, since_time)
+            elif os.getenv('ASYNC', 'false') == 'true':
+                # The async engine pulls in asyncio and httpx, which one-shot runs of the sync engine don't need
+                import asyncio
+                from nitter_xposter.aio import xpost_many_async, DEFAULT_PER_HOST_CONCURRENCY
+                failed = asyncio.run(xpost_many_async(
+                    xpost_configs,
+                    concurrency,
+                    per_host_concurrency=int(os.getenv('PER_HOST_CONCURRENCY', str(DEFAULT_PER_HOST_CONCURRENCY))),
+                ))
+                if failed:
+                    raise Exception(f"Failed to crosspost for {failed} accounts")
+            elif len(xpost_configs) == 1:
+                xpost(xpost_configs[0])
+            else:
+                failed = xpost_many(xpost_configs, concurrency)
+                if failed:
+                    raise Exception(f"Failed to crosspost for {failed} accounts")
+        finally:
+            if metrics_textfile:
+                write_metrics_textfile(metrics_textfile)
@@ -0,0 +1,141 @@
+import json
+import threading
+import logging
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from .db import StateStore
+from .xposter import xpost, deliver_outbox, create_clients, mastodon_client_key, XpostConfig, XpostClients
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_STATUS_LIMIT = 0
+
+# Fields that don't have to be present in an accounts file because the env based config doesn't require them either
+OPTIONAL_FIELDS = {
+    'nitter_https': True,
+    'mastodon_host': None,
+    'mastodon_client_id': None,
+    'mastodon_client_secret': None,
+    'mastodon_access_token': None,
+    'mastodon_status_limit': DEFAULT_STATUS_LIMIT,
+    'bsky_handle': None,
+    'bsky_password': None,
+    'bsky_status_limit': DEFAULT_STATUS_LIMIT,
+}
+
+
+def parse_accounts_config(raw: dict) -> Tuple[List[XpostConfig], int]:
+    """
+    Parses an accounts config such as
+
+    {
+        "sqlite_file": "/app/dbs/db.db",
+        "nitter_host": "nitter.example.com",
+        "concurrency": 4,
+        "accounts": [
+            {"twitter_handle": "alice", "mastodon_host": "...", ...},
+            {"twitter_handle": "bob", "bsky_handle": "...", "bsky_password": "..."}
+        ]
+    }
+
+    Top level keys other than "accounts" and "concurrency" are defaults shared by all accounts,
+    and each account can override any of them.
+    """
+    field_names = {f.name for f in dataclasses.fields(XpostConfig)}
+    defaults = {k: v for k, v in raw.items() if k not in ('accounts', 'concurrency')}
+    concurrency = int(raw.get('concurrency', DEFAULT_CONCURRENCY))
+    if concurrency < 1:
+        raise Exception("concurrency must be at least 1")
+
+    configs = []
+    for account in raw.get('accounts', []):
+        values = {**OPTIONAL_FIELDS, **defaults, **account}
+        unknown = set(values.keys()) - field_names
+        if unknown:
+            raise Exception(f"Unknown keys in accounts config: {', '.join(sorted(unknown))}")
+        missing = {f.name for f in dataclasses.fields(XpostConfig) if f.default is dataclasses.MISSING} - set(values.keys())
+        if missing:
+            raise Exception(f"Missing keys in accounts config for {account.get('twitter_handle')}: {', '.join(sorted(missing))}")
+        configs.append(XpostConfig(**values))
+
+    if not configs:
+        raise Exception("No accounts found in accounts config")
+    return configs, concurrency
+
+
+def load_accounts_config(accounts_file: str) -> Tuple[List[XpostConfig], int]:
+    with open(accounts_file) as f:
+        return parse_accounts_config(json.load(f))
+
+
+def xpost_many(configs: List[XpostConfig], concurrency: int, clients: Optional[Dict[int, XpostClients]] = None, deliver: bool = True) -> int:
+    """
+    Runs xpost for all accounts in one process with at most `concurrency` accounts crawled at once.
+    `clients` maps the index of an account in `configs` to its clients and is filled in as they are created,
+    so that they can be reused across calls.
+    Accounts using the same SQLite file share one store, which is committed once all accounts are crawled,
+    and accounts posting to the same Mastodon account share one Mastodon client.
+    If `deliver` is False, new statuses are only queued and deliver_many is expected to send them.
+    Returns the number of accounts that failed.
+    """
+    owns_clients = clients is None
+    if clients is None:
+        clients = {}
+    stores = {c.store.sqlite_file: c.store for c in clients.values()}  # type: Dict[str, StateStore]
+    stores_lock = threading.Lock()
+    mastodon_clients = {mastodon_client_key(configs[index]): c.mastodon for index, c in clients.items() if c.mastodon}
+
+    def store_for(sqlite_file: str) -> StateStore:
+        with stores_lock:
+            if sqlite_file not in stores:
+                stores[sqlite_file] = StateStore(sqlite_file)
+            return stores[sqlite_file]
+
+    def xpost_one(index: int) -> bool:
+        config = configs[index]
+        try:
+            if index not in clients:
+                clients[index] = create_clients(config, store_for(config.sqlite_file), mastodon_clients)
+            xpost(config, clients[index], deliver)
+            return True
+        except Exception as e:
+            # One account failing doesn't hold back the others, it is logged and counted in the result
+            logging.error(f"Error crossposting for {config.twitter_handle}: " + str(e))
+            return False
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='xpost') as executor:
+            results = list(executor.map(xpost_one, range(len(configs))))
+    finally:
+        for store in stores.values():
+            if owns_clients:
+                store.close()
+            else:
+                store.commit()
+    return results.count(False)
+
+
+def deliver_many(configs: List[XpostConfig], concurrency: int, clients: Dict[int, XpostClients]) -> int:
+    """
+    Sends the queued statuses of all accounts whose clients were created by xpost_many, and commits their stores.
+    Returns the number of accounts that failed.
+    """
+    # Accounts can be added to `clients` by a crawl running at the same time
+    created_clients = dict(clients)
+
+    def deliver_one(index: int) -> bool:
+        config = configs[index]
+        try:
+            deliver_outbox(config, created_clients[index])
+            return True
+        except Exception as e:
+            logging.error(f"Error delivering for {config.twitter_handle}: " + str(e))
+            return False
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='deliver') as executor:
+            results = list(executor.map(deliver_one, sorted(created_clients.keys())))
+    finally:
+        for store in {c.store.sqlite_file: c.store for c in created_clients.values()}.values():
+            store.commit()
+    return results.count(False)
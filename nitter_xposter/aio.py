@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import threading
+import dataclasses
+import httpx
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlparse
+from .db import StateStore
+from .media import Media, download_image_async, cleanup_media
+from .metrics import IMAGE_DOWNLOAD_SECONDS
+from .nitter_pool import NitterPool, fetch_feed_async
+from .xposter import (
+    XpostConfig, XpostClients, Target, create_clients, mastodon_client_key, build_targets, feed_key_of, feed_request_headers,
+    process_feed_response, deliver_to_target, record_fetch_error, evict_after_delivery, REQUEST_TIMEOUT_SECONDS
+)
+
+DEFAULT_PER_HOST_CONCURRENCY = 4
+
+
+class HostLimiter:
+    """
+    Limits how many requests are made to each host at once, across all feeds and targets running on the event loop
+    """
+    def __init__(self, per_host: int):
+        self.per_host = per_host
+        self._semaphores = {}  # type: Dict[str, asyncio.Semaphore]
+
+    def __call__(self, url_or_host: str) -> asyncio.Semaphore:
+        host = urlparse(url_or_host).netloc or url_or_host
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host)
+        return self._semaphores[host]
+
+
+class AsyncImages:
+    """
+    Same as SharedImages, but images are downloaded on the event loop, while they are waited on from delivery threads
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, http: httpx.AsyncClient, limiter: HostLimiter, spill_bytes: int):
+        self.loop = loop
+        self.http = http
+        self.limiter = limiter
+        self.spill_bytes = spill_bytes
+        self._lock = threading.Lock()
+        self._images = {}  # type: Dict[str, Future]
+
+    async def _download(self, image_url: str) -> Media:
+        async with self.limiter(image_url):
+            with IMAGE_DOWNLOAD_SECONDS.time(host=urlparse(image_url).netloc):
+                return await download_image_async(image_url, self.http, self.spill_bytes, REQUEST_TIMEOUT_SECONDS)
+
+    def prefetch(self, image_urls: List[str]):
+        with self._lock:
+            for image_url in image_urls:
+                if image_url not in self._images:
+                    self._images[image_url] = asyncio.run_coroutine_threadsafe(self._download(image_url), self.loop)
+
+    def get(self, image_url: str) -> Media:
+        # Raises DownloadError if the image could not be downloaded
+        self.prefetch([image_url])
+        return self._images[image_url].result()
+
+    async def cleanup(self):
+        # Same as SharedImages.cleanup
+        for future in list(self._images.values()):
+            try:
+                media = await asyncio.wrap_future(future)
+            except Exception:
+                continue
+            cleanup_media(media)
+
+
+def limit_target(target: Target, loop: asyncio.AbstractEventLoop, limiter: HostLimiter) -> Target:
+    # Uploads and posts are made by the blocking SDKs in the default executor, but still count towards the limit of the target host
+    def limited(call: Callable) -> Callable:
+        async def limited_call(*args):
+            async with limiter(target.host):
+                return await asyncio.to_thread(call, *args)
+        return lambda *args: asyncio.run_coroutine_threadsafe(limited_call(*args), loop).result()
+    return dataclasses.replace(target, upload_media=limited(target.upload_media), post=limited(target.post))
+
+
+async def crawl_async(config: XpostConfig, clients: XpostClients, http: httpx.AsyncClient, limiter: HostLimiter):
+    # Same as crawl, with the feed fetched on the event loop
+    logging.info("Started crawl")
+    feed_key = feed_key_of(config)
+    targets = build_targets(config, clients)
+    validators, headers = feed_request_headers(clients.store, feed_key, targets)
+    pool = NitterPool(clients.store, config.nitter_hosts())
+    try:
+        nitter_host, res = await fetch_feed_async(
+            pool, http, limiter, config.twitter_handle, config.nitter_https, headers, REQUEST_TIMEOUT_SECONDS
+        )
+    except Exception as e:
+        record_fetch_error(feed_key, e)
+        return
+    # Parsing the feed is CPU bound, so it is kept off the event loop
+    await asyncio.to_thread(
+        process_feed_response, config, clients.store, feed_key, targets, validators, nitter_host, res.status_code, res.content, res.text, res.headers
+    )
+
+
+async def deliver_outbox_async(config: XpostConfig, clients: XpostClients, http: httpx.AsyncClient, limiter: HostLimiter, executor: ThreadPoolExecutor):
+    # Same as deliver_outbox, with images downloaded and requests to targets limited on the event loop.
+    # Each target still sends its statuses one by one in its own thread so that they are posted in order
+    loop = asyncio.get_running_loop()
+    store = clients.store
+    feed_key = feed_key_of(config)
+    images = AsyncImages(loop, http, limiter, config.media_spill_bytes)
+    try:
+        await asyncio.gather(*[
+            loop.run_in_executor(
+                executor, deliver_to_target, store, feed_key, limit_target(target, loop, limiter), images, config.retry_base_seconds
+            )
+            for target in build_targets(config, clients)
+        ])
+    finally:
+        await images.cleanup()
+        evict_after_delivery(store)
+
+
+async def xpost_many_async(
+    configs: List[XpostConfig],
+    concurrency: int,
+    clients: Optional[Dict[int, XpostClients]] = None,
+    per_host_concurrency: int = DEFAULT_PER_HOST_CONCURRENCY,
+    http: Optional[httpx.AsyncClient] = None
+) -> int:
+    """
+    Same as xpost_many, but all feeds are fetched, images downloaded and statuses sent from one event loop,
+    with at most `per_host_concurrency` requests to the same host at once and `concurrency` accounts delivering at once.
+    Returns the number of accounts that failed.
+    """
+    owns_clients = clients is None
+    if clients is None:
+        clients = {}
+    stores = {c.store.sqlite_file: c.store for c in clients.values()}  # type: Dict[str, StateStore]
+    mastodon_clients = {mastodon_client_key(configs[index]): c.mastodon for index, c in clients.items() if c.mastodon}
+    limiter = HostLimiter(per_host_concurrency)
+    owns_http = http is None
+    if http is None:
+        http = httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=per_host_concurrency * 4))
+
+    async def xpost_one(index: int, executor: ThreadPoolExecutor) -> bool:
+        config = configs[index]
+        try:
+            if index not in clients:
+                if config.sqlite_file not in stores:
+                    stores[config.sqlite_file] = StateStore(config.sqlite_file)
+                # Creating clients can log in to Bluesky, which blocks
+                clients[index] = await asyncio.to_thread(create_clients, config, stores[config.sqlite_file], mastodon_clients)
+            # Same as xpost_with_clients
+            try:
+                await crawl_async(config, clients[index], http, limiter)
+            finally:
+                await deliver_outbox_async(config, clients[index], http, limiter, executor)
+            return True
+        except Exception as e:
+            logging.error(f"Error crossposting for {config.twitter_handle}: " + str(e))
+            return False
+
+    try:
+        # Threads of the delivery executor wait on the event loop, so they are kept apart from the default executor
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='deliver') as executor:
+            results = await asyncio.gather(*[xpost_one(index, executor) for index in range(len(configs))])
+    finally:
+        if owns_http:
+            await http.aclose()
+        for store in stores.values():
+            if owns_clients:
+                store.close()
+            else:
+                store.commit()
+    return results.count(False)
+
@@ -0,0 +1,152 @@
+import time
+import calendar
+import logging
+import feedparser
+from datetime import datetime, timezone
+from typing import List, Optional, Set, Tuple
+from .db import StateStore
+from .nitter_pool import NitterPool, fetch_feed
+from .outbox import dump_parsed_entry
+from .metrics import FEED_BYTES, FEED_PARSE_SECONDS, STATUSES_QUEUED
+from .xposter import (
+    create_clients, build_targets, deliver_outbox, feed_key_of, normalize_entry_id, parse_feed_entry, status_id_of,
+    target_feed_name, XpostConfig, XpostClients, REQUEST_TIMEOUT_SECONDS
+)
+
+# Stops paging back even if the statuses to backfill to were not reached, e.g. if the given status id is a typo
+BACKFILL_MAX_PAGES = 200
+# How many statuses are looked up in the seen statuses at once, under SQLite's limit of query parameters
+SEEN_LOOKUP_BATCH = 500
+# Status ids start with when the status was posted, in milliseconds since this epoch
+TWITTER_EPOCH_MS = 1288834974657
+
+
+def parse_backfill_since(value: str) -> Tuple[Optional[int], Optional[float]]:
+    # Either a status id, or an ISO date such as 2024-01-31 or 2024-01-31T12:00:00+09:00 which is taken as UTC without a timezone
+    value = value.strip()
+    if value.isdigit():
+        return int(value), None
+    since = datetime.fromisoformat(value)
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return None, since.timestamp()
+
+
+def status_time(status_id: int) -> float:
+    return ((status_id >> 22) + TWITTER_EPOCH_MS) / 1000
+
+
+def is_retweet(entry, twitter_handle: str) -> bool:
+    return bool(entry.get('author')) and entry.get('author') != f"@{twitter_handle}"
+
+
+def is_after_since(entry, twitter_handle: str, since_status_id: Optional[int], since_time: Optional[float]) -> bool:
+    published = entry.get('published_parsed')
+    if is_retweet(entry, twitter_handle):
+        # The id of a retweet is the one of the retweeted status, which can be much older, so retweets go by when they were retweeted
+        if since_status_id is not None:
+            since_time = max(since_time or 0, status_time(since_status_id))
+    elif since_status_id is not None and status_id_of(entry.id) <= since_status_id:
+        return False
+    if since_time is not None and published is not None and calendar.timegm(published) < since_time:
+        return False
+    return True
+
+
+def get_seen_by_all(store: StateStore, feed_names: List[str], status_ids: List[int]) -> Set[int]:
+    # Statuses that every target has already seen, and so are not backfilled
+    seen = set(status_ids)
+    for feed_name in feed_names:
+        seen_by_target = set()
+        for index in range(0, len(status_ids), SEEN_LOOKUP_BATCH):
+            seen_by_target |= store.get_seen(feed_name, status_ids[index:index + SEEN_LOOKUP_BATCH])
+        seen &= seen_by_target
+    return seen
+
+
+def backfill(config: XpostConfig, since_status_id: Optional[int], since_time: Optional[float], clients: Optional[XpostClients] = None):
+    """
+    Pages back through the feed to the statuses after `since_status_id` or `since_time`, queues the ones that were not seen
+    oldest first, and delivers them as fast as the rate limit of each target allows.
+    Every page is checkpointed in the store, so an interrupted backfill resumes from the next page when run again
+    """
+    if clients is not None:
+        backfill_with_clients(config, clients, since_status_id, since_time)
+        return
+
+    clients = create_clients(config)
+    try:
+        backfill_with_clients(config, clients, since_status_id, since_time)
+    finally:
+        clients.store.close()
+
+
+def backfill_with_clients(config: XpostConfig, clients: XpostClients, since_status_id: Optional[int], since_time: Optional[float]):
+    store = clients.store
+    feed_key = feed_key_of(config)
+    targets = build_targets(config, clients)
+    feed_names = [target_feed_name(feed_key, target.account) for target in targets]
+
+    checkpoint = store.get_backfill(feed_key)
+    if checkpoint is None:
+        cursor, pages = None, 0
+        logging.info(f"Started backfill of {feed_key} to {since_status_id if since_status_id is not None else since_time}")
+    else:
+        cursor, since_status_id, since_time, pages = checkpoint
+        logging.info(f"Resuming backfill of {feed_key} from page {pages + 1}")
+
+    pool = NitterPool(store, config.nitter_hosts())
+    while pages < BACKFILL_MAX_PAGES:
+        nitter_host, res = fetch_feed(pool, clients.session, config.twitter_handle, config.nitter_https, {}, REQUEST_TIMEOUT_SECONDS, cursor)
+        FEED_BYTES.inc(len(res.content), feed=feed_key)
+        with FEED_PARSE_SECONDS.time(feed=feed_key):
+            feed = feedparser.parse(res.text)
+        if feed.bozo != 0:
+            raise feed.bozo_exception
+
+        for entry in feed.entries:
+            entry['id'] = normalize_entry_id(entry.id)
+        page_entries = [entry for entry in feed.entries if status_id_of(entry.id) is not None]
+        entries = [entry for entry in page_entries if is_after_since(entry, config.twitter_handle, since_status_id, since_time)]
+        seen = get_seen_by_all(store, feed_names, [status_id_of(entry.id) for entry in entries])
+        store.stage_backfill_entries(feed_key, pages + 1, [
+            (status_id_of(entry.id), entry.id, dump_parsed_entry(parse_feed_entry(entry, config.twitter_handle, nitter_host)))
+            for entry in entries
+            if status_id_of(entry.id) not in seen
+        ])
+
+        # Pages are newest first, so a page whose own statuses are all before where to backfill to means the older pages
+        # don't have any to backfill either. Retweets are left out, as they can be retweeted long after they were posted
+        own_entries = [entry for entry in page_entries if not is_retweet(entry, config.twitter_handle)]
+        entry_ids = {entry.id for entry in entries}
+        reached_since = bool(own_entries) and not any(entry.id in entry_ids for entry in own_entries)
+        next_cursor = res.headers.get('Min-Id')
+        pages += 1
+        finished = not page_entries or reached_since or not next_cursor or next_cursor == cursor
+        store.set_backfill(feed_key, next_cursor, since_status_id, since_time, pages)
+        store.commit()
+        logging.info(f"Fetched page {pages} of the backfill of {feed_key}, {len(entries) - len(seen)} statuses to backfill")
+        if finished:
+            break
+        cursor = next_cursor
+    else:
+        logging.warning(f"Stopped paging back after {BACKFILL_MAX_PAGES} pages without reaching where to backfill to")
+
+    # Queued oldest first and ahead of the statuses that are already queued, as they are older,
+    # and together with dropping the staged entries so that they are never queued twice
+    staged = store.get_backfill_entries(feed_key)
+    now = time.time()
+    for target, feed_name in zip(targets, feed_names):
+        seen = get_seen_by_all(store, [feed_name], [status_id for status_id, _, _ in staged])
+        entries = [staged_entry for staged_entry in staged if staged_entry[0] not in seen]
+        store.enqueue_outbox(feed_name, entries, now, ahead=True)
+        STATUSES_QUEUED.inc(len(entries), feed=feed_key, target=target.name)
+        logging.info(f"Queued {len(entries)} statuses to backfill to {target.name}")
+    store.finish_backfill(feed_key)
+    store.commit()
+
+    # One delivery sends everything the rate limit of each target allows, downloading images ahead of the statuses,
+    # and the rest is left to regular runs
+    deliver_outbox(config, clients)
+    store.commit()
+    logging.info(f"Finished backfill of {feed_key}")
@@ -1,21 +1,71 @@
+import json
+import time
+import bisect
 import logging
+import functools
+import unicodedata
 import atproto
-from typing import Optional
-from atproto import Client, client_utils
+from typing import Iterator, List, Optional, Tuple
+from atproto import Client, Session, SessionEvent, client_utils
+from atproto_client.exceptions import RequestException
 from urlextract import URLExtract
+from .db import StateStore
 from .parsed_entry import ParsedEntry
+from .media import Media
+from .ratelimit import RateLimitedError, retry_at_from_headers
+from .outbox import PartiallySentError, is_transient_status
 
 
-def upload_media_to_bsky(image_file: str, logged_in_client: Client) -> Optional['atproto.models.ComAtprotoRepoUploadBlob.Data']:
-    logging.info("Uploading image to Bsky: " + image_file)
+def login_to_bsky(client: Client, store: StateStore, handle: str, password: str):
+    # createSession is heavily rate limited, so the session is saved and reused across runs.
+    # The client refreshes the access token by itself once it expires, and the refreshed session is saved again
+    def save_session(event: SessionEvent, session: Session):
+        if event in (SessionEvent.CREATE, SessionEvent.REFRESH):
+            logging.info("Saving Bsky session")
+            store.set_bsky_session(handle, session.export())
+    client.on_session_change(save_session)
+
+    session_string = store.get_bsky_session(handle)
+    if session_string:
+        try:
+            client.login(session_string=session_string)
+            return
+        except Exception as e:
+            logging.warning("Error reusing saved Bsky session, logging in again: " + str(e))
+    client.login(handle, password)
+
+
+def raise_if_rate_limited(e: Exception):
+    # The PDS sends RateLimit-* headers with 429 responses
+    response = getattr(e, 'response', None)
+    if isinstance(e, RequestException) and response is not None and response.status_code == 429:
+        raise RateLimitedError(retry_at_from_headers(response.headers or {}, time.time())) from e
+
+
+def is_transient_bsky_error(e: Exception) -> bool:
+    # Requests that the PDS rejected are not going to be accepted on retry,
+    # network errors, expired sessions and anything unexpected are worth trying again
+    response = getattr(e, 'response', None)
+    if isinstance(e, RequestException) and response is not None:
+        return is_transient_status(response.status_code)
+    return True
+
+
+def upload_media_to_bsky(image: Media, logged_in_client: Client) -> 'atproto.models.ComAtprotoRepoUploadBlob.Response':
+    logging.info(f"Uploading image to Bsky: {image}")
     try:
-        with open(image_file, 'rb') as f:
-            img_data = f.read()
-            return logged_in_client.com.atproto.repo.upload_blob(img_data)
+        return logged_in_client.com.atproto.repo.upload_blob(image.read())
     except Exception as e:
-        # TODO: handle error
-        logging.error("Error post media to bsky, aborting: " + str(e))
-        return None
+        raise_if_rate_limited(e)
+        raise
+
+def dump_bsky_blob(blob: 'atproto.models.ComAtprotoRepoUploadBlob.Response') -> str:
+    return blob.model_dump_json(by_alias=True)
+
+
+def load_bsky_blob(dumped_blob: str) -> 'atproto.models.ComAtprotoRepoUploadBlob.Response':
+    return atproto.models.ComAtprotoRepoUploadBlob.Response.model_validate_json(dumped_blob)
+
 
 UrlMaxLength = 30
 UrlOverflowPlaceholder = "..."
@@ -27,10 +77,160 @@ def truncate_url(url: str) -> str:
     return url[: UrlMaxLength - len(UrlOverflowPlaceholder)] + UrlOverflowPlaceholder
 
 
+# Bluesky counts the length of a post in graphemes, and additionally caps it in bytes
 BskyTextMaxLength = 300
+BskyTextMaxBytes = 3000
+
+
+@functools.lru_cache(maxsize=None)
+def get_url_extractor() -> URLExtract:
+    # Loading the TLD list is the expensive part, so it is done once per process.
+    # URLExtract reads the list from its cache file, or the one bundled with the package, and only
+    # goes to the network on update(), which is never called here
+    return URLExtract()
+
+
+def build_bsky_text(status_text: str) -> Tuple[str, List['atproto.models.AppBskyRichtextFacet.Main']]:
+    # Shortens the URLs in the text and builds link facets for them
+    tb = client_utils.TextBuilder()
+    extracted_urls = get_url_extractor().find_urls(status_text, get_indices=True)
+    prev_url_end = -1
+    for extracted_url in extracted_urls:
+        (url, (start, end)) = extracted_url
+        tb.text(status_text[prev_url_end + 1: start])
+        tb.link(truncate_url(url), url)
+        prev_url_end = end
+    tb.text(status_text[prev_url_end + 1:])
+    return tb.build_text(), tb.build_facets()
+
+
+def _is_regional_indicator(char: str) -> bool:
+    return 0x1F1E6 <= ord(char) <= 0x1F1FF
+
+
+def _extends_grapheme(cluster: str, char: str) -> bool:
+    # An approximation of Unicode extended grapheme clusters that covers combining marks, emoji sequences and flags,
+    # as the standard library has no grapheme segmentation
+    code = ord(char)
+    prev = cluster[-1]
+    if prev == '\r' and char == '\n':
+        return True
+    if prev == '\u200d' or char == '\u200d':
+        # Zero width joiner, e.g. within a family emoji
+        return True
+    if unicodedata.category(char) in ('Mn', 'Mc', 'Me'):
+        # Combining marks, including variation selectors
+        return True
+    if 0x1F3FB <= code <= 0x1F3FF or 0xE0020 <= code <= 0xE007F:
+        # Emoji skin tone modifiers and tags, e.g. within subdivision flags
+        return True
+    # Flags are pairs of regional indicators
+    return _is_regional_indicator(char) and _is_regional_indicator(prev) \
+        and sum(1 for c in cluster if _is_regional_indicator(c)) % 2 == 1
+
+
+def iter_graphemes(text: str) -> Iterator[str]:
+    cluster = ''
+    for char in text:
+        if cluster and not _extends_grapheme(cluster, char):
+            yield cluster
+            cluster = ''
+        cluster += char
+    if cluster:
+        yield cluster
+
+
+def split_bsky_text(
+        text: str,
+        facets: List['atproto.models.AppBskyRichtextFacet.Main'],
+        max_graphemes: int = BskyTextMaxLength,
+        max_bytes: int = BskyTextMaxBytes
+) -> List[Tuple[str, List['atproto.models.AppBskyRichtextFacet.Main']]]:
+    """
+    Splits text that is too long for one post into the texts of a thread, between words where possible
+    and never within a facet. The facets of each post are moved to its own byte offsets
+    """
+    # UTF-8 byte offset of the start of each grapheme, and of the end of the text
+    offsets = [0]
+    spaces = []
+    for grapheme in iter_graphemes(text):
+        # A cluster that doesn't fit in a post by itself, e.g. a letter with thousands of combining marks,
+        # is split between its characters
+        for piece in (grapheme,) if len(grapheme.encode('utf-8')) <= max_bytes else grapheme:
+            offsets.append(offsets[-1] + len(piece.encode('utf-8')))
+            spaces.append(piece.isspace())
+    if len(spaces) <= max_graphemes and offsets[-1] <= max_bytes:
+        return [(text, facets)]
+
+    encoded = text.encode('utf-8')
+    facets = sorted(facets, key=lambda f: f.index.byte_start)
+    facet_index = 0
+    segments = []
+    start = 0
+    count = len(spaces)
+    while start < count:
+        if spaces[start]:
+            start += 1
+            continue
+        end = min(count, start + max_graphemes)
+        while end > start + 1 and offsets[end] - offsets[start] > max_bytes:
+            end -= 1
+        if end < count:
+            # Break before the last whitespace, unless that would leave less than half a post
+            word_end = end
+            while word_end > start + (end - start) // 2 and not spaces[word_end]:
+                word_end -= 1
+            if spaces[word_end]:
+                end = word_end
+            # Move a facet that would be cut in two to the next post, unless it doesn't fit in a post by itself
+            for facet in facets[facet_index:]:
+                if facet.index.byte_start >= offsets[end]:
+                    break
+                if facet.index.byte_end > offsets[end] and facet.index.byte_start > offsets[start]:
+                    end = max(start + 1, bisect.bisect_right(offsets, facet.index.byte_start) - 1)
+                    break
+        text_end = end
+        while text_end > start and spaces[text_end - 1]:
+            text_end -= 1
+        byte_start, byte_end = offsets[start], offsets[text_end]
+
+        # Facets are in order, so each post only looks at the ones after those of the previous post
+        segment_facets = []
+        while facet_index < len(facets) and facets[facet_index].index.byte_start < offsets[end]:
+            facet = facets[facet_index]
+            facet_index += 1
+            if facet.index.byte_start >= byte_start and facet.index.byte_end <= byte_end:
+                segment_facets.append(atproto.models.AppBskyRichtextFacet.Main(
+                    features=facet.features,
+                    index=atproto.models.AppBskyRichtextFacet.ByteSlice(
+                        byte_start=facet.index.byte_start - byte_start,
+                        byte_end=facet.index.byte_end - byte_start
+                    )
+                ))
+        segments.append((encoded[byte_start:byte_end].decode('utf-8'), segment_facets))
+        start = end
+    return segments
+
+
+def dump_thread_progress(root: 'atproto.models.ComAtprotoRepoStrongRef.Main', parent: 'atproto.models.ComAtprotoRepoStrongRef.Main', next_index: int) -> str:
+    return json.dumps({
+        'root': {'uri': root.uri, 'cid': root.cid},
+        'parent': {'uri': parent.uri, 'cid': parent.cid},
+        'next': next_index,
+    })
+
+
+def load_thread_progress(progress: str) -> Tuple['atproto.models.ComAtprotoRepoStrongRef.Main', 'atproto.models.ComAtprotoRepoStrongRef.Main', int]:
+    thread = json.loads(progress)
+    return (
+        atproto.models.ComAtprotoRepoStrongRef.Main(**thread['root']),
+        atproto.models.ComAtprotoRepoStrongRef.Main(**thread['parent']),
+        thread['next']
+    )
 
 
-def post_to_bsky(parsed_entry: ParsedEntry, logged_in_client: Client):
+def post_to_bsky(parsed_entry: ParsedEntry, blobs: List['atproto.models.ComAtprotoRepoUploadBlob.Response'], logged_in_client: Client, progress: Optional[str] = None):
+    # `progress` is where a thread that was partly sent stopped, and the thread is continued from there
     def blob_to_image(blob: 'atproto.models.ComAtprotoRepoUploadBlob.Response') -> 'atproto.models.AppBskyEmbedImages.Image':
         return atproto.models.AppBskyEmbedImages.Image(
             alt='',
@@ -45,33 +245,33 @@ def post_to_bsky(parsed_entry: ParsedEntry, logged_in_client: Client):
     if parsed_entry.rt:
         status_text += f"\nRT: {parsed_entry.rt}"
 
-    tb = client_utils.TextBuilder()
-    extracted_urls = URLExtract().find_urls(status_text, get_indices=True)
-    prev_url_end = -1
-    for extracted_url in extracted_urls:
-        (url, (start, end)) = extracted_url
-        tb.text(status_text[prev_url_end + 1: start])
-        tb.link(truncate_url(url), url)
-        prev_url_end = end
-    tb.text(status_text[prev_url_end + 1:])
-
-    status_text = tb.build_text()[: BskyTextMaxLength]
-    logging.info("Sending to Bsky: " + status_text)
-    try:
-        logged_in_client.send_post(
-            text=status_text,
-            profile_identify=None,
-            reply_to=None,
-            embed=atproto.models.AppBskyEmbedImages.Main(
-                images=[blob_to_image(blob) for blob in parsed_entry.bsky_blobs]
-            ),
-            # TODO: should probably add langs??
-            langs=None,
-            # TODO: what will happen if status_text overflowed and there are facets that are cut off?
-            facets=tb.build_facets()
-        )
-        return True
-    except Exception as e:
-        # TODO: handle error
-        logging.error("Error sending to bsky, aborting: " + str(e))
-        return False
+    status_text, facets = build_bsky_text(status_text)
+    segments = split_bsky_text(status_text, facets)
+    root, parent, start = load_thread_progress(progress) if progress else (None, None, 0)
+    for index in range(start, len(segments)):
+        segment_text, segment_facets = segments[index]
+        logging.info("Sending to Bsky: " + segment_text)
+        try:
+            response = logged_in_client.send_post(
+                text=segment_text,
+                profile_identify=None,
+                reply_to=atproto.models.AppBskyFeedPost.ReplyRef(root=root, parent=parent) if root else None,
+                # Images go with the first post of a thread
+                embed=None if root else atproto.models.AppBskyEmbedImages.Main(
+                    images=[blob_to_image(blob) for blob in blobs]
+                ),
+                # TODO: should probably add langs??
+                langs=None,
+                facets=segment_facets
+            )
+        except Exception as e:
+            if root is None:
+                raise_if_rate_limited(e)
+                raise
+            # Sending the status again would post the start of the thread twice, so a retry continues from this post
+            logging.error(f"Error sending post {index + 1} of {len(segments)} of a thread to Bsky: {e}")
+            raise PartiallySentError(dump_thread_progress(root, parent, index), e) from e
+        if index + 1 < len(segments):
+            parent = atproto.models.create_strong_ref(response)
+            if root is None:
+                root = parent
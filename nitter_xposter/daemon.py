@@ -0,0 +1,92 @@
+import os
+import stat
+import time
+import random
+import signal
+import logging
+import threading
+import subprocess
+from typing import Dict, List, Optional
+from .xposter import XpostConfig, XpostClients
+from .accounts import xpost_many, deliver_many
+from .metrics import write_metrics_textfile
+
+# How often queued statuses are looked at for retries when there is no new crawl in between
+DELIVERY_INTERVAL_SECONDS = 30
+
+
+def run_post_hook(post_hook: Optional[str]):
+    # Equivalent of what main.sh does with /app/post.sh after every crawl
+    if not post_hook or not os.path.isfile(post_hook):
+        return
+    logging.info("Running post hook " + post_hook)
+    mode = os.stat(post_hook).st_mode
+    if not mode & stat.S_IXUSR:
+        os.chmod(post_hook, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    try:
+        subprocess.run([post_hook], check=True)
+    except Exception as e:
+        logging.error("Error running post hook: " + str(e))
+        return
+    logging.info("Ran post hook " + post_hook)
+
+
+def write_metrics(metrics_textfile: Optional[str]):
+    if not metrics_textfile:
+        return
+    try:
+        write_metrics_textfile(metrics_textfile)
+    except Exception as e:
+        logging.error("Error writing metrics: " + str(e))
+
+
+def next_sleep_seconds(interval_minutes: int, jitter_seconds: int, elapsed_seconds: float) -> float:
+    # Jitter spreads polls out so that many instances don't hit the same Nitter host at the same second
+    jitter = random.uniform(-jitter_seconds, jitter_seconds) if jitter_seconds > 0 else 0
+    return max(0.0, interval_minutes * 60 + jitter - elapsed_seconds)
+
+
+def run_deliverer(configs: List[XpostConfig], concurrency: int, clients: Dict[int, XpostClients], stop_event: threading.Event, wake_event: threading.Event, metrics_textfile: Optional[str] = None):
+    # Delivers queued statuses in the background so that a slow target never delays the next crawl
+    while not stop_event.is_set():
+        wake_event.clear()
+        deliver_many(configs, concurrency, clients)
+        write_metrics(metrics_textfile)
+        wake_event.wait(DELIVERY_INTERVAL_SECONDS)
+
+
+def run_daemon(configs: List[XpostConfig], interval_minutes: int, jitter_seconds: int, post_hook: Optional[str], concurrency: int = 1, stop_event: Optional[threading.Event] = None, metrics_textfile: Optional[str] = None):
+    if stop_event is None:
+        stop_event = threading.Event()
+
+        # Python running as PID 1 in the container ignores SIGTERM unless a handler is installed
+        def stop(signum, frame):
+            logging.info("Received signal %d, stopping" % signum)
+            stop_event.set()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+    logging.info(f"Started daemon, crawling every {interval_minutes} minutes with {jitter_seconds} seconds of jitter")
+    clients = {}  # type: Dict[int, XpostClients]
+    wake_event = threading.Event()
+    deliverer = threading.Thread(
+        target=run_deliverer,
+        args=(configs, concurrency, clients, stop_event, wake_event, metrics_textfile),
+        name='deliverer'
+    )
+    deliverer.start()
+    try:
+        while not stop_event.is_set():
+            started = time.monotonic()
+            failed = xpost_many(configs, concurrency, clients, deliver=False)
+            # Deliver what was just queued right away
+            wake_event.set()
+            write_metrics(metrics_textfile)
+            if failed == 0:
+                run_post_hook(post_hook)
+            stop_event.wait(next_sleep_seconds(interval_minutes, jitter_seconds, time.monotonic() - started))
+    finally:
+        stop_event.set()
+        wake_event.set()
+        deliverer.join()
+    logging.info("Stopped daemon")
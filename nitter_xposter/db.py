@@ -1,42 +1,473 @@
+import re
+import json
 import sqlite3
+import logging
+import threading
+from typing import List, Optional, Set, Tuple
 
 
-def setup_database(sqlite_file: str):
-    # Connect to SQLite Database
-    conn = sqlite3.connect(sqlite_file)
-    cursor = conn.cursor()
-
-    # Create table if it doesn't exist
+def _migrate_1(cursor: sqlite3.Cursor):
+    # Tables that used to be created on every crawl, so they may already exist
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS last_position (
         feed_name TEXT PRIMARY KEY,
         last_id TEXT
     )
     ''')
-    conn.commit()
-    conn.close()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS feed_validators (
+        feed_name TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        content_hash TEXT,
+        head_id TEXT
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS media_cache (
+        account TEXT,
+        image_url TEXT,
+        content_hash TEXT,
+        media TEXT,
+        created_at REAL,
+        expires_at REAL,
+        PRIMARY KEY (account, image_url)
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS media_cache_content_hash ON media_cache (account, content_hash)
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS bsky_session (
+        handle TEXT PRIMARY KEY,
+        session_string TEXT
+    )
+    ''')
+
+
+def _migrate_2(cursor: sqlite3.Cursor):
+    cursor.execute('''
+    CREATE TABLE rate_limit (
+        account TEXT PRIMARY KEY,
+        tokens REAL,
+        updated_at REAL,
+        blocked_until REAL
+    )
+    ''')
+
+
+def _migrate_3(cursor: sqlite3.Cursor):
+    cursor.execute('''
+    CREATE TABLE outbox (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        feed_name TEXT NOT NULL,
+        entry_id TEXT NOT NULL,
+        entry TEXT NOT NULL,
+        created_at REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL,
+        last_error TEXT,
+        failed_at REAL,
+        UNIQUE (feed_name, entry_id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX outbox_pending ON outbox (feed_name, failed_at, seq)
+    ''')
+
+
+# Frozen copies of how feeds and entries are keyed at the time of migration 4, which must not change with the code
+_LEGACY_FEED_NAME = re.compile(r'^(?:(?P<target>\w+):)?https?://[^/]+/(?P<handle>[^/]+)/rss$')
+
+
+def _normalize_feed_name(feed_name: str) -> str:
+    match = _LEGACY_FEED_NAME.match(feed_name)
+    if not match:
+        return feed_name
+    feed_key = f"nitter:{match.group('handle')}"
+    return f"{match.group('target')}:{feed_key}" if match.group('target') else feed_key
+
+
+def _normalize_entry_id(entry_id: Optional[str]) -> Optional[str]:
+    if entry_id is None:
+        return None
+    return re.sub(r'^https?://[^/]+', '', entry_id)
+
+
+def _migrate_4(cursor: sqlite3.Cursor):
+    cursor.execute('''
+    CREATE TABLE nitter_health (
+        host TEXT PRIMARY KEY,
+        latency_ewma REAL,
+        error_rate REAL,
+        last_success_at REAL,
+        last_failure_at REAL
+    )
+    ''')
+    # Feeds used to be keyed by their RSS URL and entries by their GUID, which both contain the Nitter host
+    for feed_name, last_id in cursor.execute('SELECT feed_name, last_id FROM last_position').fetchall():
+        cursor.execute(
+            'UPDATE OR REPLACE last_position SET feed_name = ?, last_id = ? WHERE feed_name = ?',
+            (_normalize_feed_name(feed_name), _normalize_entry_id(last_id), feed_name)
+        )
+    for feed_name, head_id in cursor.execute('SELECT feed_name, head_id FROM feed_validators').fetchall():
+        cursor.execute(
+            'UPDATE OR REPLACE feed_validators SET feed_name = ?, head_id = ? WHERE feed_name = ?',
+            (_normalize_feed_name(feed_name), _normalize_entry_id(head_id), feed_name)
+        )
+    for seq, feed_name, entry_id, entry in cursor.execute('SELECT seq, feed_name, entry_id, entry FROM outbox').fetchall():
+        entry = json.loads(entry)
+        entry['id'] = _normalize_entry_id(entry['id'])
+        cursor.execute(
+            'UPDATE OR IGNORE outbox SET feed_name = ?, entry_id = ?, entry = ? WHERE seq = ?',
+            (_normalize_feed_name(feed_name), _normalize_entry_id(entry_id), json.dumps(entry), seq)
+        )
+
+
+def _migrate_5(cursor: sqlite3.Cursor):
+    cursor.execute('''
+    CREATE TABLE seen (
+        feed_name TEXT NOT NULL,
+        status_id INTEGER NOT NULL,
+        seen_at REAL NOT NULL,
+        PRIMARY KEY (feed_name, status_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE INDEX seen_seen_at ON seen (seen_at)
+    ''')
+
+
+def _migrate_6(cursor: sqlite3.Cursor):
+    cursor.execute('''
+    CREATE TABLE backfill (
+        feed_name TEXT PRIMARY KEY,
+        cursor TEXT,
+        since_status_id INTEGER,
+        since_time REAL,
+        pages INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE backfill_entry (
+        feed_name TEXT NOT NULL,
+        status_id INTEGER NOT NULL,
+        entry_id TEXT NOT NULL,
+        entry TEXT NOT NULL,
+        PRIMARY KEY (feed_name, status_id)
+    ) WITHOUT ROWID
+    ''')
+
+
+# Frozen copy of how status ids are found in entry ids at the time of migration 7
+_STATUS_ID = re.compile(r'/status/(\d+)')
+
+
+def _migrate_7(cursor: sqlite3.Cursor):
+    # Queued statuses keep their status id, taken from the entry id for the ones that were already queued
+    cursor.execute('ALTER TABLE outbox ADD COLUMN status_id INTEGER')
+    for seq, entry_id in cursor.execute('SELECT seq, entry_id FROM outbox').fetchall():
+        match = _STATUS_ID.search(entry_id)
+        cursor.execute('UPDATE outbox SET status_id = ? WHERE seq = ?', (int(match.group(1)) if match else None, seq))
+    cursor.execute('DROP INDEX outbox_pending')
+    cursor.execute('''
+    CREATE INDEX outbox_pending ON outbox (feed_name, failed_at, status_id, seq)
+    ''')
+
+
+def _migrate_8(cursor: sqlite3.Cursor):
+    # Queued and staged statuses are kept in the order of the timeline rather than by status id,
+    # as retweets have the ids of the retweeted statuses
+    cursor.execute('ALTER TABLE outbox ADD COLUMN position INTEGER')
+    cursor.execute('UPDATE outbox SET position = seq')
+    cursor.execute('DROP INDEX outbox_pending')
+    cursor.execute('''
+    CREATE INDEX outbox_pending ON outbox (feed_name, failed_at, position)
+    ''')
+    cursor.execute('ALTER TABLE backfill_entry ADD COLUMN page INTEGER')
+    cursor.execute('ALTER TABLE backfill_entry ADD COLUMN position INTEGER')
+
+
+def _migrate_9(cursor: sqlite3.Cursor):
+    # What is needed to send the rest of a status that was partly sent, such as a thread
+    cursor.execute('ALTER TABLE outbox ADD COLUMN progress TEXT')
+
+
+# Migrations are run in order once when the store is opened, and the database remembers the last one that was run
+MIGRATIONS = [
+    _migrate_1,
+    _migrate_2,
+    _migrate_3,
+    _migrate_4,
+    _migrate_5,
+    _migrate_6,
+    _migrate_7,
+    _migrate_8,
+    _migrate_9,
+]
+
+
+class StateStore:
+    """
+    Holds a single connection to the SQLite file, shared by all feeds and threads of the process.
+
+    Writes are not committed right away, but collected into one transaction until commit() is called,
+    e.g. once per crawl of all feeds, so that there is one fsync per crawl instead of one per write.
+    """
+    def __init__(self, sqlite_file: str):
+        self.sqlite_file = sqlite_file
+        self._lock = threading.RLock()
+        # sqlite3 caches prepared statements per connection, so they are reused as long as the store is open
+        self._conn = sqlite3.connect(sqlite_file, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._migrate()
+
+    def _migrate(self):
+        with self._lock:
+            cursor = self._conn.cursor()
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            for index in range(version, len(MIGRATIONS)):
+                logging.info(f"Migrating database {self.sqlite_file} to version {index + 1}")
+                MIGRATIONS[index](cursor)
+                cursor.execute(f'PRAGMA user_version = {index + 1}')
+            self._conn.commit()
+
+    def _fetchone(self, sql: str, parameters: tuple) -> Optional[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, parameters).fetchone()
+
+    def _execute(self, sql: str, parameters: tuple):
+        with self._lock:
+            self._conn.execute(sql, parameters)
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def get_last_position(self, feed_name: str) -> Optional[str]:
+        # Get the last crawled position
+        last_id = self._fetchone('SELECT last_id FROM last_position WHERE feed_name = ?', (feed_name,))
+        return last_id[0] if last_id else None
+
+    def set_last_position(self, feed_name: str, new_last_id: str):
+        self._execute('REPLACE INTO last_position (feed_name, last_id) VALUES (?, ?)', (feed_name, new_last_id))
+
+    def delete_last_position(self, feed_name: str):
+        self._execute('DELETE FROM last_position WHERE feed_name = ?', (feed_name,))
+
+    def get_feed_validators(self, feed_name: str) -> Optional[tuple]:
+        # Get the validators of the last crawled response, and the newest entry in it
+        return self._fetchone(
+            'SELECT etag, last_modified, content_hash, head_id FROM feed_validators WHERE feed_name = ?',
+            (feed_name,)
+        )
+
+    def set_feed_validators(self, feed_name: str, etag: Optional[str], last_modified: Optional[str], content_hash: str, head_id: str):
+        self._execute(
+            'REPLACE INTO feed_validators (feed_name, etag, last_modified, content_hash, head_id) VALUES (?, ?, ?, ?, ?)',
+            (feed_name, etag, last_modified, content_hash, head_id)
+        )
+
+    def get_cached_media_by_url(self, account: str, image_url: str, now: float) -> Optional[str]:
+        # Get media that was uploaded from the same image URL before
+        media = self._fetchone(
+            'SELECT media FROM media_cache WHERE account = ? AND image_url = ? AND expires_at > ?',
+            (account, image_url, now)
+        )
+        return media[0] if media else None
+
+    def get_cached_media_by_content_hash(self, account: str, content_hash: str, now: float) -> Optional[str]:
+        # Get media that was uploaded from the same image content before, possibly under another URL
+        media = self._fetchone(
+            'SELECT media FROM media_cache WHERE account = ? AND content_hash = ? AND expires_at > ? ORDER BY expires_at DESC LIMIT 1',
+            (account, content_hash, now)
+        )
+        return media[0] if media else None
+
+    def set_cached_media(self, account: str, image_url: str, content_hash: str, media: str, now: float, ttl_seconds: float):
+        self._execute(
+            'REPLACE INTO media_cache (account, image_url, content_hash, media, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (account, image_url, content_hash, media, now, now + ttl_seconds)
+        )
+
+    def set_cached_media_posted(self, account: str, medias: List[str], now: float, ttl_seconds: Optional[float]):
+        # Media that cannot be reused once posted is dropped, and the rest is kept for longer
+        with self._lock:
+            for media in medias:
+                if ttl_seconds is None:
+                    self._conn.execute('DELETE FROM media_cache WHERE account = ? AND media = ?', (account, media))
+                else:
+                    self._conn.execute('UPDATE media_cache SET expires_at = ? WHERE account = ? AND media = ?', (now + ttl_seconds, account, media))
+
+    def evict_media_cache(self, now: float, max_entries: int):
+        # Drop expired media, then the oldest media over the size limit
+        with self._lock:
+            self._conn.execute('DELETE FROM media_cache WHERE expires_at <= ?', (now,))
+            self._conn.execute(
+                'DELETE FROM media_cache WHERE rowid IN (SELECT rowid FROM media_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)',
+                (max_entries,)
+            )
+
+    def get_bsky_session(self, handle: str) -> Optional[str]:
+        # Get the saved session
+        session_string = self._fetchone('SELECT session_string FROM bsky_session WHERE handle = ?', (handle,))
+        return session_string[0] if session_string else None
+
+    def set_bsky_session(self, handle: str, session_string: str):
+        # Committed right away as losing it means another rate limited login
+        with self._lock:
+            self._conn.execute('REPLACE INTO bsky_session (handle, session_string) VALUES (?, ?)', (handle, session_string))
+            self._conn.commit()
+
+    def get_rate_limit(self, account: str) -> Optional[tuple]:
+        # Get the tokens left in the bucket of an account, when they were counted, and until when the account is blocked
+        return self._fetchone('SELECT tokens, updated_at, blocked_until FROM rate_limit WHERE account = ?', (account,))
+
+    def set_rate_limit(self, account: str, tokens: float, updated_at: float, blocked_until: Optional[float]):
+        self._execute(
+            'REPLACE INTO rate_limit (account, tokens, updated_at, blocked_until) VALUES (?, ?, ?, ?)',
+            (account, tokens, updated_at, blocked_until)
+        )
+
+    def has_seen(self, feed_name: str) -> bool:
+        # Whether any status was ever seen in the feed, i.e. it is not crawled for the first time
+        return self._fetchone('SELECT 1 FROM seen WHERE feed_name = ? LIMIT 1', (feed_name,)) is not None
+
+    def get_seen(self, feed_name: str, status_ids: List[int]) -> Set[int]:
+        # Get which of the statuses were already seen in the feed
+        with self._lock:
+            return {
+                status_id for status_id, in self._conn.execute(
+                    f'SELECT status_id FROM seen WHERE feed_name = ? AND status_id IN ({", ".join("?" * len(status_ids))})',
+                    (feed_name, *status_ids)
+                )
+            }
+
+    def set_seen(self, feed_name: str, status_ids: List[int], now: float):
+        # Statuses that are seen again are kept for longer, so that ones still in the feed are never evicted
+        with self._lock:
+            self._conn.executemany(
+                'REPLACE INTO seen (feed_name, status_id, seen_at) VALUES (?, ?, ?)',
+                [(feed_name, status_id, now) for status_id in status_ids]
+            )
+
+    def evict_seen(self, feed_name: str, seen_before: float):
+        # Only evicted from a feed as it is crawled, so the statuses of a feed that is not crawled or did not change are kept
+        self._execute('DELETE FROM seen WHERE feed_name = ? AND seen_at < ?', (feed_name, seen_before))
+
+    def rename_feed(self, feed_name: str, new_feed_name: str):
+        # Moves the seen statuses and the outbox of a feed
+        with self._lock:
+            self._conn.execute('UPDATE OR IGNORE seen SET feed_name = ? WHERE feed_name = ?', (new_feed_name, feed_name))
+            self._conn.execute('UPDATE OR IGNORE outbox SET feed_name = ? WHERE feed_name = ?', (new_feed_name, feed_name))
+
+    def enqueue_outbox(self, feed_name: str, entries: List[Tuple[int, str, str]], now: float, ahead: bool = False):
+        # Queued together with marking them as seen, so that an entry is never queued twice or missed.
+        # Entries are given oldest first, and go after the entries already queued, or ahead of them if they are older,
+        # e.g. backfilled statuses
+        if ahead:
+            position = '(SELECT COALESCE(MIN(position), 0) - 1 FROM outbox WHERE feed_name = ?)'
+            entries = list(reversed(entries))
+        else:
+            position = '(SELECT COALESCE(MAX(position), 0) + 1 FROM outbox WHERE feed_name = ?)'
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO outbox (feed_name, status_id, entry_id, entry, created_at, next_attempt_at, position) '
+                f'VALUES (?, ?, ?, ?, ?, ?, {position})',
+                [(feed_name, status_id, entry_id, entry, now, now, feed_name) for status_id, entry_id, entry in entries]
+            )
+            self.set_seen(feed_name, [status_id for status_id, _, _ in entries], now)
+
+    def get_pending_outbox(self, feed_name: str) -> List[tuple]:
+        # Get the queued entries that were not given up on, oldest first
+        with self._lock:
+            return self._conn.execute(
+                'SELECT seq, entry, attempts, next_attempt_at, progress FROM outbox WHERE feed_name = ? AND failed_at IS NULL ORDER BY position',
+                (feed_name,)
+            ).fetchall()
+
+    def get_outbox_backlog(self, feed_name: str) -> Tuple[int, Optional[float]]:
+        # Get the number of queued entries that were not given up on, and when the oldest of them was queued
+        return self._fetchone(
+            'SELECT COUNT(*), MIN(created_at) FROM outbox WHERE feed_name = ? AND failed_at IS NULL',
+            (feed_name,)
+        )
+
+    def delete_outbox(self, seq: int):
+        # Committed right away like retries and failures, as a sent status that is still queued after a crash is sent again
+        with self._lock:
+            self._conn.execute('DELETE FROM outbox WHERE seq = ?', (seq,))
+            self._conn.commit()
+
+    def retry_outbox(self, seq: int, attempts: int, next_attempt_at: float, error: str, progress: Optional[str] = None):
+        # The progress of a partly sent status is kept unless there is newer progress
+        with self._lock:
+            self._conn.execute(
+                'UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ?, progress = COALESCE(?, progress) WHERE seq = ?',
+                (attempts, next_attempt_at, error, progress, seq)
+            )
+            self._conn.commit()
+
+    def fail_outbox(self, seq: int, attempts: int, error: str, now: float, progress: Optional[str] = None):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE outbox SET attempts = ?, last_error = ?, failed_at = ?, progress = COALESCE(?, progress) WHERE seq = ?',
+                (attempts, error, now, progress, seq)
+            )
+            self._conn.commit()
+
+    def evict_outbox(self, failed_before: float):
+        # Drop entries that were given up on a while ago
+        self._execute('DELETE FROM outbox WHERE failed_at < ?', (failed_before,))
 
+    def get_backfill(self, feed_name: str) -> Optional[tuple]:
+        # Get the cursor of the next page of an unfinished backfill, where it stops, and how many pages were fetched
+        return self._fetchone(
+            'SELECT cursor, since_status_id, since_time, pages FROM backfill WHERE feed_name = ?',
+            (feed_name,)
+        )
 
-def get_last_position(sqlite_file: str, feed_name: str):
-    # Connect to the database
-    conn = sqlite3.connect(sqlite_file)
-    cursor = conn.cursor()
+    def set_backfill(self, feed_name: str, cursor: Optional[str], since_status_id: Optional[int], since_time: Optional[float], pages: int):
+        self._execute(
+            'REPLACE INTO backfill (feed_name, cursor, since_status_id, since_time, pages) VALUES (?, ?, ?, ?, ?)',
+            (feed_name, cursor, since_status_id, since_time, pages)
+        )
 
-    # Get the last crawled position
-    cursor.execute('SELECT last_id FROM last_position WHERE feed_name = ?', (feed_name,))
-    last_id = cursor.fetchone()
-    last_id = last_id[0] if last_id else None
+    def stage_backfill_entries(self, feed_name: str, page: int, entries: List[Tuple[int, str, str]]):
+        # Entries are given in the order of the page, newest first
+        with self._lock:
+            self._conn.executemany(
+                'REPLACE INTO backfill_entry (feed_name, status_id, entry_id, entry, page, position) VALUES (?, ?, ?, ?, ?, ?)',
+                [(feed_name, status_id, entry_id, entry, page, position) for position, (status_id, entry_id, entry) in enumerate(entries)]
+            )
 
-    conn.close()
-    return last_id
+    def get_backfill_entries(self, feed_name: str) -> List[Tuple[int, str, str]]:
+        # Get the staged entries, oldest first
+        with self._lock:
+            return self._conn.execute(
+                'SELECT status_id, entry_id, entry FROM backfill_entry WHERE feed_name = ? ORDER BY page DESC, position DESC, status_id',
+                (feed_name,)
+            ).fetchall()
 
+    def finish_backfill(self, feed_name: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM backfill_entry WHERE feed_name = ?', (feed_name,))
+            self._conn.execute('DELETE FROM backfill WHERE feed_name = ?', (feed_name,))
 
-def set_last_position(sqlite_file: str, feed_name: str, new_last_id: str):
-    # Connect to SQLite Database
-    conn = sqlite3.connect(sqlite_file)
-    cursor = conn.cursor()
+    def get_nitter_health(self, host: str) -> Optional[tuple]:
+        return self._fetchone(
+            'SELECT latency_ewma, error_rate, last_success_at, last_failure_at FROM nitter_health WHERE host = ?',
+            (host,)
+        )
 
-    cursor.execute('REPLACE INTO last_position (feed_name, last_id) VALUES (?, ?)', (feed_name, new_last_id))
-    
-    conn.commit()
-    conn.close()
+    def set_nitter_health(self, host: str, latency_ewma: Optional[float], error_rate: float, last_success_at: Optional[float], last_failure_at: Optional[float]):
+        self._execute(
+            'REPLACE INTO nitter_health (host, latency_ewma, error_rate, last_success_at, last_failure_at) VALUES (?, ?, ?, ?, ?)',
+            (host, latency_ewma, error_rate, last_success_at, last_failure_at)
+        )
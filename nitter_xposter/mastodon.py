@@ -1,24 +1,67 @@
+import time
 import logging
-from mastodon import Mastodon
-from typing import Optional
+from mastodon import Mastodon, MastodonAPIError, MastodonRatelimitError
+from typing import List, Optional
 from .parsed_entry import ParsedEntry
+from .media import Media
+from .ratelimit import RateLimitedError
+from .outbox import is_transient_status
 
 
-def upload_media_to_mastodon(image_file: str, mastodon: Mastodon) -> Optional[str]:
-    logging.info("Uploading image to Mastodon: " + image_file)
+# Large images and videos are processed by Mastodon after they are uploaded, and are polled until they are ready
+MEDIA_PROCESSING_POLL_SECONDS = 1
+MEDIA_PROCESSING_MAX_POLL_SECONDS = 8
+MEDIA_PROCESSING_TIMEOUT_SECONDS = 120
+
+
+def mastodon_retry_at(mastodon: Mastodon) -> Optional[float]:
+    # Mastodon.py keeps the reset time from the X-RateLimit-Reset header of the last response
+    reset = getattr(mastodon, 'ratelimit_reset', None)
+    return float(reset) if isinstance(reset, (int, float)) else None
+
+
+def is_transient_mastodon_error(e: Exception) -> bool:
+    # Mastodon.py raises MastodonAPIError(message, status code, reason, error) for error responses,
+    # network errors and anything unexpected are worth trying again
+    if isinstance(e, MastodonAPIError) and len(e.args) > 1 and isinstance(e.args[1], int):
+        return is_transient_status(e.args[1])
+    return True
+
+
+def upload_media_to_mastodon(image: Media, mastodon: Mastodon) -> str:
+    logging.info(f"Uploading image to Mastodon: {image}")
     try:
-        media = mastodon.media_post(image_file)
-    except Exception as e:
-        # TODO: handle error
-        logging.error("Error post media to Mastodon, aborting: " + str(e))
-        return None
+        with image.open() as f:
+            media = mastodon.media_post(f, mime_type=image.mime_type)
+    except MastodonRatelimitError as e:
+        raise RateLimitedError(mastodon_retry_at(mastodon)) from e
     if 'id' not in media:
-        logging.error("Weird, id not found in media uploaded to Mastodon, aborting: " + image_file)
-        return None
+        raise Exception(f"Weird, id not found in media uploaded to Mastodon: {image}")
+    # Its URL is only set once Mastodon is done processing it, and statuses with media that is still processing are rejected
+    if not media.get('url'):
+        wait_for_mastodon_media(media['id'], mastodon)
     return media['id']
 
 
-def post_to_mastodon(parsed_entry: ParsedEntry, mastodon: Mastodon) -> bool:
+def wait_for_mastodon_media(media_id: str, mastodon: Mastodon):
+    # Uploads run concurrently, so the waits of the images of several statuses overlap
+    deadline = time.monotonic() + MEDIA_PROCESSING_TIMEOUT_SECONDS
+    delay = MEDIA_PROCESSING_POLL_SECONDS
+    while True:
+        try:
+            media = mastodon.media(media_id)
+        except MastodonRatelimitError as e:
+            raise RateLimitedError(mastodon_retry_at(mastodon)) from e
+        if media.get('url'):
+            return
+        if time.monotonic() + delay > deadline:
+            raise Exception(f"Mastodon is still processing media {media_id} after {MEDIA_PROCESSING_TIMEOUT_SECONDS} seconds")
+        logging.info(f"Waiting for Mastodon to process media {media_id}")
+        time.sleep(delay)
+        delay = min(delay * 2, MEDIA_PROCESSING_MAX_POLL_SECONDS)
+
+
+def post_to_mastodon(parsed_entry: ParsedEntry, media_ids: List[str], mastodon: Mastodon):
     status_text = ''
 
     if parsed_entry.text:
@@ -29,9 +72,6 @@ def post_to_mastodon(parsed_entry: ParsedEntry, mastodon: Mastodon) -> bool:
 
     logging.info("Sending to Mastodon: " + status_text)
     try:
-        mastodon.status_post(status=status_text, media_ids=parsed_entry.mastodon_media_ids)
-        return True
-    except Exception as e:
-        # TODO: handle error
-        logging.error("Error sending to Mastodon, aborting: " + str(e))
-        return False
+        mastodon.status_post(status=status_text, media_ids=media_ids)
+    except MastodonRatelimitError as e:
+        raise RateLimitedError(mastodon_retry_at(mastodon)) from e
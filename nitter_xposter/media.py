@@ -0,0 +1,154 @@
+import io
+import os
+import hashlib
+import logging
+import tempfile
+import mimetypes
+import requests
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, BinaryIO, Optional
+from .outbox import is_transient_status
+
+if TYPE_CHECKING:
+    # httpx is only used by the async engine
+    import httpx
+
+DEFAULT_MIME_TYPE = 'image/jpeg'
+DEFAULT_SPILL_BYTES = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+
+@dataclass
+class Media:
+    """
+    An image downloaded from Nitter, kept in memory unless it was too large and spilled to a tmp file
+    """
+    url: str
+    mime_type: str
+    size: int
+    data: Optional[bytes] = None
+    file: Optional[str] = None
+
+    def read(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        with open(self.file, 'rb') as f:
+            return f.read()
+
+    def content_hash(self) -> str:
+        return hashlib.sha256(self.read()).hexdigest()
+
+    def open(self) -> BinaryIO:
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.file, 'rb')
+
+    def __str__(self):
+        return f"{self.url} ({self.mime_type}, {self.size} bytes{', spilled to ' + self.file if self.file else ''})"
+
+
+def mime_type_of(res, url: str) -> str:
+    # res is either a requests or an httpx response
+    content_type = res.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type.startswith('image/') or content_type.startswith('video/'):
+        return content_type
+    guessed_type, _ = mimetypes.guess_type(url)
+    return guessed_type or DEFAULT_MIME_TYPE
+
+
+class DownloadError(Exception):
+    """
+    Raised when an image could not be downloaded from Nitter, `transient` tells whether it is worth trying again
+    """
+    def __init__(self, message: str, transient: bool):
+        super().__init__(message)
+        self.transient = transient
+
+
+class SpillBuffer:
+    """
+    Keeps a download in memory, and only writes it to a tmp file once it gets larger than spill_bytes
+    """
+    def __init__(self, url: str, mime_type: str, spill_bytes: int):
+        self.url = url
+        self.mime_type = mime_type
+        self.spill_bytes = spill_bytes
+        self.size = 0
+        self._buffer = io.BytesIO()
+        self._spilled = None
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self._spilled is None and self.size > self.spill_bytes:
+            self._spilled = tempfile.NamedTemporaryFile(suffix=mimetypes.guess_extension(self.mime_type) or '', delete=False)
+            self._spilled.write(self._buffer.getvalue())
+            self._buffer = None
+        if self._spilled is None:
+            self._buffer.write(chunk)
+        else:
+            self._spilled.write(chunk)
+
+    def discard(self):
+        if self._spilled is not None:
+            self._spilled.close()
+            os.remove(self._spilled.name)
+
+    def to_media(self) -> Media:
+        if self._spilled is None:
+            return Media(url=self.url, mime_type=self.mime_type, size=self.size, data=self._buffer.getvalue())
+        self._spilled.close()
+        return Media(url=self.url, mime_type=self.mime_type, size=self.size, file=self._spilled.name)
+
+
+def download_image(url: str, session: requests.Session, spill_bytes: int, timeout: float) -> Media:
+    logging.info("Downloading image from nitter: " + url)
+    try:
+        return _download_image(url, session, spill_bytes, timeout)
+    except requests.RequestException as e:
+        raise DownloadError(f"Error downloading image from nitter: {url}: {e}", transient=True) from e
+
+
+def _download_image(url: str, session: requests.Session, spill_bytes: int, timeout: float) -> Media:
+    with session.get(url, timeout=timeout, stream=True) as res:
+        raise_for_download_status(res.status_code, url)
+        buffer = SpillBuffer(url, mime_type_of(res, url), spill_bytes)
+        try:
+            for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                buffer.write(chunk)
+        except Exception:
+            buffer.discard()
+            raise
+    return buffer.to_media()
+
+
+async def download_image_async(url: str, client: 'httpx.AsyncClient', spill_bytes: int, timeout: float) -> Media:
+    # Same as download_image, with an httpx client on an event loop
+    import httpx
+    logging.info("Downloading image from nitter: " + url)
+    try:
+        async with client.stream('GET', url, timeout=timeout) as res:
+            raise_for_download_status(res.status_code, url)
+            buffer = SpillBuffer(url, mime_type_of(res, url), spill_bytes)
+            try:
+                async for chunk in res.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                    buffer.write(chunk)
+            except Exception:
+                buffer.discard()
+                raise
+    except httpx.HTTPError as e:
+        raise DownloadError(f"Error downloading image from nitter: {url}: {e}", transient=True) from e
+    return buffer.to_media()
+
+
+def raise_for_download_status(status_code: int, url: str):
+    if status_code >= 400:
+        raise DownloadError(
+            f"Image downloading encountered with {status_code} status code: {url}",
+            transient=is_transient_status(status_code)
+        )
+
+
+def cleanup_media(media: Media):
+    if media.file:
+        logging.info(f"Cleaning up tmp file {media.file}")
+        os.remove(media.file)
@@ -0,0 +1,171 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    """
+    A metric with one value per combination of label values, rendered in the Prometheus text format
+    """
+    type = ''
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str]):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}  # type: Dict[Tuple[str, ...], object]
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.label_names)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def _samples(self, key: Tuple[str, ...], value) -> Iterator[str]:
+        yield f"{self.name}{self._format_labels(key)} {float(value)}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str], buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            # Counts per bucket, then the sum and the count of all observations
+            counts = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        # Observes how long the block took, unless it raised
+        started = time.monotonic()
+        yield
+        self.observe(time.monotonic() - started, **labels)
+
+    def totals(self) -> Tuple[float, int]:
+        # Sum and count of the observations across all label values
+        with self._lock:
+            return sum(value[-2] for value in self._values.values()), sum(value[-1] for value in self._values.values())
+
+    def _samples(self, key: Tuple[str, ...], value) -> Iterator[str]:
+        for bound, count in zip(self.buckets, value):
+            yield f"{self.name}_bucket{self._format_labels(key, (('le', str(float(bound))),))} {float(count)}"
+        yield f"{self.name}_bucket{self._format_labels(key, (('le', '+Inf'),))} {float(value[-1])}"
+        yield f"{self.name}_sum{self._format_labels(key)} {float(value[-2])}"
+        yield f"{self.name}_count{self._format_labels(key)} {float(value[-1])}"
+
+
+REGISTRY = []  # type: List[Metric]
+
+# `feed` is the feed key (nitter:<handle>) and `target` the target name (mastodon, bsky)
+FEED_FETCH_SECONDS = Histogram('nitter_xposter_feed_fetch_seconds', 'Time to fetch a feed from a Nitter host.', ['host'])
+FEED_FETCH_FAILURES = Counter('nitter_xposter_feed_fetch_failures_total', 'Failed or rejected feed requests to a Nitter host.', ['host'])
+FEED_BYTES = Counter('nitter_xposter_feed_bytes_total', 'Bytes of feeds fetched.', ['feed'])
+FEED_PARSE_SECONDS = Histogram('nitter_xposter_feed_parse_seconds', 'Time to parse a feed.', ['feed'])
+IMAGE_DOWNLOAD_SECONDS = Histogram('nitter_xposter_image_download_seconds', 'Time to download an image.', ['host'])
+MEDIA_TRANSCODE_SECONDS = Histogram('nitter_xposter_media_transcode_seconds', 'Time to fit an image to the limits of a target.', ['feed', 'target'])
+MEDIA_UPLOAD_SECONDS = Histogram('nitter_xposter_media_upload_seconds', 'Time to upload an image to a target.', ['feed', 'target'])
+POST_SECONDS = Histogram('nitter_xposter_post_seconds', 'Time to send a status to a target.', ['feed', 'target'])
+STATUSES_QUEUED = Counter('nitter_xposter_statuses_queued_total', 'Statuses queued to be sent.', ['feed', 'target'])
+STATUSES_SENT = Counter('nitter_xposter_statuses_sent_total', 'Statuses sent.', ['feed', 'target'])
+# `kind` is one of fetch, rate_limited, transient or permanent
+FAILURES = Counter('nitter_xposter_failures_total', 'Failures by kind.', ['feed', 'target', 'kind'])
+OUTBOX_SIZE = Gauge('nitter_xposter_outbox_size', 'Statuses waiting to be sent.', ['feed', 'target'])
+OUTBOX_LAG_SECONDS = Gauge('nitter_xposter_outbox_lag_seconds', 'Age of the oldest status waiting to be sent.', ['feed', 'target'])
+
+
+def render_metrics() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+def write_metrics_textfile(path: str):
+    # Written to a tmp file first so that a collector such as node_exporter never reads half a file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(render_metrics())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise flood the log
+        pass
+
+
+def serve_metrics(port: int, host: str = '') -> ThreadingHTTPServer:
+    # Serves /metrics from a background thread until shutdown() is called on the returned server
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f"Serving metrics on port {server.server_address[1]}")
+    return server
@@ -0,0 +1,197 @@
+import time
+import logging
+import threading
+import requests
+from urllib.parse import quote
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+from .db import StateStore
+from .metrics import FEED_FETCH_SECONDS, FEED_FETCH_FAILURES
+
+if TYPE_CHECKING:
+    # asyncio and httpx are only used by the async engine
+    import asyncio
+    import httpx
+
+# Weight of the newest sample in the latency and error rate averages
+HEALTH_EWMA_ALPHA = 0.3
+# A host whose error rate is at least this is only tried after healthy hosts, until it has not failed for the cooldown
+UNHEALTHY_ERROR_RATE = 0.5
+UNHEALTHY_COOLDOWN_SECONDS = 10 * 60
+# A second host is asked for the feed if the first one has not answered after this many times its usual latency
+HEDGE_LATENCY_FACTOR = 3
+MIN_HEDGE_DELAY_SECONDS = 2
+
+
+@dataclass
+class HostHealth:
+    latency_ewma: Optional[float]
+    error_rate: float
+    last_success_at: Optional[float]
+    last_failure_at: Optional[float]
+
+
+class NitterFetchError(Exception):
+    pass
+
+
+class NitterPool:
+    """
+    Picks which of the configured Nitter hosts to fetch a feed from, based on their health kept in the store
+    """
+    def __init__(self, store: StateStore, hosts: List[str]):
+        self.store = store
+        self.hosts = hosts
+        self._lock = threading.Lock()
+        self._health = {}  # type: Dict[str, HostHealth]
+        for host in hosts:
+            health = store.get_nitter_health(host)
+            if health is not None:
+                self._health[host] = HostHealth(*health)
+
+    def _is_healthy(self, host: str, now: float) -> bool:
+        health = self._health.get(host)
+        return health is None \
+            or health.error_rate < UNHEALTHY_ERROR_RATE \
+            or now - (health.last_failure_at or 0) >= UNHEALTHY_COOLDOWN_SECONDS
+
+    def _latency(self, host: str) -> float:
+        health = self._health.get(host)
+        return health.latency_ewma if health and health.latency_ewma is not None else 0.0
+
+    def ranked(self, now: Optional[float] = None) -> List[str]:
+        # Healthy hosts first, fastest first. Hosts without a latency yet are tried first so that they get one,
+        # and ties keep the configured order
+        now = time.time() if now is None else now
+        with self._lock:
+            return sorted(self.hosts, key=lambda host: (not self._is_healthy(host, now), self._latency(host)))
+
+    def hedge_delay(self, host: str) -> float:
+        with self._lock:
+            return max(MIN_HEDGE_DELAY_SECONDS, HEDGE_LATENCY_FACTOR * self._latency(host))
+
+    def record(self, host: str, latency: Optional[float], now: Optional[float] = None):
+        # `latency` is None if the request failed
+        now = time.time() if now is None else now
+        failed = latency is None
+        if failed:
+            FEED_FETCH_FAILURES.inc(host=host)
+        else:
+            FEED_FETCH_SECONDS.observe(latency, host=host)
+        with self._lock:
+            health = self._health.get(host)
+            if health is None:
+                health = HostHealth(latency, 1.0 if failed else 0.0, None, None)
+            else:
+                if not failed:
+                    health.latency_ewma = latency if health.latency_ewma is None \
+                        else HEALTH_EWMA_ALPHA * latency + (1 - HEALTH_EWMA_ALPHA) * health.latency_ewma
+                health.error_rate = HEALTH_EWMA_ALPHA * (1.0 if failed else 0.0) + (1 - HEALTH_EWMA_ALPHA) * health.error_rate
+            if failed:
+                health.last_failure_at = now
+            else:
+                health.last_success_at = now
+            self._health[host] = health
+            self.store.set_nitter_health(host, health.latency_ewma, health.error_rate, health.last_success_at, health.last_failure_at)
+
+
+def feed_url(host: str, twitter_handle: str, https: bool, cursor: Optional[str] = None) -> str:
+    # Older pages of the feed are fetched with the cursor that Nitter sends in the Min-Id header of the previous page
+    url = f"{'https' if https else 'http'}://{host}/{twitter_handle}/rss"
+    return f"{url}?cursor={quote(cursor, safe='')}" if cursor else url
+
+
+def fetch_feed(pool: NitterPool, session: requests.Session, twitter_handle: str, https: bool, headers: Dict[str, str], timeout: float, cursor: Optional[str] = None) -> Tuple[str, requests.Response]:
+    """
+    Fetches the feed from the best host, asking the next host as well if it is slow (a hedged request), or if it fails.
+    Returns the host that answered first, and raises if no host could be reached
+    """
+    def get(host: str) -> requests.Response:
+        started = time.monotonic()
+        try:
+            res = session.get(feed_url(host, twitter_handle, https, cursor), headers=headers, timeout=timeout)
+        except Exception:
+            pool.record(host, None)
+            raise
+        if res.status_code >= 400:
+            pool.record(host, None)
+            raise NitterFetchError(f"{host} answered with {res.status_code} status code")
+        pool.record(host, time.monotonic() - started)
+        return res
+
+    remaining = pool.ranked()
+    # Requests that lost the race are left to finish in the background so that their host's health is still recorded
+    executor = ThreadPoolExecutor(max_workers=len(remaining), thread_name_prefix='nitter')
+    pending = {}
+    last_error = None  # type: Optional[Exception]
+    try:
+        while remaining or pending:
+            if not pending:
+                host = remaining.pop(0)
+                pending[executor.submit(get, host)] = host
+            hedge_host = next(iter(pending.values())) if remaining and len(pending) == 1 else None
+            done, _ = wait(pending, timeout=pool.hedge_delay(hedge_host) if hedge_host else None, return_when=FIRST_COMPLETED)
+            if not done:
+                host = remaining.pop(0)
+                logging.info(f"{hedge_host} is slow, also fetching the feed from {host}")
+                pending[executor.submit(get, host)] = host
+                continue
+            for future in done:
+                host = pending.pop(future)
+                try:
+                    return host, future.result()
+                except Exception as e:
+                    logging.warning(f"Error fetching the feed from {host}: {e}")
+                    last_error = e
+    finally:
+        executor.shutdown(wait=False)
+    raise NitterFetchError(f"Could not fetch the feed from any Nitter host: {last_error}")
+
+
+async def fetch_feed_async(pool: NitterPool, http: 'httpx.AsyncClient', limiter: Callable[[str], 'asyncio.Semaphore'], twitter_handle: str, https: bool, headers: Dict[str, str], timeout: float) -> Tuple[str, 'httpx.Response']:
+    # Same as fetch_feed, on the event loop
+    import asyncio
+    import httpx
+
+    async def get(host: str) -> 'httpx.Response':
+        url = feed_url(host, twitter_handle, https)
+        async with limiter(url):
+            started = time.monotonic()
+            try:
+                res = await http.get(url, headers=headers, timeout=timeout)
+            except httpx.HTTPError:
+                pool.record(host, None)
+                raise
+            if res.status_code >= 400:
+                pool.record(host, None)
+                raise NitterFetchError(f"{host} answered with {res.status_code} status code")
+            pool.record(host, time.monotonic() - started)
+            return res
+
+    remaining = pool.ranked()
+    pending = {}  # type: Dict[asyncio.Task, str]
+    last_error = None  # type: Optional[Exception]
+    try:
+        while remaining or pending:
+            if not pending:
+                host = remaining.pop(0)
+                pending[asyncio.ensure_future(get(host))] = host
+            hedge_host = next(iter(pending.values())) if remaining and len(pending) == 1 else None
+            done, _ = await asyncio.wait(pending, timeout=pool.hedge_delay(hedge_host) if hedge_host else None, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                host = remaining.pop(0)
+                logging.info(f"{hedge_host} is slow, also fetching the feed from {host}")
+                pending[asyncio.ensure_future(get(host))] = host
+                continue
+            for task in done:
+                host = pending.pop(task)
+                try:
+                    return host, task.result()
+                except Exception as e:
+                    logging.warning(f"Error fetching the feed from {host}: {e}")
+                    last_error = e
+    finally:
+        for task in pending:
+            task.cancel()
+    raise NitterFetchError(f"Could not fetch the feed from any Nitter host: {last_error}")
@@ -0,0 +1,50 @@
+import json
+import random
+from .parsed_entry import ParsedEntry
+
+# The delay before retrying a status doubles with every attempt from the base up to the cap,
+# and a status is given up on after the last attempt
+DEFAULT_RETRY_BASE_SECONDS = 30
+RETRY_CAP_SECONDS = 6 * 60 * 60
+MAX_DELIVERY_ATTEMPTS = 10
+# Statuses that were given up on are kept in the outbox for this long so that they can be looked into
+FAILED_RETENTION_SECONDS = 30 * 24 * 60 * 60
+
+# Status codes of errors that may go away by themselves, any other 4xx means the request itself was rejected
+TRANSIENT_STATUS_CODES = {401, 403, 408, 429}
+
+
+class PartiallySentError(Exception):
+    """
+    Raised by posts that are sent in several parts, such as threads, when a part after the first could not be sent.
+    `progress` is what the post needs to send the remaining parts when the status is retried
+    """
+    def __init__(self, progress: str, cause: Exception):
+        super().__init__(f"Sent part of the status: {cause}")
+        self.progress = progress
+        self.cause = cause
+
+
+def is_transient_status(status_code: int) -> bool:
+    return status_code >= 500 or status_code in TRANSIENT_STATUS_CODES
+
+
+def backoff_seconds(attempts: int, base_seconds: float) -> float:
+    # Half of the delay is random so that statuses that failed together are not retried together
+    delay = min(RETRY_CAP_SECONDS, base_seconds * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def dump_parsed_entry(parsed_entry: ParsedEntry) -> str:
+    # Uploaded media is not queued, it is taken from the media cache or uploaded again when the status is sent
+    return json.dumps({
+        'id': parsed_entry.id,
+        'text': parsed_entry.text,
+        'rt': parsed_entry.rt,
+        'image_urls': list(parsed_entry.image_urls),
+    })
+
+
+def load_parsed_entry(dumped_entry: str) -> ParsedEntry:
+    entry = json.loads(dumped_entry)
+    return ParsedEntry(entry['id'], entry['text'], entry['rt'], tuple(entry['image_urls']))
@@ -1,14 +1,14 @@
-import atproto
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, Tuple
 
 
-@dataclass
+@dataclass(slots=True)
 class ParsedEntry:
+    """
+    What is needed to post a feed entry to any target. Many of these are alive at once with many feeds or a large outbox,
+    so it has slots instead of a __dict__, and media uploaded for a target is kept apart from it
+    """
     id: str
     text: Optional[str]
     rt: Optional[str]
-    image_urls: List[str]
-    image_files: List[str]
-    mastodon_media_ids: List[str]
-    bsky_blobs: List["atproto.models.ComAtprotoRepoUploadBlob.Response"]
+    image_urls: Tuple[str, ...]
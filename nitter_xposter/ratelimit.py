@@ -0,0 +1,100 @@
+import time
+import logging
+import threading
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+from .db import StateStore
+
+
+@dataclass
+class RateLimit:
+    """
+    A token bucket that holds up to `burst` statuses and refills at `per_second` statuses per second
+    """
+    burst: float
+    per_second: float
+
+
+# Mastodon allows 300 statuses per account every 3 hours.
+# Its limit of 300 API calls per 5 minutes is reported in response headers and handled through RateLimitedError
+MASTODON_STATUS_RATE_LIMIT = RateLimit(burst=300, per_second=300 / (3 * 60 * 60))
+# Bluesky allows 5000 points per hour and 35000 points per day per account, and creating a record costs 3 points
+BSKY_STATUS_RATE_LIMIT = RateLimit(burst=5000 / 3, per_second=35000 / 3 / (24 * 60 * 60))
+
+
+class RateLimitedError(Exception):
+    """
+    Raised by uploads and posts when the target rejected a request because of its rate limit
+    """
+    def __init__(self, retry_at: Optional[float]):
+        super().__init__(f"Rate limited until {retry_at}")
+        self.retry_at = retry_at
+
+
+def retry_at_from_headers(headers: Mapping[str, str], now: float) -> Optional[float]:
+    # Retry-After is either a number of seconds or an HTTP date, and RateLimit-Reset is a Unix timestamp
+    headers = {k.lower(): v for k, v in headers.items()}
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return now + float(retry_after)
+        except ValueError:
+            pass
+        try:
+            return parsedate_to_datetime(retry_after).timestamp()
+        except (TypeError, ValueError):
+            pass
+    for header in ('ratelimit-reset', 'x-ratelimit-reset'):
+        try:
+            return float(headers[header])
+        except (KeyError, ValueError):
+            pass
+    return None
+
+
+# Guards reading and writing back a bucket, as several feeds can post to the same account at once
+_bucket_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Paces the statuses sent to one account, persisted in the store so that the budget carries over across runs
+    """
+    def __init__(self, store: StateStore, account: str, rate_limit: RateLimit):
+        self.store = store
+        self.account = account
+        self.rate_limit = rate_limit
+
+    def acquire(self, now: Optional[float] = None) -> bool:
+        # Takes a token if one is available
+        now = time.time() if now is None else now
+        with _bucket_lock:
+            tokens, updated_at, blocked_until = self.store.get_rate_limit(self.account) or (self.rate_limit.burst, now, None)
+            if blocked_until is not None and now < blocked_until:
+                return False
+            tokens = min(self.rate_limit.burst, tokens + max(0.0, now - updated_at) * self.rate_limit.per_second)
+            if tokens < 1:
+                self.store.set_rate_limit(self.account, tokens, now, None)
+                return False
+            self.store.set_rate_limit(self.account, tokens - 1, now, None)
+            return True
+
+    def available(self, now: Optional[float] = None) -> int:
+        # How many tokens could be taken right now, without taking any
+        now = time.time() if now is None else now
+        with _bucket_lock:
+            tokens, updated_at, blocked_until = self.store.get_rate_limit(self.account) or (self.rate_limit.burst, now, None)
+            if blocked_until is not None and now < blocked_until:
+                return 0
+            return int(min(self.rate_limit.burst, tokens + max(0.0, now - updated_at) * self.rate_limit.per_second))
+
+    def block_until(self, retry_at: Optional[float], now: Optional[float] = None):
+        # Called when the target itself says it is rate limited, usually by a shorter window than the bucket's
+        now = time.time() if now is None else now
+        if retry_at is None:
+            retry_at = now + 1 / self.rate_limit.per_second
+        logging.warning(f"Rate limited on {self.account} for {max(0.0, retry_at - now):.0f} seconds")
+        with _bucket_lock:
+            tokens, updated_at, _ = self.store.get_rate_limit(self.account) or (self.rate_limit.burst, now, None)
+            self.store.set_rate_limit(self.account, tokens, updated_at, retry_at)
@@ -2,15 +2,49 @@ import unittest
 import uuid
 import os
 import glob
+import requests
 import responses
+import feedparser
+from responses import matchers
 import time
 import copy
+import sqlite3
+import threading
+import dataclasses
+import json
+import hashlib
+import io
 import atproto
+from atproto import Session, SessionEvent
+from atproto_client.models.blob_ref import BlobRef
 from dataclasses import dataclass
-from unittest.mock import patch, call
+from unittest.mock import patch, call, ANY, MagicMock
 from datetime import datetime, timezone
 from typing import List
-from .xposter import xpost, XpostConfig
+from .xposter import xpost, create_clients, build_targets, parse_description, parse_feed_entry, XpostConfig
+from .media import Media, DownloadError, download_image
+from .db import StateStore, MIGRATIONS
+from .nitter_pool import NitterPool, NitterFetchError
+from .daemon import run_daemon
+from .accounts import parse_accounts_config, xpost_many
+from .bsky import build_bsky_text, get_url_extractor, split_bsky_text, iter_graphemes, post_to_bsky
+from .parsed_entry import ParsedEntry
+from .backfill import backfill, parse_backfill_since, status_time
+from .ratelimit import RateLimit, TokenBucket, retry_at_from_headers
+from mastodon import MastodonAPIError, MastodonRatelimitError, MastodonServiceUnavailableError
+from .outbox import backoff_seconds, RETRY_CAP_SECONDS
+from .aio import xpost_many_async
+from .transcode import MediaLimits, fit_media, BSKY_MEDIA_LIMITS
+from PIL import Image
+from .metrics import Counter, Histogram, render_metrics, serve_metrics, write_metrics_textfile, REGISTRY, STATUSES_SENT, POST_SECONDS
+import urllib.request
+import asyncio
+import httpx
+
+
+# Mastodon accounts go by a hash of their access token
+MASTODON_ACCOUNT = 'mastodon:mastodon.example.com:' + hashlib.sha256(b'access_token').hexdigest()[:16]
+ANOTHER_MASTODON_ACCOUNT = 'mastodon:mastodon.example.com:' + hashlib.sha256(b'another_access_token').hexdigest()[:16]
 
 
 @dataclass
@@ -79,7 +113,7 @@ class XposterTestCase(unittest.TestCase):
             body=body
         )
 
-    @patch('nitter_xposter.xposter.Mastodon')
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_fail_to_parse(self, mock_Mastodon):
         self._add_response('<?xml version="1.0')
@@ -89,7 +123,7 @@ class XposterTestCase(unittest.TestCase):
             xpost(self.xpost_config)
         mock_mastodon.status_post.assert_not_called()
 
-    @patch('nitter_xposter.xposter.Mastodon')
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_first_time_no_status(self, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
@@ -98,7 +132,7 @@ class XposterTestCase(unittest.TestCase):
         xpost(self.xpost_config)
         mock_mastodon.status_post.assert_not_called()
 
-    @patch('nitter_xposter.xposter.Mastodon')
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_no_new_status(self, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
@@ -113,7 +147,7 @@ class XposterTestCase(unittest.TestCase):
         xpost(self.xpost_config)
         mock_mastodon.status_post.assert_not_called()
     
-    @patch('nitter_xposter.xposter.Mastodon')
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_one_new_status(self, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
@@ -131,7 +165,7 @@ class XposterTestCase(unittest.TestCase):
         xpost(self.xpost_config)
         mock_mastodon.status_post.assert_called_once_with(status="test 2", media_ids=[])
 
-    @patch('nitter_xposter.xposter.Mastodon')
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_no_last_position_found(self, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
@@ -140,6 +174,7 @@ class XposterTestCase(unittest.TestCase):
         xpost(self.xpost_config)
         mock_mastodon.status_post.assert_not_called()
 
+        # Statuses that were not seen are new even if the last seen one dropped out of the feed
         time.sleep(1)
         self._add_response(_response_with_items([
             TestItem("<p>test 6</p>", 6),
@@ -147,9 +182,203 @@ class XposterTestCase(unittest.TestCase):
         ]))
         
         xpost(self.xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 5", media_ids=[]),
+            call(status="test 6", media_ids=[]),
+        ])
+
+        # and statuses that were seen are not posted again when they come back, e.g. when pinned
+        time.sleep(1)
+        mock_mastodon.status_post.reset_mock()
+        self._add_response(_response_with_items([
+            TestItem("<p>test</p>", 1),
+            TestItem("<p>test 7</p>", 7),
+            TestItem("<p>test 6</p>", 6),
+        ]))
+
+        xpost(self.xpost_config)
+        mock_mastodon.status_post.assert_called_once_with(status="test 7", media_ids=[])
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_metrics(self, mock_Mastodon):
+        self._add_response(_response("<p>test 1</p>"))
+        xpost(self.xpost_config)
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 2</p>", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        labels = {'feed': 'nitter:twitter_handle', 'target': 'mastodon'}
+        sent = STATUSES_SENT._values.get(('nitter:twitter_handle', 'mastodon'), 0)
+        xpost(self.xpost_config)
+        self.assertEqual(STATUSES_SENT._values[('nitter:twitter_handle', 'mastodon')], sent + 1)
+
+        rendered = render_metrics()
+        self.assertIn('# TYPE nitter_xposter_post_seconds histogram', rendered)
+        self.assertIn('nitter_xposter_outbox_size{feed="nitter:twitter_handle",target="mastodon"} 0.0', rendered)
+        self.assertRegex(rendered, r'nitter_xposter_feed_fetch_seconds_count\{host="nitter.example.com"\} \d')
+        self.assertRegex(rendered, r'nitter_xposter_post_seconds_bucket\{feed="nitter:twitter_handle",target="mastodon",le="\+Inf"\} \d')
+        with self.assertRaises(ValueError):
+            POST_SECONDS.observe(1, **{**labels, 'extra': 'label'})
+
+        textfile = f"test_{uuid.uuid4()}.prom"
+        try:
+            write_metrics_textfile(textfile)
+            with open(textfile) as f:
+                self.assertIn('nitter_xposter_statuses_sent_total', f.read())
+        finally:
+            os.remove(textfile)
+
+        server = serve_metrics(0, '127.0.0.1')
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as res:
+                self.assertIn('nitter_xposter_statuses_sent_total', res.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test.', ['label'], buckets=(1, 2))
+        counter = Counter('test_total', 'Test.', [])
+        try:
+            histogram.observe(0.5, label='a "quoted" value')
+            histogram.observe(1.5, label='a "quoted" value')
+            histogram.observe(3, label='a "quoted" value')
+            counter.inc(2)
+            self.assertEqual(histogram.render(), [
+                '# HELP test_seconds Test.',
+                '# TYPE test_seconds histogram',
+                'test_seconds_bucket{label="a \\"quoted\\" value",le="1.0"} 1.0',
+                'test_seconds_bucket{label="a \\"quoted\\" value",le="2.0"} 2.0',
+                'test_seconds_bucket{label="a \\"quoted\\" value",le="+Inf"} 3.0',
+                'test_seconds_sum{label="a \\"quoted\\" value"} 5.0',
+                'test_seconds_count{label="a \\"quoted\\" value"} 3.0',
+            ])
+            self.assertEqual(counter.render()[-1], 'test_total 2.0')
+            self.assertEqual(histogram.totals(), (5.0, 3))
+        finally:
+            REGISTRY.remove(histogram)
+            REGISTRY.remove(counter)
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_xpost_legacy_last_position(self, mock_Mastodon):
+        # Databases from before seen statuses were kept only have the last position
+        store = StateStore(self.xpost_config.sqlite_file)
+        store.set_last_position('mastodon:nitter:twitter_handle', '/twitter_handle/status/3#m')
+        store.close()
+        self._add_response(_response_with_items([
+            TestItem("<p>test 5</p>", 5),
+            TestItem("<p>test 4</p>", 4),
+            TestItem("<p>test 2</p>", 2),
+        ]))
+        mock_mastodon = mock_Mastodon.return_value
+
+        xpost(self.xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 4", media_ids=[]),
+            call(status="test 5", media_ids=[]),
+        ])
+
+        store = StateStore(self.xpost_config.sqlite_file)
+        self.assertEqual(store.get_seen(f"{MASTODON_ACCOUNT}:nitter:twitter_handle", [2, 3, 4, 5]), {2, 4, 5})
+        self.assertIsNone(store.get_last_position('mastodon:nitter:twitter_handle'))
+        # Seen statuses are evicted once they were not in the feed for a while
+        store.set_seen(f"{MASTODON_ACCOUNT}:nitter:twitter_handle", [5], time.time() + 10)
+        store.evict_seen(f"{MASTODON_ACCOUNT}:nitter:twitter_handle", time.time() + 5)
+        self.assertEqual(store.get_seen(f"{MASTODON_ACCOUNT}:nitter:twitter_handle", [2, 3, 4, 5]), {5})
+        store.close()
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_xpost_to_accounts_on_same_target(self, mock_Mastodon):
+        # Databases from before seen statuses were kept per account have them per kind of target
+        store = StateStore(self.xpost_config.sqlite_file)
+        store.set_seen('mastodon:nitter:twitter_handle', [1], time.time())
+        store.close()
+        # Another user who authorized the same app
+        another_xpost_config = copy.copy(self.xpost_config)
+        another_xpost_config.mastodon_access_token = 'another_access_token'
+        self._add_response(_response_with_items([TestItem("<p>test 1</p>", 1)]))
+        mock_mastodon = mock_Mastodon.return_value
+
+        xpost(self.xpost_config)
+        xpost(another_xpost_config)
         mock_mastodon.status_post.assert_not_called()
 
-    @patch('nitter_xposter.xposter.Mastodon')
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 2</p>", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        xpost(self.xpost_config)
+        xpost(another_xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 2", media_ids=[]),
+            call(status="test 2", media_ids=[]),
+        ])
+
+        store = StateStore(self.xpost_config.sqlite_file)
+        self.assertFalse(store.has_seen('mastodon:nitter:twitter_handle'))
+        self.assertEqual(store.get_seen(f"{MASTODON_ACCOUNT}:nitter:twitter_handle", [1, 2]), {1, 2})
+        self.assertEqual(store.get_seen(f"{ANOTHER_MASTODON_ACCOUNT}:nitter:twitter_handle", [1, 2]), {1, 2})
+        store.close()
+
+    @patch('mastodon.Mastodon')
+    def test_adopt_legacy_feeds(self, mock_Mastodon):
+        # Seen statuses kept under the account from before it went by the access token are taken over,
+        # rather than the older ones kept per kind of target
+        store = StateStore(self.xpost_config.sqlite_file)
+        store.set_seen('mastodon:mastodon.example.com:client_id:nitter:twitter_handle', [1], time.time())
+        store.set_seen('mastodon:nitter:twitter_handle', [2], time.time())
+        clients = create_clients(self.xpost_config, store)
+        build_targets(self.xpost_config, clients)
+        self.assertEqual(store.get_seen(f"{MASTODON_ACCOUNT}:nitter:twitter_handle", [1, 2]), {1})
+        self.assertFalse(store.has_seen('mastodon:mastodon.example.com:client_id:nitter:twitter_handle'))
+        store.close()
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_xpost_retweet_of_older_status(self, mock_Mastodon):
+        self._add_response(_response_with_items([TestItem("<p>test 400</p>", 400)]))
+        mock_mastodon = mock_Mastodon.return_value
+
+        xpost(self.xpost_config)
+        mock_mastodon.status_post.assert_not_called()
+
+        # The retweet has the id of the retweeted status, and is still sent after the status that was posted before it
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>rt of 100</p>", 100, rt_twitter_handle='rt_twitter_handle'),
+            TestItem("<p>own 500</p>", 500),
+            TestItem("<p>test 400</p>", 400),
+        ]))
+        xpost(self.xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="own 500", media_ids=[]),
+            call(status="rt of 100\nRT: https://twitter.com/rt_twitter_handle/status/100#m", media_ids=[]),
+        ])
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_xpost_keeps_seen_of_other_feeds(self, mock_Mastodon):
+        # Another feed that was not modified for a while keeps its seen statuses when this one is crawled
+        store = StateStore(self.xpost_config.sqlite_file)
+        store.set_seen(f"{MASTODON_ACCOUNT}:nitter:other_handle", [1, 2], time.time() - 60 * 24 * 60 * 60)
+        store.set_last_position('mastodon:nitter:other_handle', '/other_handle/status/1#m')
+        store.close()
+        self._add_response(_response_with_items([TestItem("<p>test 1</p>", 1)]))
+
+        xpost(self.xpost_config)
+        mock_Mastodon.return_value.status_post.assert_not_called()
+
+        store = StateStore(self.xpost_config.sqlite_file)
+        self.assertEqual(store.get_seen(f"{MASTODON_ACCOUNT}:nitter:other_handle", [1, 2]), {1, 2})
+        self.assertEqual(store.get_seen(f"{MASTODON_ACCOUNT}:nitter:twitter_handle", [1]), {1})
+        store.close()
+
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_one_new_status_with_rt(self, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
@@ -167,11 +396,11 @@ class XposterTestCase(unittest.TestCase):
         xpost(self.xpost_config)
         mock_mastodon.status_post.assert_called_once_with(status="test 2\nRT: https://twitter.com/rt_twitter_handle/status/2#m", media_ids=[])
 
-    @patch('nitter_xposter.xposter.Mastodon')
-    @patch('nitter_xposter.xposter.download_image_to_tmp_file')
-    @patch('nitter_xposter.xposter.cleanup_tmp_file')
+    @patch('mastodon.Mastodon')
+    @patch('nitter_xposter.xposter.download_image')
+    @patch('nitter_xposter.xposter.cleanup_media')
     @responses.activate
-    def test_xpost_one_new_status_with_img(self, mock_cleanup_tmp_file, mock_download_image_to_tmp_file, mock_Mastodon):
+    def test_xpost_one_new_status_with_img(self, mock_cleanup_media, mock_download_image, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
         mock_mastodon = mock_Mastodon.return_value
 
@@ -184,19 +413,54 @@ class XposterTestCase(unittest.TestCase):
             TestItem("<p>test 1</p>", 1),
         ]))
         
-        mock_download_image_to_tmp_file.return_value = "tmp_file"
-        mock_mastodon.media_post.return_value = {'id': 'bbbbbb'}
+        image = Media("http://nitter.example.com/pic/media%2Faaaaaa.jpg", 'image/jpeg', 5, data=b'image')
+        mock_download_image.return_value = image
+        uploaded = []
+        mock_mastodon.media_post.side_effect = lambda f, mime_type: uploaded.append(f.read()) or {'id': 'bbbbbb'}
         xpost(self.xpost_config)
-        mock_download_image_to_tmp_file.assert_called_once_with("http://nitter.example.com/pic/media%2Faaaaaa.jpg")
-        mock_mastodon.media_post.assert_called_once_with("tmp_file")
-        mock_cleanup_tmp_file.assert_called_once_with("tmp_file")
+        mock_download_image.assert_called_once_with("http://nitter.example.com/pic/media%2Faaaaaa.jpg", ANY, ANY, ANY)
+        mock_mastodon.media_post.assert_called_once_with(ANY, mime_type='image/jpeg')
+        self.assertEqual(uploaded, [b'image'])
+        mock_cleanup_media.assert_called_once_with(image)
         mock_mastodon.status_post.assert_called_once_with(status="test 2", media_ids=['bbbbbb'])
 
-    @patch('nitter_xposter.xposter.Mastodon')
-    @patch('nitter_xposter.xposter.download_image_to_tmp_file')
-    @patch('nitter_xposter.xposter.cleanup_tmp_file')
+    @patch('mastodon.Mastodon')
+    @patch('nitter_xposter.xposter.download_image')
+    @patch('nitter_xposter.mastodon.MEDIA_PROCESSING_POLL_SECONDS', 0)
+    @responses.activate
+    def test_xpost_waits_for_mastodon_media_processing(self, mock_download_image, mock_Mastodon):
+        self._add_response(_response("<p>test</p>"))
+        mock_mastodon = mock_Mastodon.return_value
+        xpost(self.xpost_config)
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 3</p><img src=\"http://nitter.example.com/pic/media%2Fcccccc.jpg\" style=\"max-width:250px;\" />", 3),
+            TestItem("<p>test 2</p><img src=\"http://nitter.example.com/pic/media%2Faaaaaa.jpg\" style=\"max-width:250px;\" />", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        mock_download_image.side_effect = lambda url, *args: Media(url, 'image/jpeg', len(url), data=url.encode())
+        # Large media is still processing when it is uploaded, and its URL is set once it is done
+        mock_mastodon.media_post.side_effect = lambda f, mime_type: {'id': f.read().decode()[-10:-4], 'url': None}
+        processing = {'aaaaaa': 2, 'cccccc': 0}
+
+        def media(media_id):
+            processing[media_id] -= 1
+            return {'id': media_id, 'url': None if processing[media_id] >= 0 else f'https://mastodon.example.com/{media_id}.jpg'}
+        mock_mastodon.media.side_effect = media
+
+        xpost(self.xpost_config)
+        self.assertEqual(mock_mastodon.media.call_count, 4)
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 2", media_ids=['aaaaaa']),
+            call(status="test 3", media_ids=['cccccc']),
+        ])
+
+    @patch('mastodon.Mastodon')
+    @patch('nitter_xposter.xposter.download_image')
+    @patch('nitter_xposter.xposter.cleanup_media')
     @responses.activate
-    def test_xpost_one_new_status_with_img_but_failed_to_download(self, mock_cleanup_tmp_file, mock_download_image_to_tmp_file, mock_Mastodon):
+    def test_xpost_one_new_status_with_img_but_failed_to_download(self, mock_cleanup_media, mock_download_image, mock_Mastodon):
         self._add_response(_response("<p>test 1</p>"))
         mock_mastodon = mock_Mastodon.return_value
 
@@ -209,21 +473,22 @@ class XposterTestCase(unittest.TestCase):
             TestItem("<p>test 2</p>", 2),
             TestItem("<p>test 1</p>", 1),
         ]))
-        mock_download_image_to_tmp_file.return_value = None
+        mock_download_image.side_effect = DownloadError("Nitter is down", transient=True)
 
         xpost(self.xpost_config)
 
         # call a third time to make sure
         # the position was indeed updated to test 2
         # after failed to download image for test 3
-        # instead of getting stuck at test 1 and reposting test 2
+        # instead of getting stuck at test 1 and reposting test 2,
+        # and that test 3 is not retried before its backoff is over
         xpost(self.xpost_config)
-        mock_download_image_to_tmp_file.assert_called_with("http://nitter.example.com/pic/media%2Faaaaaa.jpg")
+        mock_download_image.assert_called_with("http://nitter.example.com/pic/media%2Faaaaaa.jpg", ANY, ANY, ANY)
         mock_mastodon.media_post.assert_not_called()
-        mock_cleanup_tmp_file.assert_not_called()
+        mock_cleanup_media.assert_not_called()
         mock_mastodon.status_post.assert_called_once_with(status="test 2", media_ids=[])
 
-    @patch('nitter_xposter.xposter.Mastodon')
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_one_new_status_with_nitter_links(self, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
@@ -241,7 +506,7 @@ class XposterTestCase(unittest.TestCase):
         xpost(self.xpost_config)
         mock_mastodon.status_post.assert_called_once_with(status="test 2 https://twitter.com/search?q=%23hashtag", media_ids=[])
 
-    @patch('nitter_xposter.xposter.Client')
+    @patch('atproto.Client')
     @responses.activate
     def test_xpost_one_new_status_to_bsky_with_links(self, mock_AtProtoClient):
         self._add_response(_response("<p>test</p>"))
@@ -327,7 +592,7 @@ class XposterTestCase(unittest.TestCase):
         ]
         self.assertEqual(mock_bsky_client.send_post.call_args_list, expected_calls)
 
-    @patch('nitter_xposter.xposter.Mastodon')
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_multiple_new_statuses(self, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
@@ -351,7 +616,7 @@ class XposterTestCase(unittest.TestCase):
         self.assertEqual(mock_mastodon.status_post.call_args_list, expected_calls)
 
     
-    @patch('nitter_xposter.xposter.Mastodon')
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_multiple_new_statuses_exceeding_limit(self, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
@@ -378,13 +643,15 @@ class XposterTestCase(unittest.TestCase):
         self.assertEqual(mock_mastodon.status_post.call_args_list, expected_calls)
 
 
-    @patch('nitter_xposter.xposter.Mastodon')
+    @patch('mastodon.Mastodon')
     @responses.activate
     def test_xpost_multiple_new_statuses_but_one_errored(self, mock_Mastodon):
         self._add_response(_response("<p>test</p>"))
         mock_mastodon = mock_Mastodon.return_value
+        xpost_config = copy.copy(self.xpost_config)
+        xpost_config.retry_base_seconds = 0
 
-        xpost(self.xpost_config)
+        xpost(xpost_config)
         mock_mastodon.status_post.assert_not_called()
 
         time.sleep(1)
@@ -396,14 +663,14 @@ class XposterTestCase(unittest.TestCase):
         ]))
         
         mock_mastodon.status_post.side_effect = [None, Exception("Error posting status"), None]
-        xpost(self.xpost_config)
+        xpost(xpost_config)
         expected_calls = [
             call(status="test 2", media_ids=[]),
             call(status="test 3", media_ids=[])
         ]
         self.assertEqual(mock_mastodon.status_post.call_args_list, expected_calls)
         mock_mastodon.status_post.side_effect = [None, None]
-        xpost(self.xpost_config)
+        xpost(xpost_config)
         expected_calls = [
             call(status="test 2", media_ids=[]),
             call(status="test 3", media_ids=[]),
@@ -412,8 +679,1010 @@ class XposterTestCase(unittest.TestCase):
         ]
         self.assertEqual(mock_mastodon.status_post.call_args_list, expected_calls)
 
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_xpost_reuses_clients(self, mock_Mastodon):
+        self._add_response(_response("<p>test</p>"))
+        mock_mastodon = mock_Mastodon.return_value
+
+        clients = create_clients(self.xpost_config)
+        xpost(self.xpost_config, clients)
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 2</p>", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+
+        xpost(self.xpost_config, clients)
+        mock_Mastodon.assert_called_once()
+        mock_mastodon.status_post.assert_called_once_with(status="test 2", media_ids=[])
+
+    @patch('nitter_xposter.daemon.run_post_hook')
+    @patch('nitter_xposter.accounts.deliver_outbox')
+    @patch('nitter_xposter.accounts.xpost')
+    @patch('nitter_xposter.accounts.create_clients')
+    def test_run_daemon(self, mock_create_clients, mock_xpost, mock_deliver_outbox, mock_run_post_hook):
+        stop_event = threading.Event()
+        delivered = threading.Event()
+        mock_xpost.side_effect = [Exception("Error crawling"), None, None]
+        mock_deliver_outbox.side_effect = lambda *args: delivered.set()
+
+        def stop_after_third_crawl(*args):
+            if mock_xpost.call_count == 3:
+                # Statuses are delivered in the background, separately from crawls
+                self.assertTrue(delivered.wait(5))
+                stop_event.set()
+        mock_run_post_hook.side_effect = stop_after_third_crawl
+
+        run_daemon([self.xpost_config], interval_minutes=0, jitter_seconds=0, post_hook='post.sh', stop_event=stop_event)
+        mock_create_clients.assert_called_once_with(self.xpost_config, ANY, ANY)
+        self.assertEqual(mock_xpost.call_count, 3)
+        mock_xpost.assert_called_with(self.xpost_config, mock_create_clients.return_value, False)
+        mock_deliver_outbox.assert_called_with(self.xpost_config, mock_create_clients.return_value)
+        self.assertEqual(mock_run_post_hook.call_args_list, [call('post.sh'), call('post.sh')])
+
+    def test_parse_accounts_config(self):
+        configs, concurrency = parse_accounts_config({
+            'sqlite_file': 'db.db',
+            'nitter_host': 'nitter.example.com',
+            'concurrency': 2,
+            'accounts': [
+                {
+                    'twitter_handle': 'alice',
+                    'mastodon_host': 'mastodon.example.com',
+                    'mastodon_client_id': 'client_id',
+                    'mastodon_client_secret': 'client_secret',
+                    'mastodon_access_token': 'access_token',
+                },
+                {
+                    'twitter_handle': 'bob',
+                    'nitter_https': False,
+                    'bsky_handle': 'bob.bsky.social',
+                    'bsky_password': 'password',
+                    'bsky_status_limit': 5,
+                },
+            ]
+        })
+        self.assertEqual(concurrency, 2)
+        self.assertEqual([c.twitter_handle for c in configs], ['alice', 'bob'])
+        self.assertEqual([c.sqlite_file for c in configs], ['db.db', 'db.db'])
+        self.assertEqual([c.nitter_https for c in configs], [True, False])
+        self.assertTrue(configs[0].is_mastodon())
+        self.assertTrue(configs[1].is_bsky())
+        self.assertEqual(configs[1].bsky_status_limit, 5)
+
+        with self.assertRaises(Exception):
+            parse_accounts_config({'nitter_host': 'nitter.example.com', 'accounts': [{'twitter_handle': 'alice'}]})
+        with self.assertRaises(Exception):
+            parse_accounts_config({'sqlite_file': 'db.db', 'nitter_host': 'nitter.example.com', 'accounts': [{'twitter_handle': 'alice', 'typo': 1}]})
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_xpost_many(self, mock_Mastodon):
+        alice_config = copy.copy(self.xpost_config)
+        alice_config.twitter_handle = 'alice'
+        bob_config = copy.copy(self.xpost_config)
+        bob_config.twitter_handle = 'bob'
+        broken_config = copy.copy(self.xpost_config)
+        broken_config.twitter_handle = 'broken'
+        for handle in ('alice', 'bob'):
+            responses.add(
+                responses.GET,
+                f'https://nitter.example.com/{handle}/rss',
+                status=200,
+                content_type='application/rss+xml',
+                body=_response("<p>test</p>").replace('twitter_handle', handle)
+            )
+        responses.add(
+            responses.GET,
+            'https://nitter.example.com/broken/rss',
+            status=200,
+            content_type='application/rss+xml',
+            body='<?xml version="1.0'
+        )
+        mock_mastodon = mock_Mastodon.return_value
+
+        clients = {}
+        self.assertEqual(xpost_many([alice_config, bob_config, broken_config], 2, clients), 1)
+        self.assertEqual(sorted(clients.keys()), [0, 1, 2])
+        mock_mastodon.status_post.assert_not_called()
+
+        time.sleep(1)
+        for handle in ('alice', 'bob'):
+            responses.add(
+                responses.GET,
+                f'https://nitter.example.com/{handle}/rss',
+                status=200,
+                content_type='application/rss+xml',
+                body=_response_with_items([
+                    TestItem(f"<p>{handle} 2</p>", 2),
+                    TestItem(f"<p>{handle} 1</p>", 1),
+                ]).replace('twitter_handle', handle)
+            )
+        self.assertEqual(xpost_many([alice_config, bob_config, broken_config], 2, clients), 1)
+        # All accounts post to the same Mastodon account, so they share one client
+        self.assertEqual(mock_Mastodon.call_count, 1)
+        self.assertEqual(
+            sorted(c.kwargs['status'] for c in mock_mastodon.status_post.call_args_list),
+            ['alice 2', 'bob 2']
+        )
+
+    @patch('mastodon.Mastodon')
+    @patch('atproto.Client')
+    @patch('nitter_xposter.xposter.download_image')
+    @patch('nitter_xposter.xposter.cleanup_media')
+    @responses.activate
+    def test_xpost_to_mastodon_and_bsky(self, mock_cleanup_media, mock_download_image, mock_AtProtoClient, mock_Mastodon):
+        self._add_response(_response("<p>test 1</p>"))
+        mock_mastodon = mock_Mastodon.return_value
+        mock_bsky_client = mock_AtProtoClient.return_value
+
+        xpost_config = copy.copy(self.xpost_config)
+        xpost_config.bsky_handle = 'test_handle'
+        xpost_config.bsky_password = 'test_password_this_should_not_work'
+        xpost_config.retry_base_seconds = 0
+
+        xpost(xpost_config)
+        mock_mastodon.status_post.assert_not_called()
+        mock_bsky_client.send_post.assert_not_called()
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 3</p>", 3),
+            TestItem("<p>test 2</p><img src=\"http://nitter.example.com/pic/media%2Faaaaaa.jpg\" style=\"max-width:250px;\" />", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        image = Media("http://nitter.example.com/pic/media%2Faaaaaa.jpg", 'image/jpeg', 5, data=b'image')
+        mock_download_image.return_value = image
+        mock_mastodon.media_post.return_value = {'id': 'bbbbbb'}
+        mock_bsky_client.com.atproto.repo.upload_blob.return_value = atproto.models.ComAtprotoRepoUploadBlob.Response(
+            blob=BlobRef(mime_type='image/jpeg', size=5, ref='bafkreibme22gw2h7y2h7tg2fhqotaqjucnbc24deqo72b6mkl2egezxhvy')
+        )
+        mock_bsky_client.send_post.side_effect = Exception("Bsky is down")
+
+        xpost(xpost_config)
+        mock_download_image.assert_called_once_with("http://nitter.example.com/pic/media%2Faaaaaa.jpg", ANY, ANY, ANY)
+        mock_mastodon.media_post.assert_called_once_with(ANY, mime_type='image/jpeg')
+        mock_bsky_client.com.atproto.repo.upload_blob.assert_called_once_with(b'image')
+        mock_cleanup_media.assert_called_once_with(image)
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 2", media_ids=['bbbbbb']),
+            call(status="test 3", media_ids=[]),
+        ])
+        self.assertEqual(mock_bsky_client.send_post.call_count, 1)
+
+        # Bsky retries from where it failed while Mastodon is already up to date
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 3</p>", 3),
+            TestItem("<p>test 2</p>", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        mock_bsky_client.send_post.side_effect = None
+        xpost(xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_count, 2)
+        self.assertEqual([c.kwargs['text'] for c in mock_bsky_client.send_post.call_args_list], ["test 2", "test 2", "test 3"])
+
+    @patch('atproto.Client')
+    def test_create_clients_reuses_bsky_session(self, mock_AtProtoClient):
+        mock_bsky_client = mock_AtProtoClient.return_value
+        xpost_config = copy.copy(self.xpost_config)
+        xpost_config.mastodon_host = None
+        xpost_config.bsky_handle = 'test_handle'
+        xpost_config.bsky_password = 'test_password_this_should_not_work'
+
+        create_clients(xpost_config)
+        mock_bsky_client.login.assert_called_once_with('test_handle', 'test_password_this_should_not_work')
+
+        # Simulate the client creating a session
+        save_session = mock_bsky_client.on_session_change.call_args.args[0]
+        session = Session('test_handle', 'did:plc:test', 'access_jwt', 'refresh_jwt')
+        save_session(SessionEvent.CREATE, session)
+
+        mock_bsky_client.reset_mock()
+        create_clients(xpost_config)
+        mock_bsky_client.login.assert_called_once_with(session_string=session.export())
+
+        # Falls back to logging in with password if the saved session cannot be used
+        mock_bsky_client.reset_mock()
+        mock_bsky_client.login.side_effect = [Exception("Token has expired"), None]
+        create_clients(xpost_config)
+        self.assertEqual(mock_bsky_client.login.call_args_list, [
+            call(session_string=session.export()),
+            call('test_handle', 'test_password_this_should_not_work'),
+        ])
+
+    @patch('mastodon.Mastodon')
+    @patch('nitter_xposter.xposter.feedparser.parse', wraps=feedparser.parse)
+    @responses.activate
+    def test_xpost_feed_not_modified(self, mock_parse, mock_Mastodon):
+        body = _response("<p>test</p>")
+        responses.add(
+            responses.GET,
+            'https://nitter.example.com/twitter_handle/rss',
+            status=200,
+            content_type='application/rss+xml',
+            headers={'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'},
+            body=body
+        )
+        mock_mastodon = mock_Mastodon.return_value
+
+        xpost(self.xpost_config)
+        self.assertEqual(mock_parse.call_count, 1)
+
+        # Nitter says the feed is not modified
+        responses.reset()
+        responses.add(
+            responses.GET,
+            'https://nitter.example.com/twitter_handle/rss',
+            status=304,
+            match=[matchers.header_matcher({'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'})]
+        )
+        xpost(self.xpost_config)
+        self.assertEqual(mock_parse.call_count, 1)
+
+        # Nitter doesn't support validators but the feed is the same
+        responses.reset()
+        self._add_response(body)
+        xpost(self.xpost_config)
+        self.assertEqual(mock_parse.call_count, 1)
+
+        # The feed changed
+        time.sleep(1)
+        responses.reset()
+        self._add_response(_response_with_items([
+            TestItem("<p>test 2</p>", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        xpost(self.xpost_config)
+        self.assertEqual(mock_parse.call_count, 2)
+        mock_mastodon.status_post.assert_called_once_with(status="test 2", media_ids=[])
+
+    def test_parse_description(self):
+        text, image_urls = parse_description(
+            '<p>test &amp;amp; <a href="http://nitter.example.com/search?q=%23hashtag"><b>#hashtag</b></a> '
+            '<a href="https://example.com/?a=1&amp;b=2">example.com</a> <a>not a link</a></p>'
+            '<a href="http://nitter.example.com/pic/orig/media%2Faaaaaa.jpg"><img src="http://nitter.example.com/pic/media%2Faaaaaa.jpg" /></a>'
+            '<img src="http://nitter.example.com/pic/media%2Fbbbbbb.jpg" style="max-width:250px;" />',
+            'nitter.example.com'
+        )
+        self.assertEqual(
+            text,
+            "test & https://twitter.com/search?q=%23hashtag https://example.com/?a=1&b=2 not a link"
+            "https://twitter.com/pic/orig/media%2Faaaaaa.jpg"
+        )
+        self.assertEqual(image_urls, [
+            "http://nitter.example.com/pic/media%2Faaaaaa.jpg",
+            "http://nitter.example.com/pic/media%2Fbbbbbb.jpg",
+        ])
+
+    def test_build_bsky_text(self):
+        text, facets = build_bsky_text("test https://example.com/a/very/long/path/to/something and https://twitter.com/x")
+        self.assertEqual(text, "test https://example.com/a/very/...and https://twitter.com/x")
+        self.assertEqual([f.features[0].uri for f in facets], [
+            "https://example.com/a/very/long/path/to/something",
+            "https://twitter.com/x",
+        ])
+        self.assertEqual([(f.index.byte_start, f.index.byte_end) for f in facets], [(5, 35), (39, 60)])
+        self.assertIs(get_url_extractor(), get_url_extractor())
+
+    def test_split_bsky_text(self):
+        self.assertEqual(list(iter_graphemes("e\u0301👨\u200d👩\u200d👧🇯🇵🇺🇸👍🏽a")), ["e\u0301", "👨\u200d👩\u200d👧", "🇯🇵", "🇺🇸", "👍🏽", "a"])
+
+        text, facets = build_bsky_text(("あい " * 95) + "https://example.com/a/very/long/path/to/something " + ("word " * 40) + "https://twitter.com/x end")
+        segments = split_bsky_text(text, facets)
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(segments[0][0], ("あい " * 95).strip())
+        self.assertEqual(segments[0][1], [])
+        self.assertTrue(segments[1][0].startswith("https://example.com/a/very/..."))
+        self.assertLessEqual(len(segments[1][0]), 300)
+        # The facets point to their links within the text of their own post
+        encoded = segments[1][0].encode('utf-8')
+        self.assertEqual(
+            [(encoded[f.index.byte_start:f.index.byte_end].decode('utf-8'), f.features[0].uri) for f in segments[1][1]],
+            [
+                ("https://example.com/a/very/...", "https://example.com/a/very/long/path/to/something"),
+                ("https://twitter.com/x", "https://twitter.com/x"),
+            ]
+        )
+        # Text that fits in one post is left as it is
+        self.assertEqual(split_bsky_text("test", []), [("test", [])])
+        # A grapheme cluster over the byte limit by itself is split between its characters
+        text = "a" + "\u0301" * 1600
+        segments = split_bsky_text(text, [], max_bytes=500)
+        self.assertEqual("".join(segment_text for segment_text, _ in segments), text)
+        self.assertTrue(all(len(segment_text.encode('utf-8')) <= 500 for segment_text, _ in segments))
+
+    def test_post_to_bsky_thread(self):
+        client = MagicMock()
+        client.send_post.side_effect = [
+            atproto.models.AppBskyFeedPost.CreateRecordResponse(uri=f"at://did:plc:test/app.bsky.feed.post/{i}", cid=f"cid{i}")
+            for i in range(3)
+        ]
+        parsed_entry = ParsedEntry(id="1", text="word " * 150, rt=None, image_urls=())
+        post_to_bsky(parsed_entry, [], client)
+
+        calls = client.send_post.call_args_list
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(" ".join(c.kwargs['text'] for c in calls), ("word " * 150).strip())
+        self.assertIsNone(calls[0].kwargs['reply_to'])
+        self.assertEqual(calls[0].kwargs['embed'], atproto.models.AppBskyEmbedImages.Main(images=[]))
+        self.assertIsNone(calls[1].kwargs['embed'])
+        self.assertEqual((calls[1].kwargs['reply_to'].root.uri, calls[1].kwargs['reply_to'].parent.uri), ("at://did:plc:test/app.bsky.feed.post/0", "at://did:plc:test/app.bsky.feed.post/0"))
+        self.assertEqual((calls[2].kwargs['reply_to'].root.uri, calls[2].kwargs['reply_to'].parent.cid), ("at://did:plc:test/app.bsky.feed.post/0", "cid1"))
+
+    @patch('atproto.Client')
+    @responses.activate
+    def test_xpost_continues_bsky_thread(self, mock_AtProtoClient):
+        self._add_response(_response("<p>test 1</p>"))
+        mock_bsky_client = mock_AtProtoClient.return_value
+        xpost_config = copy.copy(self.xpost_config)
+        xpost_config.mastodon_host = None
+        xpost_config.bsky_handle = 'test_handle'
+        xpost_config.bsky_password = 'test_password_this_should_not_work'
+        xpost_config.retry_base_seconds = 0
+
+        xpost(xpost_config)
+        mock_bsky_client.send_post.assert_not_called()
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>" + "word " * 150 + "</p>", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        mock_bsky_client.send_post.side_effect = [
+            atproto.models.AppBskyFeedPost.CreateRecordResponse(uri="at://did:plc:test/app.bsky.feed.post/0", cid="cid0"),
+            Exception('Connection reset'),
+        ]
+        # The second post of the thread failing keeps the status queued with where the thread stopped
+        xpost(xpost_config)
+        self.assertEqual(mock_bsky_client.send_post.call_count, 2)
+        store = StateStore(xpost_config.sqlite_file)
+        (_, _, attempts, _, progress), = store.get_pending_outbox('bsky:test_handle:nitter:twitter_handle')
+        self.assertEqual(attempts, 1)
+        self.assertEqual(json.loads(progress)['next'], 1)
+        store.close()
+
+        # The retry continues the thread rather than starting it again
+        mock_bsky_client.send_post.side_effect = [
+            atproto.models.AppBskyFeedPost.CreateRecordResponse(uri=f"at://did:plc:test/app.bsky.feed.post/{i}", cid=f"cid{i}")
+            for i in (1, 2)
+        ]
+        xpost(xpost_config)
+        calls = mock_bsky_client.send_post.call_args_list[2:]
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(
+            [(c.kwargs['reply_to'].root.uri, c.kwargs['reply_to'].parent.uri) for c in calls],
+            [
+                ("at://did:plc:test/app.bsky.feed.post/0", "at://did:plc:test/app.bsky.feed.post/0"),
+                ("at://did:plc:test/app.bsky.feed.post/0", "at://did:plc:test/app.bsky.feed.post/1"),
+            ]
+        )
+        self.assertEqual(" ".join(c.kwargs['text'] for c in mock_bsky_client.send_post.call_args_list[:1] + calls), ("word " * 150).strip())
+        store = StateStore(xpost_config.sqlite_file)
+        self.assertEqual(store.get_pending_outbox('bsky:test_handle:nitter:twitter_handle'), [])
+        store.close()
+
+    @patch('mastodon.Mastodon')
+    @patch('nitter_xposter.xposter.parse_feed_entry', wraps=parse_feed_entry)
+    @responses.activate
+    def test_xpost_only_parses_entries_to_post(self, mock_parse_feed_entry, mock_Mastodon):
+        self._add_response(_response_with_items([
+            TestItem("<p>test 1</p>", 1),
+            TestItem("<p>test 0</p>", 0),
+        ]))
+        mock_mastodon = mock_Mastodon.return_value
+
+        xpost_config = copy.copy(self.xpost_config)
+        xpost_config.mastodon_status_limit = 2
+        xpost(xpost_config)
+        mock_parse_feed_entry.assert_not_called()
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 5</p>", 5),
+            TestItem("<p>test 4</p>", 4),
+            TestItem("<p>test 3</p>", 3),
+            TestItem("<p>test 2</p>", 2),
+            TestItem("<p>test 1</p>", 1),
+            TestItem("<p>test 0</p>", 0),
+        ]))
+        xpost(xpost_config)
+        self.assertEqual(
+            [c.args[0].id for c in mock_parse_feed_entry.call_args_list],
+            ['/twitter_handle/status/2#m', '/twitter_handle/status/3#m']
+        )
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 2", media_ids=[]),
+            call(status="test 3", media_ids=[]),
+        ])
+
+    @patch('mastodon.Mastodon')
+    @patch('nitter_xposter.xposter.download_image')
+    @patch('nitter_xposter.xposter.cleanup_media')
+    @responses.activate
+    def test_xpost_prefetches_images(self, mock_cleanup_media, mock_download_image, mock_Mastodon):
+        self._add_response(_response("<p>test 1</p>"))
+        mock_mastodon = mock_Mastodon.return_value
+
+        xpost(self.xpost_config)
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 3</p><img src=\"http://nitter.example.com/pic/media%2Fcccccc.jpg\" />", 3),
+            TestItem("<p>test 2</p><img src=\"http://nitter.example.com/pic/media%2Faaaaaa.jpg\" /><img src=\"http://nitter.example.com/pic/media%2Fbbbbbb.jpg\" />", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        mock_download_image.side_effect = lambda url, *args: Media(url, 'image/jpeg', 5, data=url.replace("http://nitter.example.com/pic/media%2F", "").encode())
+
+        downloads_before_first_upload = []
+        def media_post(f, mime_type):
+            if not downloads_before_first_upload:
+                downloads_before_first_upload.append(mock_download_image.call_count)
+            return {'id': f.read().decode()}
+        mock_mastodon.media_post.side_effect = media_post
+
+        xpost(self.xpost_config)
+        self.assertEqual(downloads_before_first_upload, [3])
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 2", media_ids=['aaaaaa.jpg', 'bbbbbb.jpg']),
+            call(status="test 3", media_ids=['cccccc.jpg']),
+        ])
+        self.assertEqual(mock_cleanup_media.call_count, 3)
+
+    @patch('mastodon.Mastodon')
+    @patch('nitter_xposter.xposter.download_image')
+    @responses.activate
+    def test_xpost_prefetches_images_within_rate_limit(self, mock_download_image, mock_Mastodon):
+        self._add_response(_response("<p>test 1</p>"))
+        mock_mastodon = mock_Mastodon.return_value
+
+        xpost(self.xpost_config)
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 3</p><img src=\"http://nitter.example.com/pic/media%2Fcccccc.jpg\" />", 3),
+            TestItem("<p>test 2</p><img src=\"http://nitter.example.com/pic/media%2Faaaaaa.jpg\" />", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        mock_download_image.side_effect = lambda url, *args: Media(url, 'image/jpeg', 5, data=b'image ' + url.encode())
+        mock_mastodon.media_post.side_effect = lambda f, mime_type: {'id': 'media'}
+        # Only one status can be sent in this run, so the images of the next one are not downloaded yet
+        store = StateStore(self.xpost_config.sqlite_file)
+        store.set_rate_limit(MASTODON_ACCOUNT, 1, time.time(), None)
+        store.close()
+
+        xpost(self.xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [call(status="test 2", media_ids=['media'])])
+        self.assertEqual(mock_download_image.call_args_list, [call('http://nitter.example.com/pic/media%2Faaaaaa.jpg', ANY, ANY, ANY)])
+
+    @responses.activate
+    def test_download_image(self):
+        responses.add(responses.GET, 'http://nitter.example.com/pic/media%2Faaaaaa.jpg', status=200, content_type='image/png', body=b'image')
+        responses.add(responses.GET, 'http://nitter.example.com/pic/media%2Fbbbbbb.jpg', status=200, content_type='application/octet-stream', body=b'large image')
+        responses.add(responses.GET, 'http://nitter.example.com/pic/media%2Fcccccc.jpg', status=404)
+
+        session = requests.Session()
+        image = download_image('http://nitter.example.com/pic/media%2Faaaaaa.jpg', session, 10, 30)
+        self.assertEqual((image.mime_type, image.size, image.data, image.file), ('image/png', 5, b'image', None))
+
+        # Spilled to disk, with the type guessed from the URL
+        image = download_image('http://nitter.example.com/pic/media%2Fbbbbbb.jpg', session, 10, 30)
+        self.addCleanup(os.remove, image.file)
+        self.assertEqual((image.mime_type, image.size, image.data), ('image/jpeg', 11, None))
+        self.assertEqual(image.read(), b'large image')
+
+        with self.assertRaises(DownloadError) as cm:
+            download_image('http://nitter.example.com/pic/media%2Fcccccc.jpg', session, 10, 30)
+        self.assertFalse(cm.exception.transient)
+
+    def test_fit_media(self):
+        def encode(image: Image.Image, format: str, **params) -> bytes:
+            out = io.BytesIO()
+            image.save(out, format=format, **params)
+            return out.getvalue()
+
+        # Noise doesn't compress, so a large photo is both scaled down and recompressed to fit Bluesky, without its EXIF data
+        exif = Image.Exif()
+        exif[0x010f] = 'Camera maker'
+        data = encode(Image.frombytes('RGB', (3000, 2000), os.urandom(3000 * 2000 * 3)), 'JPEG', quality=95, exif=exif)
+        self.assertGreater(len(data), BSKY_MEDIA_LIMITS.max_bytes)
+        fitted = fit_media(Media('http://nitter.example.com/pic/large.jpg', 'image/jpeg', len(data), data=data), BSKY_MEDIA_LIMITS)
+        self.assertEqual(fitted.mime_type, 'image/jpeg')
+        self.assertLessEqual(fitted.size, BSKY_MEDIA_LIMITS.max_bytes)
+        with Image.open(io.BytesIO(fitted.data)) as image:
+            self.assertLessEqual(image.width * image.height, BSKY_MEDIA_LIMITS.max_pixels)
+            self.assertAlmostEqual(image.width / image.height, 1.5, places=2)
+            self.assertNotIn('exif', image.info)
+
+        # Transcoded images are cached by content hash
+        with patch('nitter_xposter.transcode.get_transcode_pool') as mock_get_transcode_pool:
+            self.assertEqual(fit_media(Media('http://nitter.example.com/pic/retweet.jpg', 'image/jpeg', len(data), data=data), BSKY_MEDIA_LIMITS).data, fitted.data)
+            mock_get_transcode_pool.assert_not_called()
+
+        # A rotated photo is turned the right way before its EXIF data is dropped
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        data = encode(Image.new('RGB', (20, 10)), 'JPEG', exif=exif)
+        fitted = fit_media(Media('http://nitter.example.com/pic/rotated.jpg', 'image/jpeg', len(data), data=data), BSKY_MEDIA_LIMITS)
+        with Image.open(io.BytesIO(fitted.data)) as image:
+            self.assertEqual(image.size, (10, 20))
+            self.assertNotIn('exif', image.info)
+
+        # A PNG that is too large is scaled down and stays a PNG
+        data = encode(Image.new('RGBA', (100, 100)), 'PNG')
+        fitted = fit_media(Media('http://nitter.example.com/pic/large.png', 'image/png', len(data), data=data), MediaLimits(max_bytes=1000 * 1000, max_pixels=50 * 50))
+        self.assertEqual(fitted.mime_type, 'image/png')
+        with Image.open(io.BytesIO(fitted.data)) as image:
+            self.assertEqual(image.size, (50, 50))
+
+        # Images that already fit and anything that is not an image are uploaded as they are
+        image = Media('http://nitter.example.com/pic/small.png', 'image/png', len(data), data=data)
+        self.assertIs(fit_media(image, BSKY_MEDIA_LIMITS), image)
+        video = Media('http://nitter.example.com/video.mp4', 'video/mp4', 5, data=b'video')
+        self.assertIs(fit_media(video, BSKY_MEDIA_LIMITS), video)
+
+    @patch('mastodon.Mastodon')
+    @patch('nitter_xposter.xposter.download_image')
+    @responses.activate
+    def test_xpost_reuses_media_when_retrying(self, mock_download_image, mock_Mastodon):
+        self._add_response(_response("<p>test 1</p>"))
+        mock_mastodon = mock_Mastodon.return_value
+        xpost_config = copy.copy(self.xpost_config)
+        xpost_config.retry_base_seconds = 0
+
+        xpost(xpost_config)
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 2</p><img src=\"http://nitter.example.com/pic/media%2Faaaaaa.jpg\" />", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        mock_download_image.return_value = Media("http://nitter.example.com/pic/media%2Faaaaaa.jpg", 'image/jpeg', 5, data=b'image')
+        mock_mastodon.media_post.return_value = {'id': 'bbbbbb'}
+        mock_mastodon.status_post.side_effect = [Exception("Error posting status"), None]
+
+        xpost(xpost_config)
+        xpost(xpost_config)
+        mock_download_image.assert_called_once()
+        mock_mastodon.media_post.assert_called_once()
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 2", media_ids=['bbbbbb']),
+            call(status="test 2", media_ids=['bbbbbb']),
+        ])
+
+        # Media attached to a status cannot be attached to another one
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 3</p><img src=\"http://nitter.example.com/pic/media%2Faaaaaa.jpg\" />", 3),
+            TestItem("<p>test 2</p><img src=\"http://nitter.example.com/pic/media%2Faaaaaa.jpg\" />", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        mock_mastodon.media_post.return_value = {'id': 'cccccc'}
+        mock_mastodon.status_post.side_effect = None
+        xpost(xpost_config)
+        self.assertEqual(mock_mastodon.media_post.call_count, 2)
+        mock_mastodon.status_post.assert_called_with(status="test 3", media_ids=['cccccc'])
+
+    @patch('atproto.Client')
+    @patch('nitter_xposter.xposter.download_image')
+    @responses.activate
+    def test_xpost_reuses_bsky_blobs_for_same_image(self, mock_download_image, mock_AtProtoClient):
+        self._add_response(_response("<p>test 1</p>"))
+        mock_bsky_client = mock_AtProtoClient.return_value
+
+        xpost_config = copy.copy(self.xpost_config)
+        xpost_config.mastodon_host = None
+        xpost_config.bsky_handle = 'test_handle'
+        xpost_config.bsky_password = 'test_password_this_should_not_work'
+        xpost(xpost_config)
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 3</p><img src=\"http://nitter.example.com/pic/media%2Fbbbbbb.jpg\" />", 3, rt_twitter_handle='rt_twitter_handle'),
+            TestItem("<p>test 2</p><img src=\"http://nitter.example.com/pic/media%2Faaaaaa.jpg\" />", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        mock_download_image.side_effect = lambda url, *args: Media(url, 'image/jpeg', 5, data=b'image')
+        blob = atproto.models.ComAtprotoRepoUploadBlob.Response(
+            blob=BlobRef(mime_type='image/jpeg', size=5, ref='bafkreibme22gw2h7y2h7tg2fhqotaqjucnbc24deqo72b6mkl2egezxhvy')
+        )
+        mock_bsky_client.com.atproto.repo.upload_blob.return_value = blob
+
+        xpost(xpost_config)
+        self.assertEqual(mock_download_image.call_count, 2)
+        mock_bsky_client.com.atproto.repo.upload_blob.assert_called_once_with(b'image')
+        self.assertEqual(
+            [c.kwargs['embed'].images[0].image for c in mock_bsky_client.send_post.call_args_list],
+            [blob.blob, blob.blob]
+        )
+
+    def test_state_store(self):
+        sqlite_file = f"test_{uuid.uuid4()}.db"
+
+        # A database created before migrations existed
+        conn = sqlite3.connect(sqlite_file)
+        conn.execute('CREATE TABLE last_position (feed_name TEXT PRIMARY KEY, last_id TEXT)')
+        conn.execute("INSERT INTO last_position VALUES ('feed', 'id 1')")
+        conn.commit()
+
+        store = StateStore(sqlite_file)
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(store.get_last_position('feed'), 'id 1')
+
+        # Writes are only visible to other connections once committed
+        store.set_last_position('feed', 'id 2')
+        store.set_last_position('another feed', 'id 3')
+        self.assertEqual(store.get_last_position('feed'), 'id 2')
+        self.assertEqual(conn.execute("SELECT last_id FROM last_position WHERE feed_name = 'feed'").fetchone(), ('id 1',))
+        store.commit()
+        self.assertEqual(conn.execute('SELECT feed_name, last_id FROM last_position ORDER BY feed_name').fetchall(), [
+            ('another feed', 'id 3'),
+            ('feed', 'id 2'),
+        ])
+
+        # Except for the acknowledgements of queued statuses, which are committed right away
+        store.enqueue_outbox('feed', [(1, 'id 1', 'entry 1'), (2, 'id 2', 'entry 2'), (3, 'id 3', 'entry 3')], 100)
+        store.commit()
+        (seq_1, _, _, _, _), (seq_2, _, _, _, _), (seq_3, _, _, _, _) = store.get_pending_outbox('feed')
+        store.delete_outbox(seq_1)
+        store.retry_outbox(seq_2, 1, 200, 'error')
+        store.fail_outbox(seq_3, 2, 'error', 300)
+        self.assertEqual(conn.execute('SELECT entry_id, attempts, next_attempt_at, failed_at FROM outbox ORDER BY seq').fetchall(), [
+            ('id 2', 1, 200, None),
+            ('id 3', 2, 100, 300),
+        ])
+        conn.close()
+        store.close()
+
+        store = StateStore(sqlite_file)
+        self.assertEqual(store.get_last_position('another feed'), 'id 3')
+        store.close()
+
+    def test_token_bucket(self):
+        sqlite_file = f"test_{uuid.uuid4()}.db"
+        store = StateStore(sqlite_file)
+        bucket = TokenBucket(store, 'account', RateLimit(burst=2, per_second=0.5))
+        self.assertEqual(bucket.available(now=100), 2)
+        self.assertTrue(bucket.acquire(now=100))
+        self.assertEqual(bucket.available(now=100), 1)
+        self.assertTrue(bucket.acquire(now=100))
+        self.assertFalse(bucket.acquire(now=100))
+        self.assertFalse(bucket.acquire(now=101))
+        self.assertTrue(bucket.acquire(now=102))
+
+        # Blocked until the time the target asked for, however many tokens there are
+        bucket.block_until(200, now=102)
+        self.assertEqual(bucket.available(now=199), 0)
+        self.assertFalse(bucket.acquire(now=199))
+        store.close()
+
+        # The bucket is persisted
+        store = StateStore(sqlite_file)
+        bucket = TokenBucket(store, 'account', RateLimit(burst=2, per_second=0.5))
+        self.assertTrue(bucket.acquire(now=200))
+        self.assertFalse(TokenBucket(store, 'another account', RateLimit(burst=0, per_second=0.5)).acquire(now=200))
+        store.close()
+
+    def test_retry_at_from_headers(self):
+        self.assertEqual(retry_at_from_headers({'Retry-After': '120'}, 1000), 1120)
+        self.assertEqual(retry_at_from_headers({'retry-after': 'Thu, 01 Jan 1970 00:30:00 GMT'}, 1000), 1800)
+        self.assertEqual(retry_at_from_headers({'ratelimit-remaining': '0', 'ratelimit-reset': '1500'}, 1000), 1500)
+        self.assertIsNone(retry_at_from_headers({}, 1000))
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_xpost_rate_limited(self, mock_Mastodon):
+        self._add_response(_response("<p>test</p>"))
+        mock_mastodon = mock_Mastodon.return_value
+        xpost_config = copy.copy(self.xpost_config)
+        xpost_config.mastodon_status_limit = 0
+        xpost(xpost_config)
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem(f"<p>test {i}</p>", i) for i in range(15, 0, -1)
+        ]))
+
+        # Without a status limit all new statuses are sent, until the target says it is rate limited
+        mock_mastodon.ratelimit_reset = time.time() + 60
+        mock_mastodon.status_post.side_effect = [None] * 12 + [MastodonRatelimitError('Hit rate limit.')]
+        xpost(xpost_config)
+        self.assertEqual(
+            mock_mastodon.status_post.call_args_list,
+            [call(status=f"test {i}", media_ids=[]) for i in range(2, 15)]
+        )
+
+        # Nothing is sent until the rate limit resets, and then the remaining statuses are
+        mock_mastodon.status_post.side_effect = None
+        mock_mastodon.status_post.reset_mock()
+        xpost(xpost_config)
+        mock_mastodon.status_post.assert_not_called()
+
+        with patch('nitter_xposter.ratelimit.time.time', return_value=time.time() + 61):
+            xpost(xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 14", media_ids=[]),
+            call(status="test 15", media_ids=[]),
+        ])
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_xpost_outbox(self, mock_Mastodon):
+        self._add_response(_response("<p>test 1</p>"))
+        mock_mastodon = mock_Mastodon.return_value
+        xpost(self.xpost_config)
+
+        time.sleep(1)
+        self._add_response(_response_with_items([
+            TestItem("<p>test 4</p>", 4),
+            TestItem("<p>test 3</p>", 3),
+            TestItem("<p>test 2</p>", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+
+        # A status that Mastodon rejects is given up on, and one that failed because Mastodon is down is retried later
+        mock_mastodon.status_post.side_effect = [
+            MastodonAPIError('Mastodon API returned error', 422, 'Unprocessable Entity', 'Validation failed'),
+            MastodonServiceUnavailableError('Mastodon API returned error', 503, 'Service Unavailable', None),
+        ]
+        xpost(self.xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_args_list, [
+            call(status="test 2", media_ids=[]),
+            call(status="test 3", media_ids=[]),
+        ])
+
+        # Crawling moved past all entries, and statuses are sent from the outbox once the backoff is over
+        store = StateStore(self.xpost_config.sqlite_file)
+        feed_name = f"{MASTODON_ACCOUNT}:nitter:twitter_handle"
+        self.assertEqual(store.get_seen(feed_name, [1, 2, 3, 4]), {1, 2, 3, 4})
+        pending = store.get_pending_outbox(feed_name)
+        self.assertEqual([attempts for _, _, attempts, _, _ in pending], [1, 0])
+        self.assertGreater(pending[0][3], time.time())
+        store.close()
+
+        mock_mastodon.status_post.side_effect = None
+        xpost(self.xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_count, 2)
+
+        with patch('nitter_xposter.xposter.time.time', return_value=time.time() + RETRY_CAP_SECONDS):
+            xpost(self.xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_args_list[2:], [
+            call(status="test 3", media_ids=[]),
+            call(status="test 4", media_ids=[]),
+        ])
+
+        store = StateStore(self.xpost_config.sqlite_file)
+        self.assertEqual(store.get_pending_outbox(feed_name), [])
+        store.close()
+
+    def test_backoff_seconds(self):
+        for attempts, delay in [(1, 30), (2, 60), (3, 120), (20, RETRY_CAP_SECONDS)]:
+            self.assertTrue(delay / 2 <= backoff_seconds(attempts, 30) <= delay)
+        self.assertEqual(backoff_seconds(3, 0), 0)
+
+    @patch('mastodon.Mastodon')
+    def test_xpost_many_async(self, mock_Mastodon):
+        handles = ['alice', 'bob', 'carol']
+        configs = [
+            dataclasses.replace(self.xpost_config, twitter_handle=handle, retry_base_seconds=0)
+            for handle in handles
+        ]
+        feeds = {handle: [TestItem(f"<p>{handle} 1</p>", 1)] for handle in handles}
+        in_flight = {'count': 0, 'max': 0}
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            in_flight['count'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['count'])
+            try:
+                await asyncio.sleep(0.05)
+                if request.url.path.startswith('/pic/'):
+                    return httpx.Response(200, headers={'Content-Type': 'image/png'}, content=request.url.path.encode())
+                handle = request.url.path.split('/')[1]
+                body = _response_with_items(feeds[handle]).replace('twitter_handle', handle)
+                return httpx.Response(200, headers={'Content-Type': 'application/rss+xml'}, text=body)
+            finally:
+                in_flight['count'] -= 1
+
+        mock_mastodon = mock_Mastodon.return_value
+        posted = []
+        mock_mastodon.status_post.side_effect = lambda status, media_ids: posted.append((status, media_ids))
+        mock_mastodon.media_post.side_effect = lambda f, mime_type: {'id': f.read().decode()}
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http:
+                return await xpost_many_async(configs, 3, per_host_concurrency=2, http=http)
+
+        self.assertEqual(asyncio.run(run()), 0)
+        self.assertEqual(posted, [])
+
+        for handle in handles:
+            feeds[handle] = [
+                TestItem(f"<p>{handle} {i}</p><img src=\"http://nitter.example.com/pic/{handle}{i}.png\" />", i)
+                for i in range(4, 1, -1)
+            ] + feeds[handle]
+        self.assertEqual(asyncio.run(run()), 0)
+
+        # Statuses of each handle are posted in order, while requests to Nitter are limited to 2 at once
+        for handle in handles:
+            self.assertEqual([p for p in posted if p[0].startswith(handle)], [
+                (f"{handle} {i}", [f"/pic/{handle}{i}.png"]) for i in range(2, 5)
+            ])
+        self.assertEqual(len(posted), 9)
+        self.assertEqual(in_flight['max'], 2)
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_xpost_nitter_pool(self, mock_Mastodon):
+        mock_mastodon = mock_Mastodon.return_value
+        xpost_config = copy.copy(self.xpost_config)
+        xpost_config.nitter_host = 'nitter.example.com, nitter2.example.com'
+
+        def add_response(host, body, status=200, delay=0):
+            def callback(request):
+                time.sleep(delay)
+                return status, {'Content-Type': 'application/rss+xml'}, body.replace('nitter.example.com', host)
+            responses.add_callback(responses.GET, f'https://{host}/twitter_handle/rss', callback=callback)
+
+        add_response('nitter.example.com', _response("<p>test 1</p>"))
+        xpost(xpost_config)
+
+        # Hosts that were never tried are tried first, and failed over from when they error
+        time.sleep(1)
+        responses.reset()
+        add_response('nitter2.example.com', 'Rate limited', status=429)
+        add_response('nitter.example.com', _response_with_items([
+            TestItem("<p>test 2</p>", 2),
+            TestItem("<p>test 1</p>", 1),
+        ]))
+        xpost(xpost_config)
+        mock_mastodon.status_post.assert_called_once_with(status="test 2", media_ids=[])
+
+        store = StateStore(xpost_config.sqlite_file)
+        self.assertEqual(store.get_nitter_health('nitter2.example.com')[:2], (None, 1.0))
+        self.assertEqual(NitterPool(store, xpost_config.nitter_hosts()).ranked(), ['nitter.example.com', 'nitter2.example.com'])
+        store.close()
+
+        # A slow host is hedged with a request to the next one, and entries are the same whichever host serves the feed
+        time.sleep(1)
+        responses.reset()
+        add_response('nitter.example.com', _response("<p>test 3</p>"), delay=1)
+        add_response('nitter2.example.com', _response_with_items([
+            TestItem("<p>test 3 <a href=\"http://nitter2.example.com/search?q=%23hashtag\">#hashtag</a></p>", 3),
+            TestItem("<p>test 2</p>", 2),
+        ]))
+        with patch('nitter_xposter.nitter_pool.MIN_HEDGE_DELAY_SECONDS', 0.1):
+            xpost(xpost_config)
+        self.assertEqual(mock_mastodon.status_post.call_args_list[1:], [
+            call(status="test 3 https://twitter.com/search?q=%23hashtag", media_ids=[])
+        ])
+
+    def test_nitter_pool(self):
+        store = StateStore(f"test_{uuid.uuid4()}.db")
+        pool = NitterPool(store, ['a', 'b', 'c'])
+        pool.record('a', 0.5, now=100)
+        pool.record('b', 0.2, now=100)
+        pool.record('c', None, now=100)
+        self.assertEqual(pool.ranked(now=100), ['b', 'a', 'c'])
+        # An unhealthy host gets another chance after a while
+        self.assertEqual(pool.ranked(now=100 + 60 * 60), ['c', 'b', 'a'])
+        self.assertEqual(pool.hedge_delay('a'), 2)
+        pool.record('a', 1.5, now=101)
+        self.assertAlmostEqual(pool.hedge_delay('a'), 3 * (0.3 * 1.5 + 0.7 * 0.5))
+        # Health is persisted
+        self.assertEqual(NitterPool(store, ['a', 'b', 'c']).ranked(now=100), ['b', 'a', 'c'])
+        store.close()
+
+    def test_migrate_to_host_independent_keys(self):
+        sqlite_file = f"test_{uuid.uuid4()}.db"
+        conn = sqlite3.connect(sqlite_file)
+        cursor = conn.cursor()
+        for migration in MIGRATIONS[:3]:
+            migration(cursor)
+        cursor.execute('PRAGMA user_version = 3')
+        cursor.execute("INSERT INTO last_position VALUES ('https://nitter.example.com/alice/rss', 'http://nitter.example.com/alice/status/1#m')")
+        cursor.execute("INSERT INTO last_position VALUES ('bsky:http://nitter.example.com/alice/rss', 'http://nitter.example.com/alice/status/2#m')")
+        cursor.execute("INSERT INTO feed_validators VALUES ('https://nitter.example.com/alice/rss', 'etag', NULL, 'hash', 'http://nitter.example.com/alice/status/2#m')")
+        cursor.execute(
+            "INSERT INTO outbox (feed_name, entry_id, entry) VALUES ('bsky:https://nitter.example.com/alice/rss', 'http://nitter.example.com/alice/status/3#m', ?)",
+            ('{"id": "http://nitter.example.com/alice/status/3#m", "text": "test 3", "rt": null, "image_urls": []}',)
+        )
+        conn.commit()
+        conn.close()
+
+        store = StateStore(sqlite_file)
+        self.assertEqual(store.get_last_position('nitter:alice'), '/alice/status/1#m')
+        self.assertEqual(store.get_last_position('bsky:nitter:alice'), '/alice/status/2#m')
+        self.assertEqual(store.get_feed_validators('nitter:alice'), ('etag', None, 'hash', '/alice/status/2#m'))
+        pending = store.get_pending_outbox('bsky:nitter:alice')
+        self.assertEqual(len(pending), 1)
+        self.assertIn('"id": "/alice/status/3#m"', pending[0][1])
+        store.close()
+
+    def _add_page(self, items: List[TestItem], cursor: str = None, min_id: str = None, status: int = 200):
+        responses.add(
+            responses.GET,
+            'https://nitter.example.com/twitter_handle/rss',
+            status=status,
+            content_type='application/rss+xml',
+            headers={'Min-Id': min_id} if min_id else {},
+            body=_response_with_items(items),
+            match=[matchers.query_param_matcher({'cursor': cursor} if cursor else {})]
+        )
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_backfill(self, mock_Mastodon):
+        mock_mastodon = mock_Mastodon.return_value
+        # The regular crawl only marks the first page as seen
+        self._add_page([TestItem("<p>test 10</p>", 10), TestItem("<p>test 9</p>", 9)])
+        xpost(self.xpost_config)
+        mock_mastodon.status_post.assert_not_called()
+        # A newer status is queued before the backfill, and still sent after the backfilled ones
+        self._add_page([TestItem(f"<p>test {i}</p>", i) for i in (13, 10, 9)])
+        xpost(self.xpost_config, deliver=False)
+
+        responses.reset()
+        self._add_page([TestItem(f"<p>test {i}</p>", i) for i in (13, 12, 11, 10, 9)], min_id='c1')
+        self._add_page([TestItem(f"<p>test {i}</p>", i) for i in (8, 7, 6)], cursor='c1', min_id='c2')
+        self._add_page([], cursor='c2', status=502)
+        self._add_page([TestItem(f"<p>test {i}</p>", i) for i in (5, 4)], cursor='c2', min_id='c3')
+
+        # Nitter failing on the third page leaves the backfill to be resumed, without sending anything
+        with self.assertRaises(NitterFetchError):
+            backfill(self.xpost_config, 5, None)
+        mock_mastodon.status_post.assert_not_called()
+
+        backfill(self.xpost_config, 5, None)
+        self.assertEqual(
+            [c.kwargs['status'] for c in mock_mastodon.status_post.call_args_list],
+            ["test 6", "test 7", "test 8", "test 11", "test 12", "test 13"]
+        )
+        # The first two pages were fetched once, and the resumed backfill went on from the third
+        self.assertEqual([c.request.params.get('cursor') for c in responses.calls], [None, 'c1', 'c2', 'c2'])
+
+        store = StateStore(self.xpost_config.sqlite_file)
+        self.assertIsNone(store.get_backfill('nitter:twitter_handle'))
+        self.assertEqual(store.get_backfill_entries('nitter:twitter_handle'), [])
+        store.close()
+
+    @patch('mastodon.Mastodon')
+    @responses.activate
+    def test_backfill_retweets(self, mock_Mastodon):
+        mock_mastodon = mock_Mastodon.return_value
+        self._add_page([TestItem("<p>test 10</p>", 10)])
+        xpost(self.xpost_config)
+
+        # Retweets have the ids of the retweeted statuses, so they are backfilled by when they were retweeted,
+        # and a page of them doesn't stop the backfill
+        responses.reset()
+        self._add_page([TestItem("<p>test 10</p>", 10), TestItem("<p>test 1</p>", 1, rt_twitter_handle='rt_twitter_handle')], min_id='c1')
+        self._add_page([TestItem("<p>test 2</p>", 2, rt_twitter_handle='rt_twitter_handle')], cursor='c1', min_id='c2')
+        self._add_page([TestItem("<p>test 7</p>", 7), TestItem("<p>test 6</p>", 6)], cursor='c2', min_id='c3')
+        self._add_page([TestItem("<p>test 5</p>", 5), TestItem("<p>test 3</p>", 3, rt_twitter_handle='rt_twitter_handle')], cursor='c3', min_id='c4')
+        backfill(self.xpost_config, 5, None)
+        # Sent in the order of the timeline rather than by status id
+        self.assertEqual([c.kwargs['status'] for c in mock_mastodon.status_post.call_args_list], [
+            "test 3\nRT: https://twitter.com/rt_twitter_handle/status/3#m",
+            "test 6",
+            "test 7",
+            "test 2\nRT: https://twitter.com/rt_twitter_handle/status/2#m",
+            "test 1\nRT: https://twitter.com/rt_twitter_handle/status/1#m",
+        ])
+        self.assertEqual([c.request.params.get('cursor') for c in responses.calls], [None, 'c1', 'c2', 'c3'])
+        self.assertEqual(
+            datetime.fromtimestamp(status_time(1751234567890123456), timezone.utc),
+            datetime(2024, 1, 27, 13, 23, 52, 6000, timezone.utc)
+        )
+
+    def test_parse_backfill_since(self):
+        self.assertEqual(parse_backfill_since("1751234567890123456"), (1751234567890123456, None))
+        self.assertEqual(parse_backfill_since("2024-01-31"), (None, 1706659200.0))
+        self.assertEqual(parse_backfill_since("2024-01-31T09:00:00+09:00"), (None, 1706659200.0))
+
     @classmethod
     def tearDownClass(cls):
-        test_db_files = glob.glob('test_*.db')
+        test_db_files = glob.glob('test_*.db*')
         for file in test_db_files:
             os.remove(file)
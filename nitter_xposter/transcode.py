@@ -0,0 +1,162 @@
+import math
+import logging
+import threading
+import functools
+import multiprocessing
+from collections import OrderedDict
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+from .media import Media
+
+TRANSCODE_WORKERS = 2
+TRANSCODE_TIMEOUT_SECONDS = 60
+# Transcoded images are kept in memory up to this many bytes, so that an image posted by several accounts is only transcoded once
+TRANSCODE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+JPEG_QUALITIES = (90, 80, 70, 60, 50)
+# Images are scaled down by this much whenever the lowest quality is still too large
+DOWNSCALE_STEP = 0.75
+# Metadata that is dropped from images, e.g. the location a photo was taken at
+STRIPPED_INFO_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+
+
+@dataclass(frozen=True)
+class MediaLimits:
+    """
+    The largest image a target accepts, in bytes and in pixels
+    """
+    max_bytes: int
+    max_pixels: int
+
+
+# Mastodon accepts images of up to 16MB and scales them down to 3840x2160 pixels anyway
+MASTODON_MEDIA_LIMITS = MediaLimits(max_bytes=16 * 1024 * 1024, max_pixels=3840 * 2160)
+# Bluesky rejects blobs over 1MB, and its own app uploads images of at most 2000x2000 pixels
+BSKY_MEDIA_LIMITS = MediaLimits(max_bytes=1000 * 1000, max_pixels=2000 * 2000)
+
+
+def needs_transcoding(media: Media, limits: MediaLimits) -> bool:
+    # Opening an image only reads its header, so this is cheap enough to run before deciding to use the process pool
+    from PIL import Image, UnidentifiedImageError
+    if media.size > limits.max_bytes:
+        return True
+    try:
+        with media.open() as f, Image.open(f) as image:
+            if getattr(image, 'is_animated', False):
+                return False
+            return image.width * image.height > limits.max_pixels \
+                or any(key in image.info for key in STRIPPED_INFO_KEYS)
+    except (UnidentifiedImageError, OSError):
+        # Not an image Pillow knows, e.g. a video
+        return False
+
+
+def transcode_image(media: Media, limits: MediaLimits) -> Optional[Tuple[bytes, str]]:
+    """
+    Scales down and recompresses an image until it fits the limits, without its metadata.
+    Returns the new image and its MIME type, or None if it should be uploaded as it is.
+    Runs in the process pool, so it only takes and returns picklable values
+    """
+    import io
+    from PIL import Image, ImageOps
+    with media.open() as f, Image.open(f) as image:
+        if getattr(image, 'is_animated', False):
+            return None
+        source_format = image.format
+        icc_profile = image.info.get('icc_profile')
+        # Rotate the image as its EXIF orientation says, as the EXIF data is dropped
+        image = ImageOps.exif_transpose(image)
+        if image.mode == 'CMYK':
+            # The color profile of a CMYK image doesn't apply once it is converted to RGB
+            icc_profile = None
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+        def encode(image: Image.Image, format: str, **params) -> bytes:
+            out = io.BytesIO()
+            image.save(out, format=format, icc_profile=icc_profile, **params)
+            return out.getvalue()
+
+        scale = min(1.0, math.sqrt(limits.max_pixels / (image.width * image.height)))
+        while True:
+            size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+            resized = image.resize(size, Image.LANCZOS) if size != image.size else image
+            # PNGs are kept as they are lossless, e.g. for screenshots, unless they don't fit as a PNG
+            if source_format == 'PNG':
+                data = encode(resized, 'PNG', optimize=True)
+                if len(data) <= limits.max_bytes:
+                    return data, 'image/png'
+            if has_alpha:
+                background = Image.new('RGB', resized.size, (255, 255, 255))
+                background.paste(resized, mask=resized.convert('RGBA').getchannel('A'))
+                resized = background
+            elif resized.mode != 'RGB':
+                resized = resized.convert('RGB')
+            for quality in JPEG_QUALITIES:
+                data = encode(resized, 'JPEG', quality=quality, optimize=True)
+                if len(data) <= limits.max_bytes:
+                    return data, 'image/jpeg'
+            scale *= DOWNSCALE_STEP
+
+
+@functools.lru_cache(maxsize=None)
+def get_transcode_pool() -> ProcessPoolExecutor:
+    # Workers are spawned rather than forked because the process runs other threads, and only once an image needs transcoding
+    return ProcessPoolExecutor(max_workers=TRANSCODE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+class TranscodeCache:
+    """
+    Keeps the most recently transcoded images by the content hash of the original image and the limits they were fit to
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._images = OrderedDict()  # type: OrderedDict[Tuple[str, MediaLimits], Tuple[bytes, str]]
+        self._bytes = 0
+
+    def get(self, key: Tuple[str, MediaLimits]) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            if key not in self._images:
+                return None
+            self._images.move_to_end(key)
+            return self._images[key]
+
+    def set(self, key: Tuple[str, MediaLimits], image: Tuple[bytes, str]):
+        with self._lock:
+            if key in self._images:
+                return
+            self._images[key] = image
+            self._bytes += len(image[0])
+            while self._bytes > self.max_bytes and self._images:
+                _, (data, _) = self._images.popitem(last=False)
+                self._bytes -= len(data)
+
+
+_transcode_cache = TranscodeCache(TRANSCODE_CACHE_MAX_BYTES)
+
+
+def fit_media(media: Media, limits: MediaLimits) -> Media:
+    # Returns the media as it is if it already fits the limits of the target, or if it could not be transcoded
+    try:
+        if not needs_transcoding(media, limits):
+            return media
+        key = (media.content_hash(), limits)
+        transcoded = _transcode_cache.get(key)
+        if transcoded is None:
+            transcoded = get_transcode_pool().submit(transcode_image, media, limits).result(timeout=TRANSCODE_TIMEOUT_SECONDS)
+            if transcoded is None:
+                return media
+            _transcode_cache.set(key, transcoded)
+    except BrokenProcessPool as e:
+        # A worker died, e.g. out of memory, so start over with a new pool next time
+        get_transcode_pool.cache_clear()
+        logging.warning(f"Error transcoding {media}, uploading it as it is: {e}")
+        return media
+    except Exception as e:
+        logging.warning(f"Error transcoding {media}, uploading it as it is: {e}")
+        return media
+    data, mime_type = transcoded
+    logging.info(f"Transcoded {media} to {mime_type}, {len(data)} bytes")
+    return Media(url=media.url, mime_type=mime_type, size=len(data), data=data)
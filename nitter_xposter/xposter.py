@@ -1,24 +1,52 @@
-import os
-import tempfile
+import re
+import time
+import hashlib
+import threading
 import requests
+import requests.adapters
 import feedparser
 import html
 import logging
-from typing import Optional, List
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, List, Tuple
 from dataclasses import dataclass
-from bs4 import BeautifulSoup
-from mastodon import Mastodon
+from concurrent.futures import Future, ThreadPoolExecutor
+from html.parser import HTMLParser
 from urllib.parse import urlparse, urlunparse
-from atproto import Client
-from .db import setup_database, get_last_position, set_last_position
-from .mastodon import upload_media_to_mastodon, post_to_mastodon
-from .bsky import upload_media_to_bsky, post_to_bsky
+from .db import StateStore
 from .parsed_entry import ParsedEntry
+from .nitter_pool import NitterPool, fetch_feed
+from .media import Media, DownloadError, download_image, cleanup_media, DEFAULT_SPILL_BYTES
+from .outbox import (
+    dump_parsed_entry, load_parsed_entry, backoff_seconds, PartiallySentError,
+    DEFAULT_RETRY_BASE_SECONDS, MAX_DELIVERY_ATTEMPTS, FAILED_RETENTION_SECONDS
+)
+from .metrics import (
+    FEED_BYTES, FEED_PARSE_SECONDS, IMAGE_DOWNLOAD_SECONDS, MEDIA_TRANSCODE_SECONDS, MEDIA_UPLOAD_SECONDS, POST_SECONDS,
+    STATUSES_QUEUED, STATUSES_SENT, FAILURES, OUTBOX_SIZE, OUTBOX_LAG_SECONDS
+)
+from .transcode import MediaLimits, fit_media, MASTODON_MEDIA_LIMITS, BSKY_MEDIA_LIMITS
+from .ratelimit import RateLimit, RateLimitedError, TokenBucket, MASTODON_STATUS_RATE_LIMIT, BSKY_STATUS_RATE_LIMIT
+
+if TYPE_CHECKING:
+    # The SDK of each target is only imported once that target is configured, atproto alone takes a second to import
+    from mastodon import Mastodon
+    from atproto import Client
+
+REQUEST_TIMEOUT_SECONDS = 30
+IMAGE_DOWNLOAD_CONCURRENCY = 4
+# Images of the next statuses of a target are uploaded this many at a time, up to this many statuses ahead of the one being sent
+MEDIA_UPLOAD_CONCURRENCY = 4
+MEDIA_UPLOAD_AHEAD = 8
+# Statuses are remembered as seen for this long after they were last in the feed
+SEEN_RETENTION_SECONDS = 30 * 24 * 60 * 60
+
+STATUS_ID_PATTERN = re.compile(r'/status/(\d+)')
 
 
 @dataclass
 class XpostConfig:
     sqlite_file: str
+    # One Nitter host, or several separated by commas to fail over between them
     nitter_host: str
     nitter_https: bool
     twitter_handle: str
@@ -30,6 +58,10 @@ class XpostConfig:
     bsky_handle: Optional[str]
     bsky_password: Optional[str]
     bsky_status_limit: int
+    # Images larger than this are written to a tmp file instead of being kept in memory
+    media_spill_bytes: int = DEFAULT_SPILL_BYTES
+    # Base of the exponential backoff between attempts to send a status
+    retry_base_seconds: float = DEFAULT_RETRY_BASE_SECONDS
 
     def is_mastodon(self):
         return self.mastodon_host \
@@ -40,67 +72,94 @@ class XpostConfig:
     def is_bsky(self):
         return self.bsky_handle and self.bsky_password
 
+    def nitter_hosts(self) -> List[str]:
+        return [host.strip() for host in self.nitter_host.split(',') if host.strip()]
 
-def convert_description_to_text(description, nitter_host):
-    # Use BeautifulSoup to parse the HTML content
-    soup = BeautifulSoup(description, "html.parser")
 
-    # Find all anchor tags and replace them with their URL
-    for a in soup.find_all('a'):
-        if a.has_attr('href'):
-            href = a['href']
-            parsed_href = urlparse(href)
-            if parsed_href.netloc == nitter_host:
-                # nitter replaces Twitter links such as hashtags with (http) nitter links, but we want canonical twitter links
-                # so that a user can choose to use Twitter as-is,
-                # or uses an alternative frontend redirecting extension that redirects to another nitter instance of their choice
-                parsed_href = parsed_href._replace(netloc='twitter.com')
-                parsed_href = parsed_href._replace(scheme='https')
-            a.replace_with(urlunparse(parsed_href))
-
-    # Extract text, which now includes URLs in place of anchor tags
-    text = soup.get_text()
-
-    # Convert HTML entities to normal text
-    text = html.unescape(text)
-
-    return text
-
-
-def find_images_in_description(description):
-    # Use BeautifulSoup to parse the HTML content
-    soup = BeautifulSoup(description, "html.parser")
-
-    # Find all image tags and return their URLs
-    image_urls = []
-    for img in soup.find_all('img'):
-        if img.has_attr('src'):
-            image_urls.append(img['src'])
-
-    return image_urls
+@dataclass
+class XpostClients:
+    store: StateStore
+    session: requests.Session
+    mastodon: Optional['Mastodon'] = None
+    bsky: Optional['Client'] = None
 
 
-def download_image_to_tmp_file(url: str) -> Optional[str]:
-    # TODO: assumes nitter uses jpg?
-    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as f:
-        logging.info("Downloading image from nitter: " + url)
-        res = requests.get(url)
-        if res.status_code >= 400:
-            logging.error("Image downloading encountered with >= 400 status code, aborting: " + url)
-            return None
-        f.write(res.content)
-        return f.name
+def canonicalize_href(href: str, nitter_host: str) -> str:
+    parsed_href = urlparse(href)
+    if parsed_href.netloc == nitter_host:
+        # nitter replaces Twitter links such as hashtags with (http) nitter links, but we want canonical twitter links
+        # so that a user can choose to use Twitter as-is,
+        # or uses an alternative frontend redirecting extension that redirects to another nitter instance of their choice
+        parsed_href = parsed_href._replace(netloc='twitter.com')
+        parsed_href = parsed_href._replace(scheme='https')
+    return urlunparse(parsed_href)
+
+
+class DescriptionParser(HTMLParser):
+    """
+    Extracts the text and the image URLs of a Nitter description in a single streaming pass,
+    replacing each anchor tag with its (canonicalized) URL
+    """
+    def __init__(self, nitter_host: str):
+        super().__init__(convert_charrefs=True)
+        self.nitter_host = nitter_host
+        self.text_parts = []  # type: List[str]
+        self.image_urls = []  # type: List[str]
+        # Number of open anchor tags whose content is being replaced by their URL
+        self._replaced_anchor_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            if self._replaced_anchor_depth:
+                self._replaced_anchor_depth += 1
+                return
+            href = dict(attrs).get('href', False)
+            if href is not False:
+                self.text_parts.append(canonicalize_href(href or '', self.nitter_host))
+                self._replaced_anchor_depth = 1
+        elif tag == 'img':
+            src = dict(attrs).get('src', False)
+            if src is not False:
+                self.image_urls.append(src or '')
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._replaced_anchor_depth:
+            self._replaced_anchor_depth -= 1
+
+    def handle_data(self, data):
+        if not self._replaced_anchor_depth:
+            self.text_parts.append(data)
+
+
+def parse_description(description: str, nitter_host: str) -> Tuple[str, List[str]]:
+    parser = DescriptionParser(nitter_host)
+    parser.feed(description)
+    parser.close()
+
+    # Convert HTML entities that were escaped twice to normal text
+    text = html.unescape(''.join(parser.text_parts))
+
+    return text, parser.image_urls
+
+
+@dataclass(slots=True)
+class FeedEntry:
+    """
+    The fields of a feedparser entry that are used, so that the rest of the parsed feed can be released right away
+    """
+    id: str
+    description: Optional[str]
+    author: Optional[str]
+    link: Optional[str]
 
 
 def parse_feed_entry(entry, twitter_handle, nitter_host: str) -> ParsedEntry:
-    parsed_entry = ParsedEntry(entry.id, None, None, [], [], [], [])
+    # `entry` is a FeedEntry or a feedparser entry
+    parsed_entry = ParsedEntry(entry.id, None, None, ())
     if entry.description:
-        # Parse text
-        text = convert_description_to_text(entry.description, nitter_host)
-        parsed_entry.text = text
-
-        # Parse images
-        parsed_entry.image_urls = find_images_in_description(entry.description)
+        # Parse text and images
+        parsed_entry.text, image_urls = parse_description(entry.description, nitter_host)
+        parsed_entry.image_urls = tuple(image_urls)
 
     if entry.author and entry.author != f"@{twitter_handle}" and entry.link:
         # Parse RT
@@ -116,126 +175,596 @@ def parse_feed_entry(entry, twitter_handle, nitter_host: str) -> ParsedEntry:
     return parsed_entry
 
 
-def cleanup_tmp_file(image_file: str):
-    print(f"Cleaning up tmp file {image_file}")
-    os.remove(image_file)
-
+def mastodon_client_key(config: XpostConfig) -> tuple:
+    return config.mastodon_host, config.mastodon_client_id, config.mastodon_access_token
+
+
+def mastodon_account(config: XpostConfig) -> str:
+    # Several users can authorize the same app, so the account goes by the access token of the user,
+    # which is hashed so that it is not kept in the store
+    token_hash = hashlib.sha256(config.mastodon_access_token.encode('utf-8')).hexdigest()[:16]
+    return f"mastodon:{config.mastodon_host}:{token_hash}"
+
+
+# Guards creating a Mastodon client that is shared by several feeds
+_mastodon_clients_lock = threading.Lock()
+
+
+def create_clients(config: XpostConfig, store: Optional[StateStore] = None, mastodon_clients: Optional[Dict[tuple, 'Mastodon']] = None) -> XpostClients:
+    # Determine target social networks to crosspost to
+    if not config.is_mastodon() and not config.is_bsky():
+        raise Exception("Must specify Mastodon or bsky credentials, or both.")
+    if not config.nitter_hosts():
+        raise Exception("Must specify at least one Nitter host.")
+
+    # The session is shared by RSS and image requests to the same Nitter host so that connections are kept alive
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=IMAGE_DOWNLOAD_CONCURRENCY + len(config.nitter_hosts()))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # The store is shared when several accounts use the same SQLite file
+    if store is None:
+        store = StateStore(config.sqlite_file)
+    clients = XpostClients(store=store, session=session)
+    if config.is_mastodon():
+        # Creating a client looks up the version of the instance, so feeds posting to the same Mastodon account
+        # share one client and its connection pool, which has room for the concurrent uploads and the status
+        with _mastodon_clients_lock:
+            if mastodon_clients is not None and mastodon_client_key(config) in mastodon_clients:
+                clients.mastodon = mastodon_clients[mastodon_client_key(config)]
+            else:
+                from mastodon import Mastodon
+                mastodon_session = requests.Session()
+                mastodon_adapter = requests.adapters.HTTPAdapter(pool_maxsize=MEDIA_UPLOAD_CONCURRENCY + 1)
+                mastodon_session.mount('http://', mastodon_adapter)
+                mastodon_session.mount('https://', mastodon_adapter)
+                clients.mastodon = Mastodon(
+                    client_id=config.mastodon_client_id,
+                    client_secret=config.mastodon_client_secret,
+                    access_token=config.mastodon_access_token,
+                    api_base_url=f"https://{config.mastodon_host}",
+                    # Instead of sleeping until the rate limit resets, raise so that the status is retried in a later run
+                    ratelimit_method='throw',
+                    session=mastodon_session
+                )
+                if mastodon_clients is not None:
+                    mastodon_clients[mastodon_client_key(config)] = clients.mastodon
+    if config.is_bsky():
+        from atproto import Client
+        from .bsky import login_to_bsky
+        clients.bsky = Client()
+        login_to_bsky(clients.bsky, store, config.bsky_handle, config.bsky_password)
+    return clients
+
+
+class SharedImages:
+    """
+    Downloads each image at most once per crawl so that all targets upload the same bytes.
+    Images can be prefetched concurrently while statuses are still sent one by one
+    """
+    def __init__(self, session: requests.Session, spill_bytes: int):
+        self.session = session
+        self.spill_bytes = spill_bytes
+        self._lock = threading.Lock()
+        self._images = {}  # type: Dict[str, Future]
+        self._executor = ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_CONCURRENCY, thread_name_prefix='image')
+
+    def _download(self, image_url: str) -> Media:
+        with IMAGE_DOWNLOAD_SECONDS.time(host=urlparse(image_url).netloc):
+            return download_image(image_url, self.session, self.spill_bytes, REQUEST_TIMEOUT_SECONDS)
+
+    def prefetch(self, image_urls: List[str]):
+        with self._lock:
+            for image_url in image_urls:
+                if image_url not in self._images:
+                    self._images[image_url] = self._executor.submit(self._download, image_url)
+
+    def get(self, image_url: str) -> Media:
+        # Raises DownloadError if the image could not be downloaded
+        self.prefetch([image_url])
+        return self._images[image_url].result()
+
+    def cleanup(self):
+        # Deletes the images that were spilled to disk, once they are all downloaded
+        self._executor.shutdown(wait=True)
+        for future in self._images.values():
+            if future.exception() is None:
+                cleanup_media(future.result())
+
+
+# Mastodon deletes media that isn't attached to a status after a day, and ignores media that is already attached to one
+MASTODON_UNPOSTED_MEDIA_TTL_SECONDS = 12 * 60 * 60
+MASTODON_POSTED_MEDIA_TTL_SECONDS = None
+# Bluesky deletes blobs that aren't referenced by a record soon, but blobs that are can be referenced again
+BSKY_UNPOSTED_MEDIA_TTL_SECONDS = 30 * 60
+BSKY_POSTED_MEDIA_TTL_SECONDS = 7 * 24 * 60 * 60
+MEDIA_CACHE_MAX_ENTRIES = 1000
+# atproto's Client talks to bsky.social until it is pointed to another PDS
+BSKY_HOST = 'bsky.social'
 
-def xpost(config: XpostConfig):
-    logging.info("Started crosspost")
-    setup_database(config.sqlite_file)
 
-    # Determine target social network to crosspost to
-    if config.is_mastodon() and not config.is_bsky():
-        mastodon = Mastodon(
-            client_id=config.mastodon_client_id,
-            client_secret=config.mastodon_client_secret,
-            access_token=config.mastodon_access_token,
-            api_base_url=f"https://{config.mastodon_host}"
-        )
-    elif config.is_bsky() and not config.is_mastodon():
-        bsky = Client()
-        bsky.login(config.bsky_handle, config.bsky_password)
-    else:
-        raise Exception("Must specify either Mastodon or bsky credentials. Cannot specify both or neither.")
-
-    # Parsing the RSS feed
-    if config.nitter_https:
-        rss_url = f"https://{config.nitter_host}/{config.twitter_handle}/rss"
-    else:
-        rss_url = f"http://{config.nitter_host}/{config.twitter_handle}/rss"
-    try:
-        res = requests.get(rss_url)
-    except Exception as e:
-        # TODO: handle error
-        logging.error("Error retrieving tweets, aborting: " + str(e))
-        return 
-    feed = feedparser.parse(res.text)
-
-    parsed_entries = []  # type: List[ParsedEntry]
-    if feed.bozo == 0:
-        for entry in feed.entries:
-            parsed_entry = parse_feed_entry(entry, config.twitter_handle, config.nitter_host)
-            parsed_entries.append(parsed_entry)
+@dataclass
+class Target:
+    name: str
+    # Identifies the account on the target, as several accounts can share a SQLite file
+    account: str
+    # Host that requests to the target go to
+    host: str
+    # Maximum number of statuses sent per run, or 0 to only be limited by rate_limit
+    status_limit: int
+    rate_limit: RateLimit
+    # Images are scaled down and recompressed to fit these before they are uploaded
+    media_limits: MediaLimits
+    # Returns the uploaded media, and raises if the upload failed
+    upload_media: Callable[[Media], Any]
+    # Sends a status with the media uploaded for its images, or the rest of a status that was partly sent from its progress,
+    # and raises if the status could not be sent
+    post: Callable[[ParsedEntry, List[Any], Optional[str]], None]
+    # Returns whether an error raised by upload_media or post is worth trying again
+    is_transient: Callable[[Exception], bool]
+    # Converts uploaded media to and from what is saved in the media cache
+    dump_media: Callable[[Any], str]
+    load_media: Callable[[str], Any]
+    # How long uploaded media can be reused before and after it is posted, None if it cannot be reused
+    unposted_media_ttl_seconds: float
+    posted_media_ttl_seconds: Optional[float]
+    # Accounts that seen statuses and the outbox used to be kept under, most recent first
+    legacy_accounts: Tuple[str, ...] = ()
+
+
+def build_targets(config: XpostConfig, clients: XpostClients) -> List[Target]:
+    targets = []
+    if clients.mastodon:
+        from .mastodon import upload_media_to_mastodon, post_to_mastodon, is_transient_mastodon_error
+        mastodon = clients.mastodon
+        targets.append(Target(
+            name='mastodon',
+            account=mastodon_account(config),
+            host=config.mastodon_host,
+            status_limit=config.mastodon_status_limit,
+            rate_limit=MASTODON_STATUS_RATE_LIMIT,
+            media_limits=MASTODON_MEDIA_LIMITS,
+            upload_media=lambda media: upload_media_to_mastodon(media, mastodon),
+            post=lambda parsed_entry, media_ids, progress: post_to_mastodon(parsed_entry, media_ids, mastodon),
+            is_transient=is_transient_mastodon_error,
+            dump_media=str,
+            load_media=str,
+            unposted_media_ttl_seconds=MASTODON_UNPOSTED_MEDIA_TTL_SECONDS,
+            posted_media_ttl_seconds=MASTODON_POSTED_MEDIA_TTL_SECONDS,
+            legacy_accounts=(f"mastodon:{config.mastodon_host}:{config.mastodon_client_id}",),
+        ))
+    if clients.bsky:
+        from .bsky import upload_media_to_bsky, post_to_bsky, dump_bsky_blob, load_bsky_blob, is_transient_bsky_error
+        bsky = clients.bsky
+        targets.append(Target(
+            name='bsky',
+            account=f"bsky:{config.bsky_handle}",
+            host=BSKY_HOST,
+            status_limit=config.bsky_status_limit,
+            rate_limit=BSKY_STATUS_RATE_LIMIT,
+            media_limits=BSKY_MEDIA_LIMITS,
+            upload_media=lambda media: upload_media_to_bsky(media, bsky),
+            post=lambda parsed_entry, blobs, progress: post_to_bsky(parsed_entry, blobs, bsky, progress),
+            is_transient=is_transient_bsky_error,
+            dump_media=dump_bsky_blob,
+            load_media=load_bsky_blob,
+            unposted_media_ttl_seconds=BSKY_UNPOSTED_MEDIA_TTL_SECONDS,
+            posted_media_ttl_seconds=BSKY_POSTED_MEDIA_TTL_SECONDS,
+        ))
+    for target in targets:
+        adopt_legacy_feed(clients.store, feed_key_of(config), target)
+    return targets
+
+
+def get_or_upload_media(store: StateStore, feed_key: str, target: Target, image_url: str, images: SharedImages, hash_lock: Callable[[str], threading.Lock]) -> Any:
+    # `hash_lock` returns a lock per content hash, held while an image is looked up in the media cache and uploaded,
+    # so that an image under several URLs that are uploaded at once is only uploaded once
+    # Reuse media uploaded from the same URL without downloading it again, e.g. when retrying a failed status
+    now = time.time()
+    cached_media = store.get_cached_media_by_url(target.account, image_url, now)
+    if cached_media is not None:
+        logging.info(f"Reusing media uploaded to {target.name} for {image_url}")
+        return target.load_media(cached_media)
+
+    # Download image, or reuse it if another target already did
+    image = images.get(image_url)
+
+    # Reuse media uploaded from the same image under another URL, e.g. in a retweet
+    content_hash = image.content_hash()
+    with hash_lock(content_hash):
+        cached_media = store.get_cached_media_by_content_hash(target.account, content_hash, now)
+        if cached_media is None:
+            with MEDIA_TRANSCODE_SECONDS.time(feed=feed_key, target=target.name):
+                image = fit_media(image, target.media_limits)
+            with MEDIA_UPLOAD_SECONDS.time(feed=feed_key, target=target.name):
+                media = target.upload_media(image)
+            cached_media = target.dump_media(media)
+        else:
+            logging.info(f"Reusing media uploaded to {target.name} for the same image as {image_url}")
+            media = target.load_media(cached_media)
+        store.set_cached_media(target.account, image_url, content_hash, cached_media, now, target.unposted_media_ttl_seconds)
+    return media
+
+
+class MediaUploads:
+    """
+    Uploads the images of the next statuses of a target while earlier statuses are sent, so that uploads and
+    the target processing media overlap across statuses. Statuses are still sent one by one and in order
+    """
+    def __init__(self, store: StateStore, feed_key: str, target: Target, images: SharedImages):
+        self.store = store
+        self.feed_key = feed_key
+        self.target = target
+        self.images = images
+        self._lock = threading.Lock()
+        self._uploads = {}  # type: Dict[str, Future]
+        self._hash_locks = {}  # type: Dict[str, threading.Lock]
+        self._executor = ThreadPoolExecutor(max_workers=MEDIA_UPLOAD_CONCURRENCY, thread_name_prefix='upload')
+
+    def _hash_lock(self, content_hash: str) -> threading.Lock:
+        with self._lock:
+            return self._hash_locks.setdefault(content_hash, threading.Lock())
+
+    def prefetch(self, image_urls: List[str]):
+        with self._lock:
+            for image_url in image_urls:
+                if image_url not in self._uploads:
+                    self._uploads[image_url] = self._executor.submit(
+                        get_or_upload_media, self.store, self.feed_key, self.target, image_url, self.images, self._hash_lock
+                    )
+
+    def get(self, image_url: str) -> Any:
+        # Raises what the upload raised
+        self.prefetch([image_url])
+        return self._uploads[image_url].result()
+
+    def close(self):
+        # Uploads that were not started are dropped, and ones in progress still end up in the media cache
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def feed_key_of(config: XpostConfig) -> str:
+    # Feeds are keyed by the Twitter handle rather than the RSS URL, so that they can be fetched from any Nitter host
+    return f"nitter:{config.twitter_handle}"
+
+
+def normalize_entry_id(entry_id: str) -> str:
+    # GUIDs are links to the Nitter host that served the feed, so the host is dropped to compare entries across hosts
+    return urlunparse(urlparse(entry_id)._replace(scheme='', netloc=''))
+
+
+def status_id_of(entry_id: str) -> Optional[int]:
+    # Entry ids are links to statuses such as /twitter_handle/status/123#m, and status ids grow over time
+    match = STATUS_ID_PATTERN.search(entry_id)
+    return int(match.group(1)) if match else None
+
+
+def target_feed_name(feed_key: str, account: str) -> str:
+    # Seen statuses and the outbox are kept per account, so that a feed can be sent to several accounts on the same kind of target
+    return f"{account}:{feed_key}"
+
+
+def legacy_target_feed_name(feed_key: str, target: str) -> str:
+    # Before that, they were kept per kind of target
+    return f"{target}:{feed_key}"
+
+
+def get_target_last_position(store: StateStore, feed_key: str, target: str) -> Optional[str]:
+    # Positions used to be tracked per feed before targets could be combined, so fall back to that
+    return store.get_last_position(legacy_target_feed_name(feed_key, target)) or store.get_last_position(feed_key)
+
+
+def adopt_legacy_feed(store: StateStore, feed_key: str, target: Target):
+    # Takes over the statuses that the target saw and queued while they were kept under another account or per kind of target
+    feed_name = target_feed_name(feed_key, target.account)
+    legacy_feed_names = [target_feed_name(feed_key, account) for account in target.legacy_accounts]
+    for legacy_feed_name in legacy_feed_names + [legacy_target_feed_name(feed_key, target.name)]:
+        if store.has_seen(feed_name):
+            break
+        store.rename_feed(legacy_feed_name, feed_name)
+
+
+class LazyParsedEntries:
+    """
+    Parses feed entries on first use, so that entries that no target is going to post are never parsed
+    """
+    def __init__(self, twitter_handle: str, nitter_host: str):
+        self.twitter_handle = twitter_handle
+        self.nitter_host = nitter_host
+        self._lock = threading.Lock()
+        self._parsed_entries = {}  # type: Dict[str, ParsedEntry]
+
+    def get(self, entry) -> ParsedEntry:
+        with self._lock:
+            if entry.id not in self._parsed_entries:
+                self._parsed_entries[entry.id] = parse_feed_entry(entry, self.twitter_handle, self.nitter_host)
+            return self._parsed_entries[entry.id]
+
+
+def legacy_new_feed_entries(feed_entries: list, last_position: str) -> list:
+    # Before seen statuses were kept, only the newest crawled entry was, and feed entries are ordered newest first
+    entry_ids = [entry.id for entry in feed_entries]
+    if last_position in entry_ids:
+        return feed_entries[:entry_ids.index(last_position)]
+    # The entry dropped out of the feed, so fall back to statuses that are newer than it
+    last_status_id = status_id_of(last_position)
+    if last_status_id is None:
+        return []
+    return [entry for entry in feed_entries if status_id_of(entry.id) > last_status_id]
+
+
+def enqueue_for_target(store: StateStore, feed_key: str, target: Target, feed_entries: list, parsed_entries: LazyParsedEntries, now: float):
+    feed_name = target_feed_name(feed_key, target.account)
+    status_ids = {entry.id: status_id_of(entry.id) for entry in feed_entries}
+    feed_entries = [entry for entry in feed_entries if status_ids[entry.id] is not None]
+
+    # Entries whose status was not seen before are new, without parsing them
+    if store.has_seen(feed_name):
+        seen_status_ids = store.get_seen(feed_name, [status_ids[entry.id] for entry in feed_entries])
+        new_feed_entries = [entry for entry in feed_entries if status_ids[entry.id] not in seen_status_ids]
     else:
-        raise feed.bozo_exception
-    
-    if not parsed_entries:
-        # TODO: handle case. might be locked account? might be nitter down?
-        logging.info("No RSS entries found in feed")
+        last_position = get_target_last_position(store, feed_key, target.name)
+        if last_position is None:
+            # Assume just started tracking, so only statuses from now on are posted
+            logging.info(f"Finished crawling for {target.name}. Feed is crawled for the first time")
+            store.set_seen(feed_name, [status_ids[entry.id] for entry in feed_entries], now)
+            return
+        new_feed_entries = legacy_new_feed_entries(feed_entries, last_position)
+
+    # Statuses that are still in the feed are kept as seen
+    new_entry_ids = {entry.id for entry in new_feed_entries}
+    store.set_seen(feed_name, [status_ids[entry.id] for entry in feed_entries if entry.id not in new_entry_ids], now)
+    if not new_feed_entries:
+        logging.info(f"Finished crawling for {target.name}. No new statuses")
         return
 
-    # Go over parsed entries and figure out if there is an entry that matches last position
-    last_position = get_last_position(config.sqlite_file, rss_url)
-    last_position_index = -1
-    for index, parsed_entry in enumerate(parsed_entries):
-        if last_position == parsed_entry.id:
-            last_position_index = index
-            break
-
-    # If last position is already lastest or cannot be found in the feed (assume just started tracking), set last position to the newest entry and quit
-    if last_position_index in (0, -1):
-        logging.info("Finished crosspost. Last position is already latest or cannot be found in the feed")
-        set_last_position(config.sqlite_file, rss_url, parsed_entries[0].id)
+    # Only the oldest new entries within the status limit are parsed and queued, the rest are left unseen for later runs
+    if target.status_limit > 0:
+        new_feed_entries = new_feed_entries[max(0, len(new_feed_entries) - target.status_limit):]
+    entries_to_enqueue = [parsed_entries.get(entry) for entry in reversed(new_feed_entries)]
+
+    store.enqueue_outbox(
+        feed_name,
+        [(status_ids[parsed_entry.id], parsed_entry.id, dump_parsed_entry(parsed_entry)) for parsed_entry in entries_to_enqueue],
+        now
+    )
+    STATUSES_QUEUED.inc(len(entries_to_enqueue), feed=feed_key, target=target.name)
+    logging.info(f"Finished crawling for {target.name}, queued {len(entries_to_enqueue)} statuses")
+
+
+def send_status(store: StateStore, feed_key: str, target: Target, parsed_entry: ParsedEntry, progress: Optional[str], uploads: MediaUploads):
+    # Wait for the images to be uploaded for target. The uploaded media is only held until the status is sent,
+    # the media cache keeps it across statuses. A status that was partly sent already has its images
+    media = [uploads.get(image_url) for image_url in parsed_entry.image_urls] if progress is None else []
+
+    # Send status
+    with POST_SECONDS.time(feed=feed_key, target=target.name):
+        target.post(parsed_entry, media, progress)
+    STATUSES_SENT.inc(feed=feed_key, target=target.name)
+
+    store.set_cached_media_posted(
+        target.account,
+        [target.dump_media(uploaded) for uploaded in media],
+        time.time(),
+        target.posted_media_ttl_seconds
+    )
+
+
+def deliver_to_target(store: StateStore, feed_key: str, target: Target, images: SharedImages, retry_base_seconds: float):
+    # `images` can be anything with the prefetch and get methods of SharedImages
+    feed_name = target_feed_name(feed_key, target.account)
+    now = time.time()
+    pending = [
+        (seq, load_parsed_entry(entry), attempts, next_attempt_at, progress)
+        for seq, entry, attempts, next_attempt_at, progress in store.get_pending_outbox(feed_name)
+    ]
+    if not pending:
+        record_backlog(store, feed_key, target)
         return
 
-    new_position_index = last_position_index - 1
-    for i in range(new_position_index, max(-1, new_position_index - config.mastodon_status_limit), -1):
-        parsed_entry = parsed_entries[i]
-        
-        # Download image files for entry
-        failed_to_download_any = False
-        for image_url in parsed_entry.image_urls:
-            image_file = download_image_to_tmp_file(image_url)
-            if not image_file:
-                failed_to_download_any = True
-                break
-            parsed_entries[i].image_files.append(image_file)
-
-        if failed_to_download_any:
-            break
-        
-        if config.is_mastodon():
-            # Upload image files for mastodon
-            failed_to_upload_any = False
-            for image_file in parsed_entry.image_files:
-                media_id = upload_media_to_mastodon(image_file, mastodon)
-                if not media_id:
-                    failed_to_upload_any = True
-                    break
-                parsed_entries[i].mastodon_media_ids.append(media_id)
-            
-            if failed_to_upload_any:
+    bucket = TokenBucket(store, target.account, target.rate_limit)
+    uploads = MediaUploads(store, feed_key, target, images)
+    try:
+        for index, (seq, parsed_entry, attempts, next_attempt_at, progress) in enumerate(pending):
+            # Statuses are sent in order, so nothing newer is sent while a status waits to be retried
+            if next_attempt_at > now:
+                logging.info(f"Waiting to retry sending {parsed_entry.id} to {target.name}")
                 break
 
-            # Send mastodon statuses
-            if not post_to_mastodon(parsed_entry, mastodon):
+            # Statuses over the rate limit are left for later runs
+            if not bucket.acquire():
+                logging.info(f"Reached rate limit of {target.name}, sending the remaining statuses later")
                 break
 
-        elif config.is_bsky():
-            # Upload image files for bsky
-            failed_to_upload_any = False
-            for image_file in parsed_entry.image_files:
-                blob = upload_media_to_bsky(image_file, bsky)
-                if not blob:
-                    failed_to_upload_any = True
+            # Start downloading and uploading the images of this status and of the next ones that can be sent in this run,
+            # up to the first one that is not due and the tokens left
+            upcoming_entries = []
+            for _, upcoming_entry, _, upcoming_next_attempt_at, upcoming_progress in pending[index:index + min(MEDIA_UPLOAD_AHEAD, bucket.available() + 1)]:
+                if upcoming_next_attempt_at > now:
                     break
-                parsed_entries[i].bsky_blobs.append(blob)
-            
-            if failed_to_upload_any:
+                if upcoming_progress is None:
+                    upcoming_entries.append(upcoming_entry)
+            images.prefetch([
+                image_url
+                for upcoming_entry in upcoming_entries
+                for image_url in upcoming_entry.image_urls
+                if store.get_cached_media_by_url(target.account, image_url, now) is None
+            ])
+            for upcoming_entry in upcoming_entries:
+                uploads.prefetch(upcoming_entry.image_urls)
+
+            try:
+                send_status(store, feed_key, target, parsed_entry, progress, uploads)
+            except RateLimitedError as e:
+                FAILURES.inc(feed=feed_key, target=target.name, kind='rate_limited')
+                bucket.block_until(e.retry_at)
                 break
+            except Exception as e:
+                attempts += 1
+                # A status that was partly sent is retried from where it stopped, and given up on by what stopped it
+                if isinstance(e, PartiallySentError):
+                    progress, cause = e.progress, e.cause
+                else:
+                    cause = e
+                transient = cause.transient if isinstance(cause, DownloadError) else target.is_transient(cause)
+                FAILURES.inc(feed=feed_key, target=target.name, kind='transient' if transient else 'permanent')
+                if transient and attempts < MAX_DELIVERY_ATTEMPTS:
+                    delay = backoff_seconds(attempts, retry_base_seconds)
+                    logging.warning(f"Error sending {parsed_entry.id} to {target.name}, retrying in {delay:.0f} seconds: {e}")
+                    store.retry_outbox(seq, attempts, time.time() + delay, str(e), progress)
+                    break
+                logging.error(f"Error sending {parsed_entry.id} to {target.name}, giving up after {attempts} attempts: {e}")
+                store.fail_outbox(seq, attempts, str(e), time.time(), progress)
+                continue
+            store.delete_outbox(seq)
+    finally:
+        uploads.close()
+    record_backlog(store, feed_key, target)
+    logging.info(f"Finished delivering to {target.name}")
+
+
+def record_backlog(store: StateStore, feed_key: str, target: Target):
+    count, oldest_created_at = store.get_outbox_backlog(target_feed_name(feed_key, target.account))
+    OUTBOX_SIZE.set(count, feed=feed_key, target=target.name)
+    OUTBOX_LAG_SECONDS.set(time.time() - oldest_created_at if oldest_created_at else 0, feed=feed_key, target=target.name)
+
+
+def xpost(config: XpostConfig, clients: Optional[XpostClients] = None, deliver: bool = True):
+    # Clients are reused across runs in daemon mode, in which case the caller commits the store once all feeds are crawled
+    if clients is not None:
+        xpost_with_clients(config, clients, deliver)
+        return
+
+    clients = create_clients(config)
+    try:
+        xpost_with_clients(config, clients, deliver)
+    finally:
+        clients.store.close()
+
+
+def xpost_with_clients(config: XpostConfig, clients: XpostClients, deliver: bool = True):
+    # Statuses queued by earlier runs are still delivered when crawling fails
+    try:
+        crawl(config, clients)
+    finally:
+        if deliver:
+            deliver_outbox(config, clients)
 
-            # Send bsky statuses
-            if not post_to_bsky(parsed_entry, bsky):
-                break
 
-        new_position_index = i
+def crawl(config: XpostConfig, clients: XpostClients):
+    # Queues new feed entries for each target to be sent by deliver_outbox
+    logging.info("Started crawl")
+    feed_key = feed_key_of(config)
+    targets = build_targets(config, clients)
+    validators, headers = feed_request_headers(clients.store, feed_key, targets)
 
-    # Set last position to the newest entry
-    set_last_position(config.sqlite_file, rss_url, parsed_entries[new_position_index].id)
+    pool = NitterPool(clients.store, config.nitter_hosts())
+    try:
+        nitter_host, res = fetch_feed(pool, clients.session, config.twitter_handle, config.nitter_https, headers, REQUEST_TIMEOUT_SECONDS)
+    except Exception as e:
+        record_fetch_error(feed_key, e)
+        return
+    process_feed_response(config, clients.store, feed_key, targets, validators, nitter_host, res.status_code, res.content, res.text, res.headers)
+
+
+def record_fetch_error(feed_key: str, e: Exception):
+    # The crawl is given up on until the next run, and the statuses that were already queued are still delivered
+    FAILURES.inc(feed=feed_key, target='nitter', kind='fetch')
+    logging.error("Error retrieving tweets, aborting: " + str(e))
+
+
+def feed_request_headers(store: StateStore, feed_key: str, targets: List[Target]) -> Tuple[Optional[tuple], Dict[str, str]]:
+    # If all targets already caught up with the last crawled response, an unchanged response means there is nothing to do,
+    # so ask Nitter to only send the feed if it changed since then.
+    # Returns the validators of the last crawled response if so
+    validators = store.get_feed_validators(feed_key)
+    head_status_id = status_id_of(validators[3]) if validators is not None and validators[3] else None
+    caught_up = head_status_id is not None \
+        and all(store.get_seen(target_feed_name(feed_key, target.account), [head_status_id]) for target in targets)
+    if not caught_up:
+        return None, {}
+    headers = {}
+    etag, last_modified, _, _ = validators
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return validators, headers
+
+
+def process_feed_response(config: XpostConfig, store: StateStore, feed_key: str, targets: List[Target], validators: Optional[tuple], nitter_host: str, status_code: int, content: bytes, text: str, response_headers):
+    # `nitter_host` is the host that served the response
+    if status_code == 304:
+        logging.info("Finished crawl. Feed is not modified")
+        return
+    content_hash = hashlib.sha256(content).hexdigest()
+    if validators is not None and content_hash == validators[2]:
+        logging.info("Finished crawl. Feed is unchanged")
+        return
+    FEED_BYTES.inc(len(content), feed=feed_key)
+    with FEED_PARSE_SECONDS.time(feed=feed_key):
+        feed = feedparser.parse(text)
+
+    if feed.bozo != 0:
+        raise feed.bozo_exception
+
+    if not feed.entries:
+        # TODO: handle case. might be locked account? might be nitter down?
+        logging.info("No RSS entries found in feed")
+        return
 
-    # Clean up image files
-    for parsed_entry in parsed_entries:
-        for image_file in parsed_entry.image_files:
-            cleanup_tmp_file(image_file)
-    logging.info("Finished crosspost")
+    # Only the fields that are used are kept, and the rest of the parsed feed is released before entries are parsed and queued
+    feed_entries = [
+        FeedEntry(normalize_entry_id(entry.id), entry.get('description'), entry.get('author'), entry.get('link'))
+        for entry in feed.entries
+    ]
+    del feed
+
+    # Fan out the same feed entries to all targets, each of them keeping its own seen statuses and outbox
+    # so that one target being down doesn't hold back the others
+    now = time.time()
+    parsed_entries = LazyParsedEntries(config.twitter_handle, nitter_host)
+    for target in targets:
+        enqueue_for_target(store, feed_key, target, feed_entries, parsed_entries, now)
+    for target in targets:
+        feed_name = target_feed_name(feed_key, target.account)
+        store.evict_seen(feed_name, now - SEEN_RETENTION_SECONDS)
+        # Positions from before seen statuses were kept are dropped once there are seen statuses, so that a stale one is never used again
+        if store.has_seen(feed_name):
+            store.delete_last_position(legacy_target_feed_name(feed_key, target.name))
+    if all(store.has_seen(target_feed_name(feed_key, target.account)) for target in targets):
+        store.delete_last_position(feed_key)
+
+    store.set_feed_validators(
+        feed_key,
+        response_headers.get('ETag'),
+        response_headers.get('Last-Modified'),
+        content_hash,
+        feed_entries[0].id
+    )
+    logging.info("Finished crawl")
+
+
+def deliver_outbox(config: XpostConfig, clients: XpostClients):
+    # Sends the statuses that are due in the outbox of each target
+    store = clients.store
+    feed_key = feed_key_of(config)
+    targets = build_targets(config, clients)
+    images = SharedImages(clients.session, config.media_spill_bytes)
+    try:
+        with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix='target') as executor:
+            futures = [
+                executor.submit(deliver_to_target, store, feed_key, target, images, config.retry_base_seconds)
+                for target in targets
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        images.cleanup()
+        evict_after_delivery(store)
+
+
+def evict_after_delivery(store: StateStore):
+    now = time.time()
+    store.evict_media_cache(now, MEDIA_CACHE_MAX_ENTRIES)
+    store.evict_outbox(now - FAILED_RETENTION_SECONDS)
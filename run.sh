@@ -1,5 +1,11 @@
 #!/bin/bash
 
+# In daemon mode main.py schedules crawls and runs post.sh itself, so cron is not needed
+if [ "${DAEMON}" = "true" ]; then
+    echo "DAEMON environment variable is true, running as a long-running process"
+    exec /usr/local/bin/python /app/main.py
+fi
+
 # Create a script that loads environment for the cron job
 printenv | sed 's/^\([a-zA-Z0-9_]*\)=\(.*\)$/export \1="\2"/g' > /app/env.sh
 chmod +x /app/env.sh